@@ -0,0 +1,417 @@
+# coding=utf-8
+"""
+Throughput and latency of the three client stacks, paypal.PayPalInterface
+('interface'), paypalnvp.core.PayPal ('paypalnvp') and paypalrestsdk
+('rest'), running the same workloads against the local emulators of
+paypal_emulator, each in its own process:
+
+checkout
+    SetExpressCheckout, GetExpressCheckoutDetails, DoExpressCheckoutPayment;
+    REST: create a PayPal payment and execute it.
+capture
+    DoDirectPayment as Authorization, then DoCapture; REST has no
+    authorizations in this SDK and pays by credit card with intent 'sale'.
+lookup
+    GetTransactionDetails; REST: Payment.find.
+history
+    TransactionSearch (up to 100 rows); REST: a page of 20 payments.
+
+Each workload runs at every concurrency level (client threads), after a
+warm-up. Reported per stack, workload and level as JSON: operations and API
+calls per second, p50/p95/p99/max latency of an operation, client CPU and
+emulator CPU per call, and the client's resident memory with its growth per
+call. Compare the output of two versions to find regressions:
+
+    python benchmarks/client_stacks.py --concurrency 1,4,16 \\
+        --operations 500 --output before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import platform
+import optparse
+import threading
+import subprocess
+
+MODULES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'modules')
+sys.path.insert(0, MODULES)
+
+import paypal
+import paypalrestsdk
+from paypalnvp import core, fields, requests
+
+STACKS = ('interface', 'paypalnvp', 'rest')
+WORKLOADS = ('checkout', 'capture', 'lookup', 'history')
+CARD = '4417119669820331'
+
+def start_emulator(module, latency=None):
+    """Runs ``module`` (nvp or rest) in a child process; returns it and its url."""
+    command = [sys.executable, '-m', 'paypal_emulator.' + module,
+               '--port', '0']
+    if latency:
+        command += ['--latency', latency]
+    process = subprocess.Popen(command, cwd=MODULES, stdout=subprocess.PIPE)
+    url = process.stdout.readline().split(' on ')[-1].strip()
+    if not url.startswith('http'):
+        process.kill()
+        raise RuntimeError('%s emulator did not start' % module)
+    return process, url
+
+def process_cpu(pid):
+    """The CPU seconds used by process ``pid``, None where /proc is missing."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    return (int(stat[11]) + int(stat[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def rss_kib():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except IOError:
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def amount():
+    return '%d.%02d' % (random.randint(5, 500), random.randint(0, 99))
+
+
+class InterfaceStack(object):
+    """paypal.PayPalInterface, one per thread."""
+
+    def __init__(self, url):
+        self.url = url
+        self.ids = []
+
+    def client(self):
+        client = paypal.PayPalInterface(API_USERNAME='bench',
+                                        API_PASSWORD='bench',
+                                        API_SIGNATURE='bench')
+        client.config.API_ENDPOINT = self.url
+        return client
+
+    def checkout(self, client):
+        token = client.set_express_checkout(
+            amt=amount(), returnurl='http://shop/return',
+            cancelurl='http://shop/cancel', paymentaction='Sale').token
+        details = client.get_express_checkout_details(token)
+        done = client.do_express_checkout_payment(
+            token, payerid=details.payerid, amt=details.amt,
+            paymentaction='Sale')
+        self.ids.append(done.transactionid)
+        return 3
+
+    def capture(self, client):
+        auth = client.do_direct_payment(
+            'Authorization', amt=amount(), creditcardtype='Visa', acct=CARD,
+            expdate='012030', cvv2='962', firstname='Test', lastname='Buyer')
+        client.do_capture(auth.transactionid, auth.amt)
+        return 2
+
+    def lookup(self, client):
+        client.get_transaction_details(random.choice(self.ids))
+        return 1
+
+    def history(self, client):
+        client._call('TransactionSearch', startdate='2000-01-01T00:00:00Z')
+        return 1
+
+
+class Call(core.Request):
+    """Any NVP call, for the methods paypalnvp.requests does not cover."""
+
+    def __init__(self, method, **fields):
+        self._nvp_request = dict(fields, METHOD=method)
+        self._nvp_response = dict()
+
+    def get_nvp_request(self):
+        return dict(self._nvp_request)
+
+    def set_nvp_response(self, nvp_response):
+        self._nvp_response = nvp_response
+
+    def get_nvp_response(self):
+        return self._nvp_response
+
+
+class LocalPooledHttpPost(core.PooledHttpPost):
+    """Sends what core.PayPal addresses to PayPal to the emulator."""
+
+    def __init__(self, url):
+        core.PooledHttpPost.__init__(self)
+        self.url = url
+
+    def send(self, exchange):
+        exchange.url = self.url
+        return core.PooledHttpPost.send(self, exchange)
+
+
+class PaypalnvpStack(object):
+    """paypalnvp.core.PayPal, one pooled transport shared by all threads."""
+
+    def __init__(self, url):
+        self.transport = LocalPooledHttpPost(url)
+        self.ids = []
+
+    def client(self):
+        profile = core.BaseProfile('bench', 'bench')
+        profile.set_signature('bench')
+        return core.PayPal(profile, sandbox=True, transport=self.transport)
+
+    def call(self, client, request):
+        client.set_response(request)
+        response = request.get_nvp_response()
+        if response.get('ACK') != 'Success':
+            raise RuntimeError('%s failed: %s' % (
+                request.get_nvp_request()['METHOD'], response))
+        return response
+
+    def payment(self):
+        items = []
+        for i in range(random.randint(1, 5)):
+            item = fields.PaymentItem()
+            item.set_name('Item %d' % i)
+            item.set_amount(amount())
+            item.set_quantity(random.randint(1, 3))
+            items.append(item)
+        return fields.Payment(items=items)
+
+    def checkout(self, client):
+        payment = self.payment()
+        token = self.call(client, requests.SetExpressCheckout(
+            payment, 'http://shop/return', 'http://shop/cancel'))['TOKEN']
+        details = self.call(client, requests.GetExpressCheckoutDetails(token))
+        done = self.call(client, requests.DoExpressCheckoutPayment(
+            payment, token, 'Sale', details['PAYERID']))
+        self.ids.append(done['PAYMENTINFO_0_TRANSACTIONID'])
+        return 3
+
+    def capture(self, client):
+        auth = self.call(client, Call('DoDirectPayment',
+            PAYMENTACTION='Authorization', AMT=amount(), CREDITCARDTYPE='Visa',
+            ACCT=CARD, EXPDATE='012030', CVV2='962'))
+        self.call(client, Call('DoCapture', AUTHORIZATIONID=auth['TRANSACTIONID'],
+                               AMT=auth['AMT'], COMPLETETYPE='Complete'))
+        return 2
+
+    def lookup(self, client):
+        self.call(client, Call('GetTransactionDetails',
+                               TRANSACTIONID=random.choice(self.ids)))
+        return 1
+
+    def history(self, client):
+        self.call(client, Call('TransactionSearch',
+                               STARTDATE='2000-01-01T00:00:00Z'))
+        return 1
+
+
+class RestStack(object):
+    """paypalrestsdk with the process wide Api, which all threads share."""
+
+    def __init__(self, url):
+        paypalrestsdk.set_config(mode='sandbox', client_id='bench',
+                                 client_secret='bench', endpoint=url)
+        self.ids = []
+
+    def client(self):
+        return paypalrestsdk.api.default()
+
+    def create(self, attributes):
+        payment = paypalrestsdk.Payment(attributes)
+        if not payment.create():
+            raise RuntimeError('payment failed: %s' % payment.error)
+        return payment
+
+    def transactions(self):
+        return [{'amount': {'total': amount(), 'currency': 'USD'},
+                 'description': 'Benchmark order'}]
+
+    def checkout(self, client):
+        payment = self.create({
+            'intent': 'sale', 'payer': {'payment_method': 'paypal'},
+            'redirect_urls': {'return_url': 'http://shop/return',
+                              'cancel_url': 'http://shop/cancel'},
+            'transactions': self.transactions()})
+        if not payment.execute({'payer_id': 'BENCHBUYER'}):
+            raise RuntimeError('execute failed: %s' % payment.error)
+        self.ids.append(payment.id)
+        return 2
+
+    def capture(self, client):
+        self.create({
+            'intent': 'sale',
+            'payer': {'payment_method': 'credit_card', 'funding_instruments': [
+                {'credit_card': {'type': 'visa', 'number': CARD,
+                                 'expire_month': '1', 'expire_year': '2030',
+                                 'cvv2': '962'}}]},
+            'transactions': self.transactions()})
+        return 1
+
+    def lookup(self, client):
+        paypalrestsdk.Payment.find(random.choice(self.ids))
+        return 1
+
+    def history(self, client):
+        paypalrestsdk.Payment.all({'count': 20})
+        return 1
+
+
+def run_level(stack, workload, emulator, threads, operations):
+    """Runs ``operations`` of ``workload`` on ``threads`` threads."""
+    operation = getattr(stack, workload)
+    latencies = [[] for _ in range(threads)]
+    calls = [0] * threads
+    errors = []
+
+    def worker(n):
+        client = stack.client()
+        try:
+            for _ in range(n, operations, threads):
+                started = time.time()
+                calls[n] += operation(client)
+                latencies[n].append(time.time() - started)
+        except Exception as e:
+            errors.append(repr(e))
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    rss = rss_kib()
+    server_cpu = process_cpu(emulator.pid)
+    cpu = sum(os.times()[:2])
+    started = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - started
+    cpu = sum(os.times()[:2]) - cpu
+    if server_cpu is not None:
+        server_cpu = process_cpu(emulator.pid) - server_cpu
+
+    samples = sum(latencies, [])
+    total = sum(calls)
+    result = {
+        'concurrency': threads,
+        'operations': len(samples),
+        'calls': total,
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'operations_per_second': round(len(samples) / elapsed, 1),
+        'calls_per_second': round(total / elapsed, 1),
+    }
+    if samples:
+        result.update({
+            'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+            'max_ms': round(max(samples) * 1000, 3),
+        })
+    if total:
+        result['client_cpu_ms_per_call'] = round(cpu * 1000 / total, 3)
+        if server_cpu is not None:
+            result['emulator_cpu_ms_per_call'] = round(
+                server_cpu * 1000 / total, 3)
+        if rss is not None:
+            after = rss_kib()
+            result['rss_kib'] = after
+            result['rss_growth_bytes_per_call'] = round(
+                (after - rss) * 1024.0 / total, 1)
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--stacks', default=','.join(STACKS))
+    parser.add_option('--workloads', default=','.join(WORKLOADS))
+    parser.add_option('--concurrency', default='1,4,16',
+                      help='comma separated thread counts')
+    parser.add_option('--operations', type='int', default=300,
+                      help='operations per workload and level')
+    parser.add_option('--warmup', type='int', default=20,
+                      help='operations before each workload is measured')
+    parser.add_option('--latency', metavar='SPEC',
+                      help='emulated PayPal latency, e.g. constant:0.05')
+    parser.add_option('--output', metavar='FILE',
+                      help='write the JSON report to FILE too')
+    options, _ = parser.parse_args(argv)
+    levels = [int(n) for n in options.concurrency.split(',')]
+    random.seed(1)
+
+    nvp, nvp_url = start_emulator('nvp', options.latency)
+    rest, rest_url = start_emulator('rest', options.latency)
+    stacks = {
+        'interface': (InterfaceStack(nvp_url + '/nvp'), nvp),
+        'paypalnvp': (PaypalnvpStack(nvp_url + '/nvp'), nvp),
+        'rest': (RestStack(rest_url), rest),
+    }
+    results = []
+    try:
+        for name in options.stacks.split(','):
+            stack, emulator = stacks[name]
+            # Transactions for lookups; they also warm connections and caches.
+            client = stack.client()
+            for _ in range(options.warmup):
+                stack.checkout(client)
+            for workload in options.workloads.split(','):
+                operation = getattr(stack, workload)
+                for _ in range(options.warmup):
+                    operation(client)
+                for threads in levels:
+                    result = run_level(stack, workload, emulator, threads,
+                                       options.operations)
+                    result.update(stack=name, workload=workload)
+                    results.append(result)
+                    sys.stderr.write('%-10s %-9s %3d threads: %8.1f ops/s '
+                        'p99 %.2f ms\n' % (name, workload, threads,
+                        result['operations_per_second'],
+                        result.get('p99_ms', 0)))
+    finally:
+        nvp.kill()
+        rest.kill()
+
+    report = json.dumps({
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'host': {'name': socket.gethostname(), 'cpus': _cpus(),
+                 'platform': platform.platform()},
+        'options': {'operations': options.operations,
+                    'warmup': options.warmup,
+                    'latency': options.latency},
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    print report
+
+def _cpus():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return None
+
+if __name__ == '__main__':
+    main()
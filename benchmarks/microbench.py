@@ -0,0 +1,305 @@
+# coding=utf-8
+"""
+Microbenchmarks of the pure-Python hot paths of checkout workers:
+
+payment_request
+    paypalnvp Payment.get_nvp_request with ``items`` line items.
+set_express_checkout
+    Building a paypalnvp SetExpressCheckout and its get_nvp_request, with
+    the deep copies of requests.py.
+nvp_response_copy
+    set_nvp_response and get_nvp_response (deep copies) of ``fields``
+    response fields.
+interface_urlencode
+    PayPalInterface's utf-8 encoding and urllib.urlencode of the
+    credentials and ``fields`` request fields.
+paypal_response_parse
+    PayPalResponse of an NVP answer with ``fields`` fields (parse_qs).
+paypal_response_getattr
+    Reading 10 fields of such a PayPalResponse through __getattr__.
+resource_merge, resource_to_dict
+    paypalrestsdk Resource from a payment with ``depth`` levels of nested
+    objects, and back.
+
+Each case is timed in process CPU time with the garbage collector off, in
+batches calibrated to about 50 ms, after a warm-up batch; the fastest of
+``--repeat`` batches gives the time per operation. Allocations are counted
+with tracemalloc where available (bytes and blocks per operation); on
+Python 2, which lacks it, ``objects`` is the growth of the garbage
+collector's count of new containers (instances, dicts, lists, tuples) during
+one operation: allocations less those freed again, except tuples that go
+back to the free list.
+
+Timings are normalized by a calibration loop of plain dict, string and list
+operations, timed before and after the cases, so results from a faster or
+slower (or busier) machine than the one the baselines came from compare
+with them. The results are compared with benchmarks/baselines/microbench.json
+and cases slower than their baseline by more than ``--tolerance`` are
+reported as regressions; with --strict the run then fails. Refresh the
+baselines with --update after intended changes:
+
+    python benchmarks/microbench.py [--filter NAME] [--strict] [--update]
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import urllib
+import platform
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'modules'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from paypal.interface import PayPalInterface
+from paypal.response import PayPalResponse
+from paypalnvp import fields, requests
+from paypalrestsdk.resource import Resource
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines', 'microbench.json')
+
+# CPU time of the process, in microseconds: time other processes take is not
+# counted.
+_clock = getattr(time, 'process_time', None) or time.clock
+
+ITEMS = (1, 10, 50)
+FIELDS = (10, 100, 500)
+DEPTHS = (2, 5, 8)
+
+def payment(items):
+    random.seed(items)
+    lines = []
+    for i in range(items):
+        item = fields.PaymentItem()
+        item.set_name('Item %d' % i)
+        item.set_description('Description of item %d' % i)
+        item.set_amount('%d.%02d' % (random.randint(1, 99), random.randint(0, 99)))
+        item.set_tax_amount('0.50')
+        item.set_quantity(random.randint(1, 3))
+        item.set_item_number('SKU-%05d' % i)
+        lines.append(item)
+    return fields.Payment(items=lines)
+
+def nvp_fields(n):
+    pairs = [('ACK', 'Success'), ('TOKEN', 'EC-0123456789ABCDEFG'),
+             ('CORRELATIONID', '3b3bd4a3e7a1c'), ('VERSION', '61.0')]
+    for i in range(n - len(pairs)):
+        pairs.append(('L_FIELD%d' % i, 'Value number %d, with spaces & co' % i))
+    return pairs
+
+def nested(depth):
+    """A payment like JSON object, nested ``depth`` levels deep."""
+    node = {'amount': {'total': '10.00', 'currency': 'USD'},
+            'links': [{'href': 'https://api/x', 'rel': 'self',
+                       'method': 'GET'}] * 3}
+    for level in range(depth - 1):
+        node = {'id': 'RES-%d' % level, 'state': 'approved',
+                'create_time': '2015-01-01T00:00:00Z',
+                'related_resources': [{'sale': node}, {'refund': node}],
+                'payer': {'payment_method': 'paypal',
+                          'payer_info': {'email': 'buyer@example.com'}}}
+    return node
+
+
+def cases():
+    """(name, parameter, operation) of every case."""
+    for n in ITEMS:
+        p = payment(n)
+        yield 'payment_request', 'items=%d' % n, p.get_nvp_request
+        yield 'set_express_checkout', 'items=%d' % n, \
+            lambda p=p: requests.SetExpressCheckout(
+                p, 'http://shop/return', 'http://shop/cancel').get_nvp_request()
+
+    interface = PayPalInterface(API_USERNAME='bench_api1.example.com',
+                                API_PASSWORD='1234567890',
+                                API_SIGNATURE='A' * 56)
+    config = interface.config
+    for n in FIELDS:
+        pairs = nvp_fields(n)
+        answer = urllib.urlencode(pairs)
+        request = requests.GetExpressCheckoutDetails('EC-0123456789ABCDEFG')
+        response = dict(pairs)
+
+        def copies(request=request, response=response):
+            request.set_nvp_response(response)
+            return request.get_nvp_response()
+
+        def encode(values=dict((k.lower(), v) for k, v in pairs[4:])):
+            values = dict(values, user=config.API_USERNAME,
+                          pwd=config.API_PASSWORD,
+                          signature=config.API_SIGNATURE,
+                          method='DoExpressCheckoutPayment', version='60.0')
+            return urllib.urlencode(interface._encode_utf8(**values))
+
+        parsed = PayPalResponse(answer, config)
+        names = ['ack', 'token', 'correlationid', 'version'] + \
+            ['l_field%d' % i for i in range(6)]
+
+        def getattrs(parsed=parsed, names=names):
+            for name in names:
+                getattr(parsed, name)
+
+        yield 'nvp_response_copy', 'fields=%d' % n, copies
+        yield 'interface_urlencode', 'fields=%d' % n, encode
+        yield 'paypal_response_parse', 'fields=%d' % n, \
+            lambda answer=answer: PayPalResponse(answer, config)
+        yield 'paypal_response_getattr', 'fields=%d' % n, getattrs
+
+    for depth in DEPTHS:
+        document = nested(depth)
+        resource = Resource(document)
+        yield 'resource_merge', 'depth=%d' % depth, \
+            lambda document=document: Resource(document)
+        yield 'resource_to_dict', 'depth=%d' % depth, resource.to_dict
+
+
+def calibration():
+    """The reference workload timings are divided by."""
+    values = {}
+    for i in xrange(200):
+        values['key%d' % i] = 'value %d' % i
+    return '&'.join(sorted('%s=%s' % item for item in values.items()))
+
+
+def time_per_op(operation, repeat):
+    # Like timeit: collections would charge other cases' garbage to this one.
+    gc.collect()
+    gc.disable()
+    try:
+        return _time_per_op(operation, repeat)
+    finally:
+        gc.enable()
+
+def _time_per_op(operation, repeat):
+    number = 1
+    while True:
+        started = _clock()
+        for _ in xrange(number):
+            operation()
+        if _clock() - started >= 0.05:
+            break
+        number *= 2
+    for _ in xrange(number):
+        operation()
+    best = []
+    for _ in range(repeat):
+        started = _clock()
+        for _ in xrange(number):
+            operation()
+        best.append((_clock() - started) / number)
+    return min(best), number
+
+def allocations(operation):
+    """Allocations of one operation, after a warm-up call."""
+    operation()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        result = operation()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        del result
+        stats = after.compare_to(before, 'filename')
+        return {'bytes': sum(s.size_diff for s in stats if s.size_diff > 0),
+                'blocks': sum(s.count_diff for s in stats if s.count_diff > 0)}
+    gc.collect()
+    gc.disable()
+    try:
+        # The count of new containers never drops below zero: pad it so
+        # the objects the operation frees are subtracted.
+        padding = [[] for _ in xrange(100000)]
+        before = gc.get_count()[0]
+        result = operation()
+        objects = gc.get_count()[0] - before
+        del result, padding
+    finally:
+        gc.enable()
+    return {'objects': objects}
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--filter', default='',
+                      help='run the cases whose name contains this')
+    parser.add_option('--repeat', type='int', default=15)
+    parser.add_option('--tolerance', type='float', default=0.5,
+                      help='allowed slowdown against the baseline')
+    parser.add_option('--strict', action='store_true',
+                      help='exit with status 1 when a case regressed')
+    parser.add_option('--baselines', default=BASELINES)
+    parser.add_option('--update', action='store_true',
+                      help='write the results as new baselines')
+    options, _ = parser.parse_args(argv)
+
+    baselines = {}
+    if os.path.exists(options.baselines):
+        with open(options.baselines) as f:
+            baselines = json.load(f).get('cases', {})
+
+    selected = [case for case in cases() if options.filter in case[0]]
+    timings = []
+    unit = time_per_op(calibration, options.repeat)[0]
+    for name, parameter, operation in selected:
+        seconds, number = time_per_op(operation, options.repeat)
+        timings.append((name, parameter, operation, seconds, number))
+    # The machine is taken at its fastest of both ends of the run.
+    unit = min(unit, time_per_op(calibration, options.repeat)[0])
+
+    results = {}
+    regressions = []
+    for name, parameter, operation, seconds, number in timings:
+        key = '%s[%s]' % (name, parameter)
+        result = {'us_per_op': round(seconds * 1e6, 3), 'batch': number,
+                  'calibrated': round(seconds / unit, 3)}
+        result.update(allocations(operation))
+        baseline = baselines.get(key)
+        if baseline:
+            if 'calibrated' in baseline:
+                ratio = seconds / unit / baseline['calibrated']
+            else:
+                ratio = seconds * 1e6 / baseline['us_per_op']
+            result['vs_baseline'] = round(ratio, 3)
+            if ratio > 1 + options.tolerance:
+                regressions.append(key)
+        results[key] = result
+        sys.stderr.write('%-45s %10.2f us %s\n' % (key, result['us_per_op'],
+            'vs_baseline' in result and 'x%.2f' % result['vs_baseline'] or ''))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'calibration_us': round(unit * 1e6, 3),
+        'cases': results,
+    }
+    if options.update:
+        for result in results.values():
+            result.pop('vs_baseline', None)
+        baselines.update(results)
+        report['cases'] = baselines
+        directory = os.path.dirname(options.baselines)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(options.baselines, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True,
+                               separators=(',', ': ')) + '\n')
+        regressions = []
+    else:
+        report['regressions'] = regressions
+        for key in regressions:
+            sys.stderr.write('regression: %s x%.2f\n'
+                             % (key, results[key]['vs_baseline']))
+    print json.dumps(report, indent=2, sort_keys=True, separators=(',', ': '))
+    return 1 if regressions and options.strict else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# coding=utf-8
+"""
+Latency benchmark of the Instant Update (shipping callback) responder under
+concurrent callbacks.
+
+A threaded local HTTP server answers callbacks with
+paypalnvp.shipping.ShippingCallback from a rate table of a few thousand
+postal prefixes and weight bands; client threads post callback requests for
+random destinations and carts over keep-alive connections. Reported are the
+callbacks per second and latency percentiles, to compare with the 1 to 6
+second callback timeout PayPal allows.
+
+    python benchmarks/shipping_callback.py [callbacks] [threads]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import httplib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'modules'))
+
+from paypalnvp import shipping, util
+
+COUNTRIES = ('NL', 'BE', 'DE', 'FR', 'IT', 'US')
+
+def rate_table():
+    table = shipping.RateTable('EUR')
+    for country in COUNTRIES:
+        table.add_rate(country, 'Standard', '6.95')
+        table.add_rate(country, 'Express', '19.95', max_weight=30)
+        for prefix in range(10, 100):
+            for band, amount in ((1, '3.95'), (5, '5.95'), (20, '9.95')):
+                table.add_rate(country, 'Standard', amount, max_weight=band,
+                               postal_prefix=str(prefix))
+        table.set_tax_rate(country, 0.21)
+    table.build()
+    return table
+
+def callback_request(encoder):
+    pairs = [('METHOD', 'CallbackRequest'), ('CALLBACKVERSION', '61.0'),
+             ('CURRENCYCODE', 'EUR'), ('LOCALECODE', 'en_US')]
+    for i in range(random.randint(1, 5)):
+        pairs += [('L_NAME%d' % i, 'Item %d' % i),
+                  ('L_AMT%d' % i, '%d.%02d' % (random.randint(1, 99), 50)),
+                  ('L_QTY%d' % i, str(random.randint(1, 3))),
+                  ('L_ITEMWEIGHTVALUE%d' % i, str(random.randint(100, 5000))),
+                  ('L_ITEMWEIGHTUNIT%d' % i, 'g')]
+    pairs += [('SHIPTOCOUNTRY', random.choice(COUNTRIES)),
+              ('SHIPTOZIP', '%04d' % random.randint(1000, 9999))]
+    return encoder.encode(pairs)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(responder):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            answer = responder.respond(body)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main(callbacks=5000, threads=16):
+    started = time.time()
+    responder = shipping.ShippingCallback(rate_table())
+    build_seconds = time.time() - started
+    server = serve(responder)
+
+    encoder = util.NvpEncoder()
+    bodies = [callback_request(encoder) for _ in range(1000)]
+    latencies = [[] for _ in range(threads)]
+
+    def client(n):
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port, timeout=10)
+        for i in range(n, callbacks, threads):
+            started = time.time()
+            conn.request('POST', '/paypalnvp/shipping', bodies[i % len(bodies)],
+                         {'Content-Type': 'application/x-www-form-urlencoded'})
+            conn.getresponse().read()
+            latencies[n].append(time.time() - started)
+        conn.close()
+
+    started = time.time()
+    workers = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+
+    samples = sum(latencies, [])
+    inline = time.time()
+    for body in bodies:
+        responder.respond(body)
+    inline = (time.time() - inline) / len(bodies)
+
+    print json.dumps({
+        'callbacks': len(samples),
+        'threads': threads,
+        'table_build_ms': round(build_seconds * 1000, 1),
+        'per_second': round(len(samples) / elapsed, 1),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+        'respond_us': round(inline * 1e6, 1),
+    }, indent=2)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
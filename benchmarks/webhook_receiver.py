@@ -0,0 +1,141 @@
+# coding=utf-8
+"""
+Benchmark of paypalrestsdk.WebhookReceiver against a local stand-in for
+PayPal's webhook emitter.
+
+The emitter signs events with a throw-away certificate served from a local
+HTTP server, the way PayPal serves its signing certificates, and delivers
+them from several threads with a share of redeliveries. Reported are the
+events accepted per second, receive() latency percentiles, the number of
+certificate downloads (one, if caching works) and the handler batches.
+
+    python benchmarks/webhook_receiver.py [events] [threads] [redelivery share]
+
+Needs pyOpenSSL.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import base64
+import threading
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'modules'))
+
+from OpenSSL import crypto
+
+import paypalrestsdk
+
+WEBHOOK_ID = 'BENCH-WEBHOOK'
+CERT_PATH = '/v1/notifications/certs/CERT-bench'
+
+class Emitter(object):
+    """Signs events like PayPal does and serves the signing certificate."""
+    def __init__(self):
+        self.key = crypto.PKey()
+        self.key.generate_key(crypto.TYPE_RSA, 2048)
+        cert = crypto.X509()
+        cert.get_subject().CN = 'messageverificationcerts.paypal.com'
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(self.key)
+        cert.sign(self.key, 'sha256')
+        pem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(pem)))
+                self.end_headers()
+                self.wfile.write(pem)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.cert_url = 'http://127.0.0.1:%d%s' % (self.server.server_port,
+                                                   CERT_PATH)
+
+    def delivery(self, event):
+        body = json.dumps(event)
+        transmission_id = str(uuid.uuid4())
+        transmission_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        message = '%s|%s|%s|%d' % (transmission_id, transmission_time,
+                                   WEBHOOK_ID, zlib.crc32(body) & 0xffffffff)
+        headers = {
+            'PAYPAL-TRANSMISSION-ID': transmission_id,
+            'PAYPAL-TRANSMISSION-TIME': transmission_time,
+            'PAYPAL-TRANSMISSION-SIG': base64.b64encode(
+                crypto.sign(self.key, message, 'sha256')),
+            'PAYPAL-CERT-URL': self.cert_url,
+            'PAYPAL-AUTH-ALGO': 'SHA256withRSA',
+        }
+        return headers, body
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main(events=5000, threads=8, redelivery=0.1):
+    emitter = Emitter()
+    deliveries = []
+    for i in range(events):
+        event = { 'id': 'WH-%d' % i, 'event_type': 'PAYMENT.SALE.COMPLETED',
+                  'resource': { 'id': 'SALE-%d' % i, 'state': 'completed' } }
+        deliveries.append(emitter.delivery(event))
+    deliveries += deliveries[:int(events * redelivery)]
+
+    batches = []
+    receiver = paypalrestsdk.WebhookReceiver(
+        WEBHOOK_ID,
+        cert_cache=paypalrestsdk.CertificateCache(trusted_hosts=('127.0.0.1',)))
+    receiver.on('PAYMENT.SALE.COMPLETED', lambda batch: batches.append(len(batch)))
+
+    latencies = [[] for _ in range(threads)]
+    def deliver(n):
+        for headers, body in deliveries[n::threads]:
+            started = time.time()
+            receiver.receive(headers, body)
+            latencies[n].append(time.time() - started)
+
+    started = time.time()
+    workers = [threading.Thread(target=deliver, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+    receiver.flush()
+    deadline = time.time() + 5
+    while sum(batches) < receiver.received and time.time() < deadline:
+        time.sleep(0.01)
+
+    samples = sum(latencies, [])
+    print json.dumps({
+        'deliveries': len(deliveries),
+        'accepted': receiver.received,
+        'duplicates': receiver.duplicates,
+        'seconds': round(elapsed, 3),
+        'per_second': round(len(deliveries) / elapsed, 1),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'cert_fetches': receiver.cert_cache.fetches,
+        'batches': len(batches),
+        'handled': sum(batches),
+    }, indent=2)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    converters = (int, int, float)
+    main(*[convert(arg) for convert, arg in zip(converters, args)])
@@ -12,11 +12,17 @@ def index():
     # one (if applicable).
     #sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     import unittest
+    from paypal_payment import t_transport
+    from paypal_payment import t_ipn
+    from paypal_payment import t_shipping
+    from paypal_payment import t_finalize
+    from paypal_payment import t_prefetch
     from paypal_payment import t_direct_payment
     from paypal_payment import t_express_checkout
     
     # A list of the modules under the tests package that should be ran.
-    test_modules = [t_direct_payment, t_express_checkout]
+    test_modules = [t_transport, t_ipn, t_shipping, t_finalize, t_prefetch,
+        t_direct_payment, t_express_checkout]
     
     # Fire off all of the tests.
     for mod in test_modules:
@@ -0,0 +1,19 @@
+def _processor():
+    import paypal_ipn
+    return paypal_ipn.default(settings.paypal_ipn_spool,
+                              sandbox=settings.sandbox,
+                              uri=db._uri, folder=db._folder,
+                              workers=settings.paypal_ipn_workers)
+
+def index():
+    """
+    PayPal IPN listener. Use URL('paypalipn', 'index', scheme=True) as the
+    notify URL. The message is only spooled here; verification and the
+    database updates happen in background workers.
+    """
+    _processor().submit(request.body.read())
+    return ''
+
+def status():
+    """Number of spooled IPN messages per state, for monitoring."""
+    return response.json(_processor().spool.counts())
@@ -0,0 +1,9 @@
+def index():
+    """
+    Metrics of the PayPal API calls of all processes in Prometheus text
+    format. Map it to /metrics in routes.py if the scraper expects that path.
+    """
+    import paypal_transport
+    session.forget(response)
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return paypal_transport.install_metrics(settings.paypal_metrics_path).render()
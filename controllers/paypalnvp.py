@@ -1,8 +1,6 @@
-def index():
+def _paypal( transport=None ):
     # import the required modules
     import paypalnvp.core
-    import paypalnvp.requests
-    import paypalnvp.fields
     
     # set user - these are your credentials from paypal
     user = paypalnvp.core.BaseProfile(
@@ -10,6 +8,59 @@ def index():
        password=settings.paypal_password )
     user.set_signature( settings.paypal_signature )
     
+    # create new instance of paypal nvp
+    return paypalnvp.core.PayPal( user, sandbox=settings.sandbox, transport=transport )
+
+def _prefetcher():
+    # one token prefetcher per process
+    import paypalnvp.prefetch
+    return cache.ram( 'paypalnvp_prefetcher', 
+        lambda: paypalnvp.prefetch.TokenPrefetcher( _paypal() ), 
+        time_expire=None )
+
+def _finalizer():
+    # background DoExpressCheckoutPayment workers sharing pooled connections
+    import paypalnvp.core
+    import paypalnvp.finalize
+    def start():
+        paypal = _paypal( paypalnvp.core.PooledHttpPost( 
+            size=settings.paypal_finalize_workers ) )
+        queue = paypalnvp.finalize.FinalizationQueue( settings.paypal_finalize_queue )
+        return paypalnvp.finalize.Finalizer( paypal, queue, 
+            workers=settings.paypal_finalize_workers ).start()
+    return cache.ram( 'paypalnvp_finalizer', start, time_expire=None )
+
+def _sessions():
+    # SetExpressCheckout requests sent, by token
+    import paypalnvp.session
+    return cache.ram( 'paypalnvp_sessions', 
+        lambda: paypalnvp.session.CheckoutSessionStore( settings.paypal_checkout_sessions ), 
+        time_expire=None )
+
+def _rates():
+    # shipping rate tables, built once per process
+    import paypalnvp.shipping
+    def build():
+        table = paypalnvp.shipping.RateTable( settings.paypal_shipping_currency )
+        for rate in settings.paypal_shipping_rates:
+            table.add_rate( **rate )
+        for country, rate in settings.paypal_shipping_tax.items():
+            table.set_tax_rate( country, rate )
+        table.build()
+        return paypalnvp.shipping.ShippingCallback( table )
+    return cache.ram( 'paypalnvp_rates', build, time_expire=None )
+
+def _owner():
+    # the buyer the prefetched tokens belong to: response.session_id is
+    # still None on a first visit, so keep an id in the session itself
+    from gluon.utils import web2py_uuid
+    if not session.paypalnvp_owner:
+        session.paypalnvp_owner = web2py_uuid()
+    return session.paypalnvp_owner
+
+def _payment():
+    import paypalnvp.fields
+    
     # create items (items from a shopping basket)
     item1 = paypalnvp.fields.PaymentItem()
     item1.set_name( 'Tazza da caffe' )
@@ -24,22 +75,86 @@ def index():
     # create payment payment from the items
     payment = paypalnvp.fields.Payment( items=[item1, item2] )
     payment.set_currency( 'EUR' )
+    return payment
+
+def _set_express_checkout( payment ):
+    import paypalnvp.requests
     
     # create set express checkout - the first paypal request
-    set_ec = paypalnvp.requests.SetExpressCheckout( 
+    return paypalnvp.requests.SetExpressCheckout( 
         payment, URL('paypalnvp', 'success', scheme=True), 
         URL('paypalnvp', 'cancel', scheme=True) )
+
+def review():
+    # the cart page: ask paypal for the checkout token in the background,
+    # so the checkout button can redirect without waiting for paypal
+    _prefetcher().prefetch( _set_express_checkout( _payment() ), owner=_owner() )
+    return dict( checkout=URL('paypalnvp', 'index') )
+
+def index():
+    # use the prefetched token when the cart did not change since review,
+    # send SetExpressCheckout now otherwise
+    payment = _payment()
+    set_ec = _set_express_checkout( payment )
+    redirect_url = _prefetcher().checkout( set_ec, owner=_owner() )
     
-    # create new instance of paypal nvp, send request e set response
-    paypal = paypalnvp.core.PayPal( user )
-    paypal.set_response( set_ec )   
-    
-    api_response = set_ec.get_nvp_response()
-    redirect_url = paypal.get_redirect_url( set_ec )
+    # remember the cart sent, so success() needs no GetExpressCheckoutDetails
+    _sessions().record( set_ec, payment )
     redirect(redirect_url)
     
-def succes():
-    return dict()
+def shipping():
+    # Instant Update callback: use URL('paypalnvp', 'shipping', scheme='https')
+    # with SetExpressCheckout.set_callback
+    session.forget( response )
+    return _rates().respond( request.body.read() )
+
+def success():
+    # the buyer approved the payment at paypal
+    import paypalnvp.core
+    import paypalnvp.requests
+    token = request.vars.token
+    payer_id = request.vars.PayerID
+    sessions = _sessions()
+    paypal = _paypal()
+    
+    if sessions.needs_details( token ):
+        # unknown token or amounts changed at paypal: ask paypal
+        get_ec = paypalnvp.requests.GetExpressCheckoutDetails( token )
+        paypal.set_response( get_ec )
+        payer_id = get_ec.get_nvp_response().get( 'PAYERID', payer_id )
+        do_ec = paypalnvp.requests.DoExpressCheckoutPayment( 
+            _payment(), token, 'Sale', payer_id )
+    else:
+        # built from the cart recorded at SetExpressCheckout
+        do_ec = sessions.do_express_checkout_payment( token, payer_id )
+    
+    if settings.paypal_async_finalize:
+        # answer at once, the payment is completed in the background
+        _finalizer().submit( do_ec )
+        return dict( token=token, 
+            status=URL('paypalnvp', 'finalize_status', vars=dict(token=token)) )
+    
+    paypal.set_response( do_ec )
+    api_response = do_ec.get_nvp_response()
+    if api_response.get( 'ACK' ) in paypalnvp.core.SUCCESS_ACKS:
+        sessions.forget( token )
+    return dict( response=api_response )
+
+def finalize_status():
+    # polled by the processing page while the payment is being completed
+    session.forget( response )
+    import paypalnvp.finalize
+    status = _finalizer().status( request.vars.token )
+    if status is None:
+        raise HTTP( 404 )
+    if status['state'] == paypalnvp.finalize.DONE:
+        # the recorded cart is no longer needed
+        _sessions().forget( request.vars.token )
+    return response.json( dict( state=status['state'], 
+        transaction_id=(status['response'] or {}).get( 'PAYMENTINFO_0_TRANSACTIONID' ) ) )
 
 def cancel():
-    return dict()
\ No newline at end of file
+    if request.vars.token:
+        _sessions().forget( request.vars.token )
+    return dict()
+
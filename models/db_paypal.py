@@ -0,0 +1,57 @@
+####
+# PayPal IPN
+####
+import os
+from paypal_ipn import define_table
+
+# Verified IPN messages end up in db.paypal_ipn.
+define_table(db)
+
+# Local spool the listener writes to before answering PayPal.
+settings.paypal_ipn_spool = os.path.join(request.folder, 'databases', 'paypal_ipn.sqlite')
+settings.paypal_ipn_workers = 4
+
+####
+# PayPal Express Checkout
+####
+
+# SetExpressCheckout requests by token, to complete checkouts without
+# GetExpressCheckoutDetails.
+settings.paypal_checkout_sessions = os.path.join(request.folder, 'databases', 'paypal_checkout.sqlite')
+
+# Shipping rates for the Instant Update callback (controllers/paypalnvp.py,
+# shipping), as RateTable.add_rate arguments. Weights in kilograms.
+settings.paypal_shipping_currency = 'EUR'
+settings.paypal_shipping_rates = [
+    dict(country='NL', name='Standard', amount='4.95', max_weight=2),
+    dict(country='NL', name='Standard', amount='8.95', max_weight=30),
+    dict(country='NL', name='Express', amount='14.95', max_weight=30),
+]
+settings.paypal_shipping_tax = {}
+
+# Complete checkouts in background workers instead of the return url request
+# (controllers/paypalnvp.py, success); the page polls finalize_status.
+settings.paypal_async_finalize = False
+settings.paypal_finalize_queue = os.path.join(request.folder, 'databases', 'paypal_finalize.sqlite')
+settings.paypal_finalize_workers = 4
+
+####
+# PayPal metrics
+####
+import paypal_transport
+
+# Shared memory file the processes publish their call metrics to; served by
+# controllers/paypalmetrics.py.
+settings.paypal_metrics_path = os.path.join(request.folder, 'databases', 'paypal_metrics.shm')
+paypal_transport.install_metrics(settings.paypal_metrics_path)
+
+####
+# PayPal call logging
+####
+
+# Share of the calls per method logged at INFO on the paypal_transport
+# logger (1: all); failed calls are always logged, with the calls before them.
+settings.paypal_log_rates = {'GetExpressCheckoutDetails': 0.1, 'GetBalance': 0.1}
+settings.paypal_log_default_rate = 1.0
+paypal_transport.install_logging(settings.paypal_log_rates,
+                                 settings.paypal_log_default_rate)
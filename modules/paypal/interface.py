@@ -7,13 +7,22 @@ with it.
 
 import types
 import socket
+import logging
 import urllib
 import urllib2
 from urlparse import urlsplit, urlunsplit
 
+import paypal_transport
+
 from settings import PayPalConfig
 from response import PayPalResponse
 from exceptions import PayPalError, PayPalAPIResponseError
+
+_log = logging.getLogger(__name__)
+
+# urlopen, with connections that time the phases of each request.
+_opener = urllib2.build_opener(paypal_transport.TimedHTTPHandler,
+                               paypal_transport.TimedHTTPSHandler)
    
 class PayPalInterface(object):
     """
@@ -21,7 +30,7 @@ class PayPalInterface(object):
     queries, configuration, etc, all go through here. See the __init__ method
     for config related details.
     """
-    def __init__(self , config=None, **kwargs):
+    def __init__(self , config=None, pipeline=None, **kwargs):
         """
         Constructor, which passes all config directives to the config class
         via kwargs. For example:
@@ -29,8 +38,10 @@ class PayPalInterface(object):
             paypal = PayPalInterface(API_USERNAME='somevalue')
             
         Optionally, you may pass a 'config' kwarg to provide your own
-        PayPalConfig object.
+        PayPalConfig object, and a 'pipeline' kwarg to send requests through
+        a paypal_transport.Pipeline other than the process wide default.
         """
+        self.pipeline = pipeline
         if config:
             # User provided their own PayPalConfig object.
             self.config = config
@@ -94,29 +105,46 @@ class PayPalInterface(object):
         for k,v in kwargs.iteritems():
             url_values[k.upper()] = v
         
-        # When in DEBUG level 2 or greater, print out the NVP pairs.
-        if self.config.DEBUG_LEVEL >= 2:
-            k = url_values.keys()
-            k.sort()
-            for i in k:
-               print " %-20s : %s" % (i , url_values[i])
+        # When in DEBUG level 2 or greater, log the NVP pairs, credentials
+        # masked.
+        if self.config.DEBUG_LEVEL >= 2 and _log.isEnabledFor(logging.DEBUG):
+            pairs = paypal_transport.redact(url_values)
+            for k in sorted(pairs):
+                _log.debug(" %-20s : %s", k, pairs[k])
 
         u2 = self._encode_utf8(**url_values)
 
         data = urllib.urlencode(u2)
-        req = urllib2.Request(self.config.API_ENDPOINT, data, headers)
-        response = PayPalResponse(urllib2.urlopen(req).read(), self.config)
+        exchange = paypal_transport.Exchange('nvp', method,
+                                             self.config.API_ENDPOINT,
+                                             data, headers)
+        pipeline = self.pipeline or paypal_transport.default_pipeline()
+        content = paypal_transport.default_hooks().call(exchange, pipeline.send,
+                                                        self._transmit)
+        response = PayPalResponse(content, self.config)
 
         if self.config.DEBUG_LEVEL >= 1:
-            print " %-20s : %s" % ("ENDPOINT", self.config.API_ENDPOINT)
+            _log.debug(" %-20s : %s", "ENDPOINT", self.config.API_ENDPOINT)
     
         if not response.success:
             if self.config.DEBUG_LEVEL >= 1:
-                print response
+                _log.debug("%s", response)
             raise PayPalAPIResponseError(response)
 
         return response
 
+    def _transmit(self, exchange):
+        """
+        Performs the HTTP POST for ``exchange`` and returns the raw NVP body.
+        Called by the transport pipeline from within _call.
+        """
+        req = urllib2.Request(exchange.url, exchange.body, exchange.headers)
+        res = _opener.open(req)
+        exchange.status = res.getcode()
+        exchange.content = res.read()
+        exchange.timings = req.connection.timings
+        return exchange.content
+
     def address_verify(self, email, street, zip):
         """Shortcut for the AddressVerify method.
     
@@ -182,7 +210,7 @@ class PayPalInterface(object):
         The `amt` should be the same as the authorized transaction.
         """
         kwargs.update(locals())
-        del kwargs['self']
+        del kwargs['self'], kwargs['kwargs']
         return self._call('DoCapture', **kwargs)
 
     def do_direct_payment(self, paymentaction="Sale", **kwargs):
@@ -221,7 +249,7 @@ class PayPalInterface(object):
             direct_payment(paymentaction="Sale", **charge)
         """
         kwargs.update(locals())
-        del kwargs['self']
+        del kwargs['self'], kwargs['kwargs']
         return self._call('DoDirectPayment', **kwargs)
 
     def do_void(self, authorizationid, note=''):
@@ -254,7 +282,7 @@ class PayPalInterface(object):
         """Shortcut for the SetExpressCheckout method.
         """
         kwargs.update(locals())
-        del kwargs['self']
+        del kwargs['self'], kwargs['kwargs']
         return self._call('SetExpressCheckout', **kwargs)
 
     def set_express_checkout(self, token='', **kwargs):
@@ -262,7 +290,7 @@ class PayPalInterface(object):
             JV did not like the original method. found it limiting.
         """
         kwargs.update(locals())
-        del kwargs['self']
+        del kwargs['self'], kwargs['kwargs']
         self._check_required(('amt',), **kwargs)
         return self._call('SetExpressCheckout', **kwargs)
 
@@ -297,7 +325,7 @@ class PayPalInterface(object):
                 
         """
         kwargs.update(locals())
-        del kwargs['self']
+        del kwargs['self'], kwargs['kwargs']
         self._check_required(('paymentaction', 'payerid'), **kwargs)
         return self._call('DoExpressCheckoutPayment', **kwargs)
         
@@ -0,0 +1,9 @@
+# coding=utf-8
+"""
+Local stand-ins for PayPal's APIs, for load tests, benchmarks and offline
+development. They keep state in memory, emulate latency and inject faults.
+"""
+from server import EmulatorServer, Reply, Latency, Faults, \
+    ERROR, HTTP, HANG, RESET
+from nvp import NvpEmulator
+from rest import RestEmulator
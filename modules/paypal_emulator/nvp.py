@@ -0,0 +1,430 @@
+# coding=utf-8
+"""
+A stateful stand-in for PayPal's NVP API, for load tests and offline
+development. It keeps Express Checkout tokens, transactions and balances in
+memory and moves them through the states PayPal does:
+
+* SetExpressCheckout, GetExpressCheckoutDetails, DoExpressCheckoutPayment
+  (the buyer approves every checkout at once)
+* DoDirectPayment, DoAuthorization, DoCapture, DoVoid
+* GetTransactionDetails, TransactionSearch, GetBalance
+
+Answers carry PayPal's error codes for unknown tokens and transactions,
+repeated checkouts, captures of voided authorizations and invalid cards.
+
+Serve it over HTTP:
+
+    python -m paypal_emulator.nvp --port 8080 --latency lognormal:0.2:0.5
+
+or use it in process, where it is a paypalnvp Transport:
+
+    paypal = PayPal(profile, transport=paypal_emulator.NvpEmulator())
+"""
+
+import time
+import urllib
+import calendar
+import threading
+from urlparse import parse_qsl
+
+from server import Reply, Faults, EmulatorServer, HTTP, HANG, RESET, run
+from util import new_id as _id, cents, money as _money, fee as _fee, luhn, \
+    expired, timestamp as _timestamp
+
+_ERRORS = {
+    '10001': 'Internal Error',
+    '10002': 'Security error',
+    '10004': 'Transaction refused because of an invalid argument.',
+    '10404': 'ReturnURL is missing.',
+    '10405': 'CancelURL is missing.',
+    '10410': 'Invalid token.',
+    '10415': 'Transaction refused because a previous transaction with this '
+             'token has already been completed.',
+    '10508': 'Invalid expiration date.',
+    '10527': 'This transaction cannot be processed. Please enter a valid '
+             'credit card number and type.',
+    '10600': 'Authorization is voided.',
+    '10602': 'Authorization has already been completed.',
+    '10609': 'Transaction id is invalid.',
+    '10610': 'Amount specified exceeds allowable limit.',
+    '81002': 'Method Specified is not Supported',
+}
+
+_CURRENCIES = ('USD', 'EUR', 'GBP', 'CAD', 'AUD', 'JPY')
+
+
+class ApiError(Exception):
+    """An error answer; ``code`` is a key of _ERRORS."""
+    def __init__(self, code, message=None):
+        Exception.__init__(self, code)
+        self.code = code
+        self.message = message or _ERRORS[code]
+
+
+class _Transaction(object):
+    __slots__ = ('id', 'type', 'status', 'pending_reason', 'amount',
+                 'currency', 'captured', 'parent', 'payer', 'created')
+
+    def __init__(self, id, type, status, amount, currency, payer,
+                 pending_reason='None', parent=None):
+        self.id = id
+        self.type = type
+        self.status = status
+        self.pending_reason = pending_reason
+        self.amount = amount
+        self.currency = currency
+        self.captured = 0
+        self.parent = parent
+        self.payer = payer
+        self.created = time.time()
+
+
+class NvpEmulator(object):
+    """
+    The emulated NVP API. Call handle() with the request fields, serve it
+    with serve(), or hand it to paypalnvp.core.PayPal as transport.
+
+    ``latency`` (a Latency) delays answers; ``faults`` (a Faults) injects
+    errors. ``balance`` is the starting balance in each currency.
+    """
+    def __init__(self, latency=None, faults=None, balance='10000.00'):
+        self.latency = latency
+        self.faults = faults or Faults()
+        # Calls per method, for tests asserting what was sent.
+        self.calls = {}
+        self._checkouts = {}
+        self._transactions = {}
+        self._history = []
+        self._balances = dict((c, cents(balance)) for c in _CURRENCIES)
+        self._lock = threading.Lock()
+        self._handlers = {
+            'SetExpressCheckout': self.set_express_checkout,
+            'GetExpressCheckoutDetails': self.get_express_checkout_details,
+            'DoExpressCheckoutPayment': self.do_express_checkout_payment,
+            'DoDirectPayment': self.do_direct_payment,
+            'DoAuthorization': self.do_authorization,
+            'DoCapture': self.do_capture,
+            'DoVoid': self.do_void,
+            'GetTransactionDetails': self.get_transaction_details,
+            'TransactionSearch': self.transaction_search,
+            'GetBalance': self.get_balance,
+        }
+
+    # Entry points.
+
+    def handle(self, fields):
+        """Answers the NVP request ``fields`` (a dict) with a list of pairs."""
+        method = fields.get('METHOD', '')
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if not (fields.get('USER') and fields.get('PWD')) and \
+                not fields.get('SUBJECT'):
+            return self._error(fields, ApiError('10002'))
+        handler = self._handlers.get(method)
+        if handler is None:
+            return self._error(fields, ApiError('81002'))
+        try:
+            with self._lock:
+                pairs = handler(fields)
+        except ApiError as e:
+            return self._error(fields, e)
+        return self._envelope(fields, 'Success') + pairs
+
+    def __call__(self, verb, path, headers, body):
+        """The HTTP entry point, for EmulatorServer."""
+        fields = dict(parse_qsl(body, keep_blank_values=True))
+        fault = self.faults.pick(fields.get('METHOD'))
+        if fault is not None:
+            kind, params = fault
+            if kind == HTTP:
+                return Reply('Service unavailable', params.get('status', 500))
+            if kind in (HANG, RESET):
+                return Reply(fault=kind)
+            pairs = self._error(fields, ApiError(params.get('code', '10001')))
+        else:
+            pairs = self.handle(fields)
+        return Reply(_encode(pairs))
+
+    def send(self, exchange):
+        """
+        paypalnvp Transport interface: answers ``exchange`` in process,
+        sleeping for the latency if one is set.
+        """
+        reply = self('POST', exchange.url, exchange.headers, exchange.body)
+        delay = self.latency and self.latency.sample() or 0
+        if delay:
+            time.sleep(delay)
+        if reply.fault is not None:
+            raise IOError('Emulated %s' % reply.fault)
+        exchange.status = reply.status
+        exchange.content = reply.body
+        return exchange.content
+
+    def get_response(self, urlString, msg):
+        return self('POST', urlString, {}, msg).body
+
+    def serve(self, host='127.0.0.1', port=0):
+        """Starts an EmulatorServer for this emulator and returns it."""
+        return EmulatorServer(self, host, port, self.latency).start()
+
+    # Express Checkout.
+
+    def set_express_checkout(self, f):
+        if not f.get('RETURNURL'):
+            raise ApiError('10404')
+        if not f.get('CANCELURL'):
+            raise ApiError('10405')
+        amount = _amount(f, 'AMT')
+        token = 'EC-' + _id(17)
+        self._checkouts[token] = {
+            'amount': amount,
+            'currency': _first(f, 'CURRENCYCODE') or 'USD',
+            'action': _first(f, 'PAYMENTACTION') or 'Sale',
+            'payer': _id(13),
+            'status': 'PaymentActionNotInitiated',
+            'fields': f,
+            'transaction': None,
+        }
+        return [('TOKEN', token)]
+
+    def get_express_checkout_details(self, f):
+        checkout = self._checkout(f)
+        request = checkout['fields']
+        pairs = [('TOKEN', f['TOKEN']),
+                 ('CHECKOUTSTATUS', checkout['status']),
+                 ('EMAIL', request.get('EMAIL') or 'buyer@example.com'),
+                 ('PAYERID', checkout['payer']),
+                 ('PAYERSTATUS', 'verified'),
+                 ('FIRSTNAME', 'Test'), ('LASTNAME', 'Buyer'),
+                 ('COUNTRYCODE', 'US'),
+                 ('SHIPTONAME', 'Test Buyer'),
+                 ('SHIPTOSTREET', '1 Main St'), ('SHIPTOCITY', 'San Jose'),
+                 ('SHIPTOSTATE', 'CA'), ('SHIPTOZIP', '95131'),
+                 ('SHIPTOCOUNTRYCODE', 'US'),
+                 ('CURRENCYCODE', checkout['currency']),
+                 ('AMT', _money(checkout['amount'])),
+                 ('PAYMENTREQUEST_0_CURRENCYCODE', checkout['currency']),
+                 ('PAYMENTREQUEST_0_AMT', _money(checkout['amount']))]
+        if checkout['transaction']:
+            pairs.append(('PAYMENTREQUEST_0_TRANSACTIONID',
+                          checkout['transaction']))
+        for name, value in request.items():
+            if name.startswith('L_'):
+                pairs.append((name, value))
+        return pairs
+
+    def do_express_checkout_payment(self, f):
+        checkout = self._checkout(f)
+        if checkout['status'] == 'PaymentActionCompleted':
+            raise ApiError('10415')
+        if f.get('PAYERID') != checkout['payer']:
+            raise ApiError('10004', 'PayerID value is invalid.')
+        amount = _amount(f, 'AMT', required=False) or checkout['amount']
+        currency = _first(f, 'CURRENCYCODE') or checkout['currency']
+        action = _first(f, 'PAYMENTACTION') or checkout['action']
+        txn = self._record('expresscheckout', action, amount, currency,
+                           checkout['payer'])
+        checkout['status'] = 'PaymentActionCompleted'
+        checkout['transaction'] = txn.id
+        pairs = [('TOKEN', f['TOKEN'])]
+        for prefix in ('', 'PAYMENTINFO_0_'):
+            pairs += [(prefix + name, value)
+                      for name, value in self._payment_info(txn)]
+        return pairs
+
+    # Direct payments and authorizations.
+
+    def do_direct_payment(self, f):
+        amount = _amount(f, 'AMT')
+        if not luhn(f.get('ACCT', '')):
+            raise ApiError('10527')
+        expires = f.get('EXPDATE', '')
+        if len(expires) != 6 or not expires.isdigit() or \
+                expired(int(expires[2:]), int(expires[:2])):
+            raise ApiError('10508')
+        action = f.get('PAYMENTACTION') or 'Sale'
+        txn = self._record('webaccept', action, amount,
+                           f.get('CURRENCYCODE') or 'USD', _id(13))
+        return [('TRANSACTIONID', txn.id), ('AMT', _money(amount)),
+                ('CURRENCYCODE', txn.currency), ('AVSCODE', 'X'),
+                ('CVV2MATCH', 'M')]
+
+    def do_authorization(self, f):
+        order = self._transaction(f, 'TRANSACTIONID')
+        if order.pending_reason != 'order':
+            raise ApiError('10609')
+        amount = _amount(f, 'AMT')
+        if amount > order.amount:
+            raise ApiError('10610')
+        txn = self._new(_Transaction(_id(17), 'expresscheckout', 'Pending',
+                                     amount, order.currency, order.payer,
+                                     'authorization', order.id))
+        return [('TRANSACTIONID', txn.id), ('AMT', _money(amount)),
+                ('PAYMENTSTATUS', 'Pending'), ('PENDINGREASON', 'authorization')]
+
+    def do_capture(self, f):
+        auth = self._transaction(f, 'AUTHORIZATIONID')
+        self._check_open(auth)
+        amount = _amount(f, 'AMT')
+        # PayPal allows capturing up to 115% of the authorization.
+        if auth.captured + amount > auth.amount * 115 // 100:
+            raise ApiError('10610')
+        auth.captured += amount
+        if f.get('COMPLETETYPE', 'Complete') == 'Complete':
+            auth.status, auth.pending_reason = 'Completed', 'None'
+        capture = self._new(_Transaction(_id(17), auth.type, 'Completed',
+                                         amount, auth.currency, auth.payer,
+                                         parent=auth.id))
+        self._credit(capture)
+        return [('AUTHORIZATIONID', auth.id)] + self._payment_info(capture)
+
+    def do_void(self, f):
+        auth = self._transaction(f, 'AUTHORIZATIONID')
+        self._check_open(auth)
+        auth.status, auth.pending_reason = 'Voided', 'None'
+        return [('AUTHORIZATIONID', auth.id)]
+
+    # Lookups.
+
+    def get_transaction_details(self, f):
+        txn = self._transaction(f, 'TRANSACTIONID')
+        return [('TRANSACTIONID', txn.id),
+                ('PARENTTRANSACTIONID', txn.parent or ''),
+                ('TRANSACTIONTYPE', txn.type),
+                ('PAYMENTTYPE', 'instant'),
+                ('ORDERTIME', _timestamp(txn.created)),
+                ('AMT', _money(txn.amount)),
+                ('FEEAMT', _money(_fee(txn.amount))),
+                ('CURRENCYCODE', txn.currency),
+                ('PAYMENTSTATUS', txn.status),
+                ('PENDINGREASON', txn.pending_reason),
+                ('REASONCODE', 'None'),
+                ('PAYERID', txn.payer),
+                ('PAYERSTATUS', 'verified'),
+                ('FIRSTNAME', 'Test'), ('LASTNAME', 'Buyer')]
+
+    def transaction_search(self, f):
+        # The 100 newest transactions since STARTDATE, like PayPal's page.
+        try:
+            since = calendar.timegm(time.strptime(f.get('STARTDATE', ''),
+                                                  '%Y-%m-%dT%H:%M:%SZ'))
+        except ValueError:
+            raise ApiError('10004', 'Start date is missing or invalid.')
+        pairs = []
+        for i, txn in enumerate(self._history[:-101:-1]):
+            if txn.created < since:
+                break
+            net = txn.amount - _fee(txn.amount)
+            pairs += [('L_TIMESTAMP%d' % i, _timestamp(txn.created)),
+                      ('L_TIMEZONE%d' % i, 'GMT'),
+                      ('L_TYPE%d' % i, 'Payment'),
+                      ('L_EMAIL%d' % i, 'buyer@example.com'),
+                      ('L_NAME%d' % i, 'Test Buyer'),
+                      ('L_TRANSACTIONID%d' % i, txn.id),
+                      ('L_STATUS%d' % i, txn.status),
+                      ('L_AMT%d' % i, _money(txn.amount)),
+                      ('L_CURRENCYCODE%d' % i, txn.currency),
+                      ('L_FEEAMT%d' % i, '-' + _money(_fee(txn.amount))),
+                      ('L_NETAMT%d' % i, _money(net))]
+        return pairs
+
+    def get_balance(self, f):
+        currencies = f.get('RETURNALLCURRENCIES') == '1' and _CURRENCIES or \
+            ('USD',)
+        pairs = []
+        for i, currency in enumerate(currencies):
+            pairs += [('L_AMT%d' % i, _money(self._balances[currency])),
+                      ('L_CURRENCYCODE%d' % i, currency)]
+        return pairs
+
+    # State.
+
+    def _checkout(self, f):
+        checkout = self._checkouts.get(f.get('TOKEN'))
+        if checkout is None:
+            raise ApiError('10410')
+        return checkout
+
+    def _transaction(self, f, name):
+        txn = self._transactions.get(f.get(name))
+        if txn is None:
+            raise ApiError('10609')
+        return txn
+
+    def _check_open(self, auth):
+        if auth.pending_reason != 'authorization':
+            if auth.status == 'Voided':
+                raise ApiError('10600')
+            raise ApiError('10602')
+
+    def _record(self, type, action, amount, currency, payer):
+        # Sale completes at once; Authorization and Order stay pending.
+        if action == 'Sale':
+            txn = self._new(_Transaction(_id(17), type, 'Completed', amount,
+                                         currency, payer))
+            self._credit(txn)
+            return txn
+        reason = action == 'Order' and 'order' or 'authorization'
+        return self._new(_Transaction(_id(17), type, 'Pending', amount,
+                                      currency, payer, reason))
+
+    def _new(self, txn):
+        self._transactions[txn.id] = txn
+        self._history.append(txn)
+        return txn
+
+    def _credit(self, txn):
+        if txn.currency in self._balances:
+            self._balances[txn.currency] += txn.amount - _fee(txn.amount)
+
+    def _payment_info(self, txn):
+        return [('TRANSACTIONID', txn.id),
+                ('TRANSACTIONTYPE', txn.type),
+                ('PAYMENTTYPE', 'instant'),
+                ('ORDERTIME', _timestamp(txn.created)),
+                ('AMT', _money(txn.amount)),
+                ('FEEAMT', _money(_fee(txn.amount))),
+                ('CURRENCYCODE', txn.currency),
+                ('PAYMENTSTATUS', txn.status),
+                ('PENDINGREASON', txn.pending_reason),
+                ('REASONCODE', 'None')]
+
+    def _envelope(self, f, ack):
+        return [('TIMESTAMP', _timestamp(time.time())),
+                ('CORRELATIONID', _id(13).lower()),
+                ('ACK', ack),
+                ('VERSION', f.get('VERSION', '')),
+                ('BUILD', '1000000')]
+
+    def _error(self, f, error):
+        return self._envelope(f, 'Failure') + [
+            ('L_ERRORCODE0', error.code),
+            ('L_SHORTMESSAGE0', error.message.split('.')[0]),
+            ('L_LONGMESSAGE0', error.message),
+            ('L_SEVERITYCODE0', 'Error')]
+
+
+def _first(f, name):
+    return f.get(name) or f.get('PAYMENTREQUEST_0_' + name)
+
+def _amount(f, name, required=True):
+    value = _first(f, name)
+    if not value:
+        if required:
+            raise ApiError('10004', 'Order total is missing.')
+        return None
+    try:
+        return cents(value)
+    except ValueError:
+        raise ApiError('10004', 'Order total is invalid.')
+
+def _encode(pairs):
+    quote = urllib.quote_plus
+    return '&'.join('%s=%s' % (name, quote(value)) for name, value in pairs)
+
+
+def main(argv=None):
+    run(NvpEmulator, 'NVP emulator', '/nvp', 8080, argv)
+
+if __name__ == '__main__':
+    main()
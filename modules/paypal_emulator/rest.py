@@ -0,0 +1,437 @@
+# coding=utf-8
+"""
+A stateful stand-in for the PayPal REST API paypalrestsdk talks to:
+
+* POST /v1/oauth2/token, handing out tokens that expire after
+  ``token_lifetime`` seconds, so clients refresh them
+* /v1/payments/payment: create, list, find and execute
+* /v1/payments/sale/{id} and its refund, /v1/payments/refund/{id}
+* /v1/vault/credit-card: store and find
+
+POSTs with a PayPal-Request-Id header are idempotent: a repeat gets the
+first answer back and changes nothing. Errors have the status codes and JSON
+bodies PayPal sends, so paypalrestsdk raises the matching exceptions.
+
+``calls`` counts the calls per method ('POST v1/payments/payment',
+'GET v1/payments/payment/{id}', ...), ``replayed`` the idempotent repeats;
+GET /v1/emulator/counters returns both as JSON.
+
+    python -m paypal_emulator.rest --port 8081 --fault 0.01:http::503
+"""
+
+import re
+import json
+import time
+import base64
+import threading
+from urlparse import urlsplit, parse_qsl
+
+from server import Reply, Faults, EmulatorServer, HANG, RESET, run
+from util import new_id, cents, money, fee, luhn, expired, timestamp
+
+_ERRORS = {
+    400: ('VALIDATION_ERROR', 'Invalid request - see details'),
+    401: ('invalid_token', 'Token signature verification failed'),
+    403: ('PERMISSION_DENIED', 'No permission for the requested operation'),
+    404: ('INVALID_RESOURCE_ID', 'The requested resource ID was not found'),
+    405: ('METHOD_NOT_SUPPORTED', 'The server does not implement the '
+                                  'requested HTTP method'),
+    409: ('DUPLICATE_REQUEST_ID', 'The value of PayPal-Request-Id header has '
+                                  'already been used'),
+    410: ('GONE', 'The requested resource is no longer available'),
+    422: ('UNPROCESSABLE_ENTITY', 'The requested action could not be '
+                                  'performed'),
+    429: ('RATE_LIMIT_REACHED', 'Too many requests. Blocked due to '
+                                'throttling'),
+    500: ('INTERNAL_SERVICE_ERROR', 'An internal service error has occurred'),
+    503: ('SERVICE_UNAVAILABLE', 'Service is unavailable'),
+}
+
+
+class ApiError(Exception):
+    """An error answer with ``status`` and PayPal's error ``name``."""
+    def __init__(self, status, name=None, message=None, details=None):
+        Exception.__init__(self, status)
+        default_name, default_message = _ERRORS.get(status, _ERRORS[500])
+        self.status = status
+        self.name = name or default_name
+        self.message = message or default_message
+        self.details = details
+
+    def body(self):
+        if self.name.islower():
+            # OAuth errors: invalid_token, invalid_client, ...
+            return {'error': self.name, 'error_description': self.message}
+        body = {'name': self.name, 'message': self.message,
+                'debug_id': new_id(13).lower(),
+                'information_link': 'https://developer.paypal.com/webapps/'
+                    'developer/docs/api/#%s' % self.name}
+        if self.details:
+            body['details'] = [{'field': f, 'issue': i} for f, i in self.details]
+        return body
+
+
+_ROUTES = (
+    ('POST', 'v1/oauth2/token', 'token'),
+    ('POST', 'v1/payments/payment', 'create_payment'),
+    ('GET', 'v1/payments/payment', 'list_payments'),
+    ('GET', 'v1/payments/payment/{id}', 'find_payment'),
+    ('POST', 'v1/payments/payment/{id}/execute', 'execute_payment'),
+    ('GET', 'v1/payments/sale/{id}', 'find_sale'),
+    ('POST', 'v1/payments/sale/{id}/refund', 'refund_sale'),
+    ('GET', 'v1/payments/refund/{id}', 'find_refund'),
+    ('POST', 'v1/vault/credit-card', 'store_credit_card'),
+    ('GET', 'v1/vault/credit-card/{id}', 'find_credit_card'),
+    ('GET', 'v1/emulator/counters', 'counters'),
+)
+
+
+class RestEmulator(object):
+    """
+    The emulated REST API; serve it with serve(). ``latency`` (a Latency)
+    delays answers, ``faults`` (a Faults) injects errors: ERROR and HTTP
+    faults answer with their ``status`` (500 by default) and PayPal's JSON
+    error body.
+    """
+    def __init__(self, latency=None, faults=None, token_lifetime=60,
+                 credentials=None):
+        self.latency = latency
+        self.faults = faults or Faults()
+        self.token_lifetime = token_lifetime
+        # client_id: client_secret pairs accepted; any when None.
+        self.credentials = credentials
+        self.calls = {}
+        self.replayed = 0
+        self._tokens = {}
+        self._payments = {}
+        self._order = []
+        self._sales = {}
+        self._refunds = {}
+        self._cards = {}
+        self._idempotent = {}
+        self._lock = threading.Lock()
+        self._routes = [(verb, template, _pattern(template),
+                         getattr(self, handler))
+                        for verb, template, handler in _ROUTES]
+
+    def serve(self, host='127.0.0.1', port=0):
+        """Starts an EmulatorServer for this emulator and returns it."""
+        return EmulatorServer(self, host, port, self.latency).start()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = {}
+            self.replayed = 0
+
+    def __call__(self, verb, path, headers, body):
+        parts = urlsplit(path)
+        resource = parts.path.strip('/')
+        for route_verb, template, pattern, handler in self._routes:
+            match = pattern.match(resource)
+            if match is not None and route_verb == verb:
+                break
+        else:
+            return _reply(ApiError(404))
+        if handler == self.counters:
+            with self._lock:
+                return Reply(json.dumps(self.counters()), 200,
+                             'application/json')
+        method = '%s %s' % (verb, template)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        fault = self.faults.pick(method)
+        if fault is not None:
+            kind, params = fault
+            if kind in (HANG, RESET):
+                return Reply(fault=kind)
+            return _reply(ApiError(params.get('status', 500)))
+
+        base = 'http://%s' % headers.get('host', 'localhost')
+        request_id = verb == 'POST' and headers.get('paypal-request-id')
+        with self._lock:
+            if request_id and request_id in self._idempotent:
+                self.replayed += 1
+                return self._idempotent[request_id]
+            try:
+                if handler == self.token:
+                    self._authenticate(headers)
+                else:
+                    self._authorize(headers)
+                data = body
+                if verb == 'POST' and handler != self.token:
+                    data = _json(body)
+                status, result = handler(data, base, dict(
+                    parse_qsl(parts.query)), *match.groups())
+                reply = Reply(json.dumps(result), status,
+                              'application/json')
+            except ApiError as e:
+                reply = _reply(e)
+            if request_id and reply.status < 500:
+                self._idempotent[request_id] = reply
+        return reply
+
+    # OAuth.
+
+    def _authenticate(self, headers):
+        scheme, _, credentials = headers.get('authorization', '').partition(' ')
+        try:
+            client_id, _, secret = base64.b64decode(credentials).partition(':')
+        except TypeError:
+            client_id = secret = None
+        if scheme != 'Basic' or not client_id or (
+                self.credentials is not None and
+                self.credentials.get(client_id) != secret):
+            raise ApiError(401, 'invalid_client', 'Client Authentication failed')
+
+    def _authorize(self, headers):
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        expires = self._tokens.get(token)
+        if scheme != 'Bearer' or expires is None or expires < time.time():
+            raise ApiError(401)
+
+    def token(self, body, base, query):
+        if dict(parse_qsl(body or '')).get('grant_type') != \
+                'client_credentials':
+            raise ApiError(400, 'unsupported_grant_type',
+                           'Grant Type is NULL or not supported')
+        token = 'A015' + new_id(60)
+        self._tokens[token] = time.time() + self.token_lifetime
+        return 200, {'scope': 'https://api.paypal.com/v1/payments/.* '
+                             'https://api.paypal.com/v1/vault/credit-card',
+                     'access_token': token, 'token_type': 'Bearer',
+                     'app_id': 'APP-80W284485P519543T',
+                     'expires_in': self.token_lifetime}
+
+    # Payments.
+
+    def create_payment(self, data, base, query):
+        intent = data.get('intent')
+        payer = data.get('payer') or {}
+        method = payer.get('payment_method')
+        transactions = data.get('transactions') or []
+        details = []
+        if intent not in ('sale', 'authorize', 'order'):
+            details.append(('intent', 'Must be sale, authorize or order'))
+        if method not in ('paypal', 'credit_card'):
+            details.append(('payer.payment_method',
+                            'Must be paypal or credit_card'))
+        if method == 'paypal' and not data.get('redirect_urls'):
+            details.append(('redirect_urls', 'Required for PayPal payments'))
+        if not transactions:
+            details.append(('transactions', 'Required field missing'))
+        for i, transaction in enumerate(transactions):
+            amount = transaction.get('amount') or {}
+            try:
+                if cents(amount.get('total')) <= 0:
+                    raise ValueError()
+            except (TypeError, ValueError):
+                details.append(('transactions[%d].amount.total' % i,
+                                'Must be a positive amount'))
+            if not amount.get('currency'):
+                details.append(('transactions[%d].amount.currency' % i,
+                                'Required field missing'))
+        if method == 'credit_card':
+            for i, instrument in enumerate(payer.get('funding_instruments') or [{}]):
+                card = instrument.get('credit_card')
+                if card is not None:
+                    details += self._card_errors(
+                        card, 'payer.funding_instruments[%d].credit_card' % i)
+                elif instrument.get('credit_card_token', {}).get(
+                        'credit_card_id') not in self._cards:
+                    details.append(('payer.funding_instruments[%d]' % i,
+                                    'Unknown or missing credit card'))
+        if details:
+            raise ApiError(400, details=details)
+
+        now = timestamp()
+        payment = {
+            'id': 'PAY-' + new_id(24),
+            'create_time': now, 'update_time': now,
+            'intent': intent, 'payer': payer,
+            'transactions': transactions,
+        }
+        self._payments[payment['id']] = payment
+        self._order.append(payment['id'])
+        if method == 'credit_card':
+            self._approve(payment, base)
+        else:
+            token = 'EC-' + new_id(17)
+            payment['state'] = 'created'
+            payment['redirect_urls'] = data['redirect_urls']
+            payment['links'] = _links(base, 'v1/payments/payment/' + payment['id'],
+                execute=('POST', '/execute'))
+            payment['links'].append({
+                'href': 'https://www.sandbox.paypal.com/cgi-bin/webscr'
+                        '?cmd=_express-checkout&token=' + token,
+                'rel': 'approval_url', 'method': 'REDIRECT'})
+        return 201, payment
+
+    def list_payments(self, data, base, query):
+        count = min(int(query.get('count', 10)), 20)
+        ids = self._order[::-1]
+        if query.get('start_id') in self._payments:
+            ids = ids[ids.index(query['start_id']):]
+        else:
+            ids = ids[int(query.get('start_index', 0)):]
+        page = [self._payments[i] for i in ids[:count]]
+        result = {'payments': page, 'count': len(page)}
+        if len(ids) > count:
+            result['next_id'] = ids[count]
+        return 200, result
+
+    def find_payment(self, data, base, query, id):
+        return 200, self._find(self._payments, id)
+
+    def execute_payment(self, data, base, query, id):
+        payment = self._find(self._payments, id)
+        if not data.get('payer_id'):
+            raise ApiError(400, details=[('payer_id', 'Required field missing')])
+        if payment['state'] != 'created':
+            raise ApiError(400, 'PAYMENT_STATE_INVALID',
+                           'This request is invalid due to the current state '
+                           'of the payment')
+        payment['payer']['payer_info'] = {'payer_id': data['payer_id'],
+                                          'email': 'buyer@example.com'}
+        if data.get('transactions'):
+            payment['transactions'] = data['transactions']
+        self._approve(payment, base)
+        return 200, payment
+
+    def _approve(self, payment, base):
+        payment['state'] = 'approved'
+        payment['update_time'] = timestamp()
+        payment['links'] = _links(base, 'v1/payments/payment/' + payment['id'])
+        for transaction in payment['transactions']:
+            amount = transaction['amount']
+            if payment['intent'] != 'sale':
+                resource = {'id': new_id(17), 'state': 'authorized',
+                            'amount': amount, 'parent_payment': payment['id'],
+                            'create_time': timestamp(),
+                            'update_time': timestamp()}
+                transaction['related_resources'] = [
+                    {payment['intent'] == 'order' and 'order' or
+                     'authorization': resource}]
+                continue
+            sale = {'id': new_id(17), 'state': 'completed', 'amount': amount,
+                    'parent_payment': payment['id'],
+                    'transaction_fee': {'value': money(fee(cents(amount['total']))),
+                                        'currency': amount['currency']},
+                    'create_time': timestamp(), 'update_time': timestamp()}
+            sale['links'] = _links(base, 'v1/payments/sale/' + sale['id'],
+                                   refund=('POST', '/refund'))
+            self._sales[sale['id']] = sale
+            transaction['related_resources'] = [{'sale': sale}]
+
+    # Sales and refunds.
+
+    def find_sale(self, data, base, query, id):
+        return 200, self._find(self._sales, id)
+
+    def refund_sale(self, data, base, query, id):
+        sale = self._find(self._sales, id)
+        if sale['state'] not in ('completed', 'partially_refunded'):
+            raise ApiError(400, 'TRANSACTION_REFUSED',
+                           'The request was refused')
+        total = cents(sale['amount']['total'])
+        refunded = sum(cents(self._refunds[r]['amount']['total'])
+                       for r in sale.get('refunds', ()))
+        amount = data.get('amount') or {'total': money(total - refunded),
+                                        'currency': sale['amount']['currency']}
+        try:
+            requested = cents(amount.get('total'))
+        except (TypeError, ValueError):
+            raise ApiError(400, details=[('amount.total', 'Must be an amount')])
+        if requested <= 0 or refunded + requested > total:
+            raise ApiError(400, 'REFUND_EXCEEDED_TRANSACTION_AMOUNT',
+                           'Refund amount exceeded transaction amount')
+        refund = {'id': new_id(17), 'state': 'completed', 'amount': amount,
+                  'sale_id': sale['id'],
+                  'parent_payment': sale['parent_payment'],
+                  'create_time': timestamp(), 'update_time': timestamp()}
+        refund['links'] = _links(base, 'v1/payments/refund/' + refund['id'])
+        self._refunds[refund['id']] = refund
+        sale.setdefault('refunds', []).append(refund['id'])
+        sale['state'] = refunded + requested == total and 'refunded' or \
+            'partially_refunded'
+        return 201, refund
+
+    def find_refund(self, data, base, query, id):
+        return 200, self._find(self._refunds, id)
+
+    # Vault.
+
+    def store_credit_card(self, data, base, query):
+        details = self._card_errors(data, '')
+        if details:
+            raise ApiError(400, details=details)
+        card = dict(data)
+        card['number'] = 'x' * (len(data['number']) - 4) + data['number'][-4:]
+        card.pop('cvv2', None)
+        card.update({'id': 'CARD-' + new_id(24), 'state': 'ok',
+                     'valid_until': '%04d-%02d-01T00:00:00Z' % (
+                         int(data['expire_year']), int(data['expire_month'])),
+                     'create_time': timestamp(), 'update_time': timestamp()})
+        card['links'] = _links(base, 'v1/vault/credit-card/' + card['id'])
+        self._cards[card['id']] = card
+        return 201, card
+
+    def find_credit_card(self, data, base, query, id):
+        return 200, self._find(self._cards, id)
+
+    def _card_errors(self, card, prefix):
+        prefix = prefix and prefix + '.'
+        details = []
+        if not luhn(str(card.get('number', ''))):
+            details.append((prefix + 'number', 'Value is invalid'))
+        if card.get('type') not in ('visa', 'mastercard', 'discover', 'amex'):
+            details.append((prefix + 'type', 'Value is invalid'))
+        try:
+            if expired(int(card['expire_year']), int(card['expire_month'])):
+                details.append((prefix + 'expire_year', 'Card has expired'))
+        except (KeyError, TypeError, ValueError):
+            details.append((prefix + 'expire_month', 'Required field missing'))
+        return details
+
+    # Counters.
+
+    def counters(self, *args):
+        return {'calls': self.calls, 'replayed': self.replayed}
+
+    def _find(self, resources, id):
+        resource = resources.get(id)
+        if resource is None:
+            raise ApiError(404)
+        return resource
+
+
+def _json(body):
+    try:
+        data = json.loads(body or '{}')
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise ApiError(400, 'MALFORMED_REQUEST',
+                       'Incoming JSON request does not map to API request')
+    return data
+
+def _pattern(template):
+    return re.compile('^%s$' % re.escape(template).replace(
+        re.escape('{id}'), '([^/]+)'))
+
+def _links(base, path, **more):
+    links = [{'href': '%s/%s' % (base, path), 'rel': 'self', 'method': 'GET'}]
+    for rel, (method, suffix) in sorted(more.items()):
+        links.append({'href': '%s/%s%s' % (base, path, suffix), 'rel': rel,
+                      'method': method})
+    return links
+
+def _reply(error):
+    return Reply(json.dumps(error.body()), error.status, 'application/json')
+
+
+def main(argv=None):
+    run(RestEmulator, 'REST emulator', '', 8081, argv)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+# coding=utf-8
+"""
+A small HTTP/1.1 server for the emulators: one thread, non-blocking sockets
+and keep-alive connections, with responses held back on a timer heap to
+emulate PayPal's latency without a thread per request.
+"""
+
+import sys
+import math
+import time
+import heapq
+import errno
+import random
+import select
+import socket
+import threading
+
+class Latency(object):
+    """
+    Response delay distribution; sample() returns seconds. Build one with
+    constant(), uniform() or lognormal().
+    """
+    def __init__(self, sample):
+        self.sample = sample
+
+    def constant(cls, seconds):
+        return cls(lambda: seconds)
+    constant = classmethod(constant)
+
+    def uniform(cls, low, high):
+        return cls(lambda: random.uniform(low, high))
+    uniform = classmethod(uniform)
+
+    def lognormal(cls, median, sigma=0.5, maximum=None):
+        """
+        Long tailed, like real API latency: half the delays are below
+        ``median``; ``sigma`` widens the tail, capped at ``maximum``.
+        """
+        mu = math.log(median)
+        if maximum is None:
+            return cls(lambda: random.lognormvariate(mu, sigma))
+        return cls(lambda: min(random.lognormvariate(mu, sigma), maximum))
+    lognormal = classmethod(lognormal)
+
+    def parse(cls, text):
+        """
+        From 'constant:0.1', 'uniform:0.05:0.3' or 'lognormal:0.2:0.5[:5]',
+        for command lines.
+        """
+        kind, _, params = text.partition(':')
+        return getattr(cls, kind)(*[float(p) for p in params.split(':') if p])
+    parse = classmethod(parse)
+
+
+# Faults the emulators can inject.
+ERROR = 'error'  # an API level error answer
+HTTP = 'http'    # an HTTP error status, ``status`` (500 by default)
+HANG = 'hang'    # no answer at all; the client has to time out
+RESET = 'reset'  # the connection is closed without an answer
+
+class Faults(object):
+    """
+    Error injection rules: each rule applies a fault to a share ``rate`` of
+    the calls of ``methods`` (all when None). The first rule that fires
+    wins.
+    """
+    def __init__(self):
+        self.rules = []
+
+    def add(self, rate, kind=ERROR, methods=None, **params):
+        """
+        Adds a rule and returns self. ``params`` go with the fault, for
+        example status=503 for HTTP or code='10001' for ERROR.
+        """
+        self.rules.append((rate, kind, methods and frozenset(methods), params))
+        return self
+
+    def pick(self, method):
+        """The (kind, params) of the fault for one call of ``method``, or None."""
+        for rate, kind, methods, params in self.rules:
+            if methods is not None and method not in methods:
+                continue
+            if random.random() < rate:
+                return kind, params
+        return None
+
+    def parse(cls, specs):
+        """
+        From 'rate:kind[:method,method][:status or code]' strings, for
+        command lines: '0.01:error', '0.005:http:DoCapture:503'.
+        """
+        faults = cls()
+        for spec in specs:
+            parts = spec.split(':')
+            methods = len(parts) > 2 and parts[2] and parts[2].split(',') or None
+            params = {}
+            if len(parts) > 3:
+                params[parts[1] == HTTP and 'status' or 'code'] = \
+                    parts[1] == HTTP and int(parts[3]) or parts[3]
+            faults.add(float(parts[0]), parts[1], methods, **params)
+        return faults
+    parse = classmethod(parse)
+
+
+class Reply(object):
+    """What an emulator answers to one request."""
+    def __init__(self, body='', status=200, content_type='text/plain',
+                 headers=None, delay=None, fault=None):
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+        self.headers = headers or []
+        # Seconds to hold the answer back; None for the server's latency.
+        self.delay = delay
+        # HANG or RESET, to not answer at all.
+        self.fault = fault
+
+
+_REASONS = {200: 'OK', 201: 'Created', 204: 'No Content', 400: 'Bad Request',
+            401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found',
+            405: 'Method Not Allowed', 409: 'Conflict', 410: 'Gone',
+            422: 'Unprocessable Entity', 429: 'Too Many Requests',
+            500: 'Internal Server Error', 502: 'Bad Gateway',
+            503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class _Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbox = ''
+        self.outbox = ''
+        # True while a request is being answered; the next one waits.
+        self.busy = False
+        self.close_after = False
+
+
+class EmulatorServer(object):
+    """
+    Serves ``app`` on ``host``:``port`` (0 picks a free port). ``app`` is
+    called with (verb, path, headers, body), headers a dict with lower
+    case names, and returns a Reply. Answers are delayed by
+    ``latency.sample()`` seconds unless the Reply sets its own delay.
+    """
+    def __init__(self, app, host='127.0.0.1', port=0, latency=None,
+                 backlog=1024):
+        self.app = app
+        self.latency = latency
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(backlog)
+        self._listener.setblocking(False)
+        self.host, self.port = self._listener.getsockname()
+        self.requests = 0
+        self._connections = {}
+        self._timers = []
+        self._sequence = 0
+        self._running = False
+        self._thread = None
+        self._poll = select.epoll() if hasattr(select, 'epoll') else None
+
+    def url(self, path=''):
+        return 'http://%s:%d%s' % (self.host, self.port, path)
+
+    def start(self):
+        """Serves from a background thread; returns self."""
+        self._running = True
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='paypal-emulator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve_forever(self):
+        if self._thread is None:
+            # Called directly, not by start(): a stop() right after start()
+            # must not be undone here.
+            self._running = True
+        self._register(self._listener.fileno(), read=True)
+        try:
+            while self._running:
+                timeout = 0.1
+                if self._timers:
+                    timeout = max(0, min(timeout, self._timers[0][0] - time.time()))
+                for fd, readable, writable in self._wait(timeout):
+                    if fd == self._listener.fileno():
+                        self._accept()
+                        continue
+                    conn = self._connections.get(fd)
+                    if conn is None:
+                        continue
+                    if readable:
+                        self._read(conn)
+                    if writable and fd in self._connections:
+                        self._write(conn)
+                self._fire_timers()
+        finally:
+            for conn in list(self._connections.values()):
+                self._close(conn)
+            self._unregister(self._listener.fileno())
+            self._listener.close()
+
+    # Polling, with epoll where there is one.
+
+    def _register(self, fd, read=True, write=False):
+        if self._poll is not None:
+            mask = (read and select.EPOLLIN or 0) | (write and select.EPOLLOUT or 0)
+            try:
+                self._poll.modify(fd, mask)
+            except IOError:
+                self._poll.register(fd, mask)
+
+    def _unregister(self, fd):
+        if self._poll is not None:
+            try:
+                self._poll.unregister(fd)
+            except (IOError, ValueError):
+                pass
+
+    def _wait(self, timeout):
+        if self._poll is not None:
+            try:
+                events = self._poll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+            return [(fd, bool(mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR)),
+                     bool(mask & select.EPOLLOUT)) for fd, mask in events]
+        readers = [self._listener.fileno()] + list(self._connections)
+        writers = [fd for fd, c in self._connections.items() if c.outbox]
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        writable = set(writable)
+        return [(fd, fd in readable, fd in writable)
+                for fd in set(readable) | writable]
+
+    # Connections.
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock)
+            self._connections[conn.fd] = conn
+            self._register(conn.fd, read=True)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self._close(conn)
+            return
+        conn.inbox += data
+        self._next_request(conn)
+
+    def _next_request(self, conn):
+        if conn.busy:
+            return
+        end = conn.inbox.find('\r\n\r\n')
+        if end < 0:
+            return
+        lines = conn.inbox[:end].split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if len(conn.inbox) < end + 4 + length:
+            return
+        body = conn.inbox[end + 4:end + 4 + length]
+        conn.inbox = conn.inbox[end + 4 + length:]
+        try:
+            verb, path, version = lines[0].split(' ', 2)
+        except ValueError:
+            self._close(conn)
+            return
+        connection = headers.get('connection', '').lower()
+        conn.close_after = connection == 'close' or (
+            version == 'HTTP/1.0' and connection != 'keep-alive')
+        conn.busy = True
+        self.requests += 1
+        try:
+            reply = self.app(verb, path, headers, body)
+        except Exception as e:
+            reply = Reply('%s: %s' % (type(e).__name__, e), 500)
+        if reply.fault == HANG:
+            return
+        delay = reply.delay
+        if delay is None:
+            delay = self.latency and self.latency.sample() or 0
+        if reply.fault == RESET:
+            data = None
+        else:
+            data = self._render(reply, conn.close_after)
+        if delay <= 0:
+            self._answer(conn, data)
+        else:
+            self._sequence += 1
+            heapq.heappush(self._timers,
+                           (time.time() + delay, self._sequence, conn, data))
+
+    def _render(self, reply, close):
+        head = ['HTTP/1.1 %d %s' % (reply.status, _REASONS.get(reply.status, 'Unknown')),
+                'Content-Type: %s' % reply.content_type,
+                'Content-Length: %d' % len(reply.body)]
+        for name, value in reply.headers:
+            head.append('%s: %s' % (name, value))
+        if close:
+            head.append('Connection: close')
+        return '\r\n'.join(head) + '\r\n\r\n' + reply.body
+
+    def _answer(self, conn, data):
+        if self._connections.get(conn.fd) is not conn:
+            return
+        if data is None:
+            self._close(conn)
+            return
+        conn.outbox += data
+        self._write(conn)
+
+    def _write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbox)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                self._close(conn)
+                return
+        conn.outbox = conn.outbox[sent:]
+        if conn.outbox:
+            self._register(conn.fd, read=True, write=True)
+            return
+        self._register(conn.fd, read=True)
+        if conn.close_after:
+            self._close(conn)
+            return
+        conn.busy = False
+        if conn.inbox:
+            self._next_request(conn)
+
+    def _fire_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, conn, data = heapq.heappop(self._timers)
+            self._answer(conn, data)
+
+    def _close(self, conn):
+        if self._connections.get(conn.fd) is not conn:
+            return
+        del self._connections[conn.fd]
+        self._unregister(conn.fd)
+        conn.sock.close()
+
+
+def run(emulator, name, path, port, argv=None):
+    """
+    Command line entry point: serves an ``emulator`` (the class) built with
+    the --latency and --fault options until interrupted.
+    """
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=port)
+    parser.add_option('--latency', metavar='SPEC',
+                      help="'constant:0.1', 'uniform:0.05:0.3' or "
+                           "'lognormal:0.2:0.5[:max]'")
+    parser.add_option('--fault', action='append', default=[], metavar='SPEC',
+                      help="'rate:kind[:methods][:code or status]', kind one "
+                           "of error, http, hang, reset; repeatable")
+    options, _ = parser.parse_args(argv)
+    latency = options.latency and Latency.parse(options.latency) or None
+    app = emulator(latency=latency, faults=Faults.parse(options.fault))
+    server = EmulatorServer(app, options.host, options.port, latency)
+    print '%s on %s' % (name, server.url(path))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
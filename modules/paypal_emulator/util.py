@@ -0,0 +1,52 @@
+# coding=utf-8
+"""Helpers shared by the emulators: ids, money amounts, cards and times."""
+
+import os
+import time
+import binascii
+import datetime
+
+def new_id(length):
+    """A random upper case hexadecimal id of ``length`` characters."""
+    return binascii.hexlify(os.urandom((length + 1) // 2))[:length].upper()
+
+def cents(value):
+    """An amount string such as '10.00' in cents; ValueError if invalid."""
+    return int(round(float(value) * 100))
+
+def money(cents):
+    return '%d.%02d' % divmod(cents, 100)
+
+def fee(cents):
+    """PayPal's fee on ``cents``: 2.9% plus 0.30."""
+    return int(round(cents * 0.029)) + 30
+
+def luhn(number):
+    """True if ``number`` is a plausible card number."""
+    if not number.isdigit() or not 12 <= len(number) <= 19:
+        return False
+    total = 0
+    for i, digit in enumerate(reversed(number)):
+        n = int(digit)
+        if i % 2:
+            n *= 2
+            if n > 9:
+                n -= 9
+        total += n
+    return total % 10 == 0
+
+def expired(year, month):
+    today = datetime.date.today()
+    return (year, month) < (today.year, today.month)
+
+_stamp = [None, None]
+
+def timestamp(seconds=None):
+    """``seconds`` (now by default) in ISO 8601, UTC."""
+    # Formatted once per second; most answers carry the current time.
+    second = int(time.time() if seconds is None else seconds)
+    if _stamp[0] == second:
+        return _stamp[1]
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(second))
+    _stamp[:] = [second, stamp]
+    return stamp
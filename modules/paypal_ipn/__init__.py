@@ -0,0 +1,36 @@
+# coding=utf-8
+"""
+Instant Payment Notification handling. The listener only spools the raw
+message and answers PayPal; worker threads verify the messages over pooled
+connections and hand them to the application in batches.
+"""
+import threading
+
+from spool import IPNSpool, dedupe_key, parse
+from verifier import IPNVerifier, POSTBACK_URLS
+from processor import IPNProcessor
+from dal import DALHandler, define_table
+
+_processors = {}
+_lock = threading.Lock()
+
+def default(spool_path, sandbox=True, handler=None, uri=None, folder=None,
+            workers=4):
+    """
+    Returns the started IPNProcessor of this process for ``spool_path``,
+    creating it on first use. Without a ``handler``, messages are stored in
+    the paypal_ipn table of the database at ``uri``.
+    """
+    processor = _processors.get(spool_path)
+    if processor is None:
+        with _lock:
+            processor = _processors.get(spool_path)
+            if processor is None:
+                environment = sandbox and 'sandbox' or 'production'
+                processor = IPNProcessor(
+                    IPNSpool(spool_path),
+                    IPNVerifier(POSTBACK_URLS[environment]),
+                    handler or DALHandler(uri, folder),
+                    workers=workers).start()
+                _processors[spool_path] = processor
+    return processor
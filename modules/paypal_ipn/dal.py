@@ -0,0 +1,65 @@
+# coding=utf-8
+"""
+Storing verified IPN messages with the web2py DAL.
+"""
+
+import urllib
+import datetime
+import threading
+
+def define_table(db):
+    """Defines the paypal_ipn table on ``db`` and returns it."""
+    from gluon import Field
+    if 'paypal_ipn' in db.tables:
+        return db.paypal_ipn
+    return db.define_table('paypal_ipn',
+        Field('txn_id', length=64),
+        Field('txn_type', length=64),
+        Field('payment_status', length=32),
+        Field('mc_gross', length=32),
+        Field('mc_currency', length=3),
+        Field('invoice'),
+        Field('custom'),
+        Field('payer_email'),
+        Field('raw', 'text'),
+        Field('received_on', 'datetime'))
+
+
+class DALHandler(object):
+    """
+    IPNProcessor handler inserting each batch into the paypal_ipn table with
+    one bulk insert and one commit. Worker threads run outside any web2py
+    request, so each opens its own DAL connection to ``uri``.
+    """
+    def __init__(self, uri, folder=None):
+        self.uri = uri
+        self.folder = folder
+        self._local = threading.local()
+
+    def __call__(self, messages):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            from gluon import DAL
+            db = self._local.db = DAL(self.uri, folder=self.folder,
+                                      migrate=False)
+            define_table(db)
+        now = datetime.datetime.now()
+        rows = []
+        for ipn in messages:
+            rows.append(dict(
+                txn_id=ipn.get('txn_id'),
+                txn_type=ipn.get('txn_type'),
+                payment_status=ipn.get('payment_status'),
+                mc_gross=ipn.get('mc_gross'),
+                mc_currency=ipn.get('mc_currency'),
+                invoice=ipn.get('invoice'),
+                custom=ipn.get('custom'),
+                payer_email=ipn.get('payer_email'),
+                raw=urllib.urlencode(sorted(ipn.items())),
+                received_on=now))
+        try:
+            db.paypal_ipn.bulk_insert(rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
@@ -0,0 +1,120 @@
+# coding=utf-8
+"""
+The worker pool that verifies spooled IPN messages and hands them, in
+batches, to the application.
+"""
+
+import time
+import logging
+import threading
+
+from spool import parse, VERIFIED, INVALID, APPLIED, NEW
+
+class IPNProcessor(object):
+    """
+    Runs ``workers`` threads that claim new messages from ``spool``,
+    verify them with ``verifier`` and pass the verified ones to
+    ``handler``, a callable taking a list of parsed IPN dicts. The handler
+    gets up to ``batch_size`` messages at once so it can store them in a
+    single transaction; if it raises, the batch is offered again later.
+
+    Messages that fail verification because PayPal could not be reached
+    are retried up to ``max_attempts`` times.
+    """
+    def __init__(self, spool, verifier, handler, workers=4, batch_size=50,
+                 max_attempts=10, poll_interval=1.0, claim_timeout=300):
+        self.spool = spool
+        self.verifier = verifier
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self._wakeup = threading.Event()
+        self._apply_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Starts the worker threads; messages left by a crash are requeued."""
+        if self._threads:
+            return self
+        self.spool.requeue_stale(self.claim_timeout)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='paypal-ipn-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, raw):
+        """
+        Spools a raw IPN body and wakes a worker. This is all the listener
+        does while PayPal waits for its HTTP 200. Returns False for
+        redeliveries.
+        """
+        stored = self.spool.put(raw)
+        if stored:
+            self._wakeup.set()
+        return stored
+
+    def process(self, limit=None):
+        """
+        Verifies up to ``limit`` (default ``batch_size``) new messages and
+        applies whatever is verified. Returns the number of messages
+        verified or found invalid. Used by the worker threads, and handy
+        from a scheduler task when no threads are wanted.
+        """
+        claimed = self.spool.claim(limit or self.batch_size)
+        verified, invalid, retry = [], [], []
+        for ipn_id, raw in claimed:
+            try:
+                if self.verifier.verify(raw):
+                    verified.append(ipn_id)
+                else:
+                    invalid.append(ipn_id)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'IPN %s postback failed', ipn_id)
+                retry.append(ipn_id)
+        self.spool.mark(verified, VERIFIED)
+        self.spool.mark(invalid, INVALID)
+        self.spool.mark(retry, NEW, attempt=True)
+        self.apply()
+        return len(verified) + len(invalid)
+
+    def apply(self):
+        """Hands verified messages to the handler, one batch at a time."""
+        # One applier at a time, so a batch is never handed out twice.
+        if not self._apply_lock.acquire(False):
+            return
+        try:
+            while True:
+                batch = self.spool.take_verified(self.batch_size)
+                if not batch:
+                    return
+                try:
+                    self.handler([parse(raw) for ipn_id, raw in batch])
+                except Exception:
+                    logging.getLogger(__name__).exception(
+                        'IPN handler failed, batch kept for retry')
+                    return
+                self.spool.mark([ipn_id for ipn_id, raw in batch], APPLIED)
+        finally:
+            self._apply_lock.release()
+
+    def _run(self):
+        last_requeue = time.time()
+        while True:
+            try:
+                if not self.process():
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                if time.time() - last_requeue > self.claim_timeout:
+                    self.spool.requeue_stale(self.claim_timeout)
+                    self.spool.give_up(self.max_attempts)
+                    last_requeue = time.time()
+            except Exception:
+                logging.getLogger(__name__).exception('IPN worker failed')
+                time.sleep(self.poll_interval)
@@ -0,0 +1,184 @@
+# coding=utf-8
+"""
+The durable local queue IPN messages are written to before PayPal gets its
+HTTP 200, so the listener can answer at once and verify later.
+"""
+
+import time
+import hashlib
+import sqlite3
+import threading
+from urlparse import parse_qs
+
+NEW = 'new'
+CLAIMED = 'claimed'
+VERIFIED = 'verified'
+INVALID = 'invalid'
+APPLIED = 'applied'
+FAILED = 'failed'
+DUPLICATE = 'duplicate'
+
+def dedupe_key(fields):
+    """
+    The key identifying redeliveries of the same notification. A txn_id is
+    notified once per payment_status change (Pending, then Completed, ...),
+    so both are part of the key; messages without a txn_id fall back to the
+    ipn_track_id PayPal keeps across redeliveries.
+    """
+    if fields.get('txn_id'):
+        return 'txn:%s:%s' % (fields['txn_id'], fields.get('payment_status', ''))
+    if fields.get('ipn_track_id'):
+        return 'track:%s' % fields['ipn_track_id']
+    return None
+
+def parse(raw):
+    """Parses a raw IPN body into a dict of single values."""
+    return dict((k, v[0]) for k, v in parse_qs(raw, keep_blank_values=True).items())
+
+
+class IPNSpool(object):
+    """
+    A sqlite file at ``path`` holding every IPN received, indexed by dedupe
+    key so redeliveries are dropped on arrival.
+
+    Messages move from 'new' to 'claimed' (a worker is verifying them), to
+    'verified' or 'invalid', and from 'verified' to 'applied' once the
+    application stored them. Messages PayPal could not be asked about after
+    many attempts end up 'failed'.
+
+    Only a verified or applied message blocks others with its key: anybody
+    can post a forged message with a real txn_id, and it must not take the
+    place of the genuine one. Messages with the key of one verified before
+    them end up 'duplicate' instead of 'verified'.
+    """
+    _SCHEMA = ("""
+        CREATE TABLE IF NOT EXISTS ipn (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe TEXT,
+            raw BLOB NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            received REAL NOT NULL,
+            updated REAL NOT NULL
+        )""",
+        # Spools made when the dedupe key was unique.
+        "DROP INDEX IF EXISTS ipn_dedupe",
+        "CREATE INDEX IF NOT EXISTS ipn_dedupe_state ON ipn (dedupe, state)",
+        "CREATE INDEX IF NOT EXISTS ipn_state ON ipn (state, id)",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        db = self._connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        for statement in self._SCHEMA:
+            db.execute(statement)
+
+    def put(self, raw):
+        """
+        Stores a raw IPN body. Returns False if it is a redelivery of a
+        message already stored, or a message with the key of one verified.
+        """
+        now = time.time()
+        key = dedupe_key(parse(raw)) or 'raw:' + hashlib.sha1(raw).hexdigest()
+        raw = sqlite3.Binary(raw)
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # A message that failed may be tried again when PayPal resends it.
+            known = db.execute(
+                'SELECT 1 FROM ipn WHERE dedupe = ? AND (state IN (?, ?) OR '
+                '(raw = ? AND state != ?)) LIMIT 1',
+                (key, VERIFIED, APPLIED, raw, FAILED)).fetchone()
+            if not known:
+                db.execute(
+                    'INSERT INTO ipn (dedupe, raw, state, received, updated) '
+                    'VALUES (?, ?, ?, ?, ?)', (key, raw, NEW, now, now))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return not known
+
+    def claim(self, limit):
+        """Marks up to ``limit`` new messages claimed and returns (id, raw) pairs."""
+        return self._take(NEW, CLAIMED, limit)
+
+    def take_verified(self, limit):
+        """Returns up to ``limit`` verified messages not applied yet."""
+        rows = self._connection().execute(
+            'SELECT id, raw FROM ipn WHERE state = ? ORDER BY id LIMIT ?',
+            (VERIFIED, limit)).fetchall()
+        return [(row[0], str(row[1])) for row in rows]
+
+    def mark(self, ids, state, attempt=False):
+        """
+        Moves the messages ``ids`` to ``state``; those marked verified when
+        another message with their key is verified or applied become
+        duplicates.
+        """
+        if not ids:
+            return
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            for i in ids:
+                new_state = state
+                if state == VERIFIED and db.execute(
+                        'SELECT 1 FROM ipn WHERE dedupe = '
+                        '(SELECT dedupe FROM ipn WHERE id = ?) '
+                        'AND id != ? AND state IN (?, ?) LIMIT 1',
+                        (i, i, VERIFIED, APPLIED)).fetchone():
+                    new_state = DUPLICATE
+                db.execute(
+                    'UPDATE ipn SET state = ?, attempts = attempts + ?, '
+                    'updated = ? WHERE id = ?',
+                    (new_state, 1 if attempt else 0, now, i))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def requeue_stale(self, older_than):
+        """Hands messages claimed by a worker that died back to the queue."""
+        db = self._connection()
+        db.execute('UPDATE ipn SET state = ? WHERE state = ? AND updated < ?',
+                   (NEW, CLAIMED, time.time() - older_than))
+
+    def give_up(self, max_attempts):
+        """Marks new messages that were attempted ``max_attempts`` times failed."""
+        self._connection().execute(
+            'UPDATE ipn SET state = ?, updated = ? '
+            'WHERE state = ? AND attempts >= ?',
+            (FAILED, time.time(), NEW, max_attempts))
+
+    def counts(self):
+        """Number of messages per state."""
+        return dict(self._connection().execute(
+            'SELECT state, COUNT(*) FROM ipn GROUP BY state').fetchall())
+
+    def _take(self, state, new_state, limit):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = db.execute(
+                'SELECT id, raw FROM ipn WHERE state = ? ORDER BY id LIMIT ?',
+                (state, limit)).fetchall()
+            db.executemany('UPDATE ipn SET state = ?, updated = ? WHERE id = ?',
+                           [(new_state, time.time(), row[0]) for row in rows])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return [(row[0], str(row[1])) for row in rows]
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # Autocommit; multi-statement writes use explicit transactions.
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
@@ -0,0 +1,41 @@
+# coding=utf-8
+"""
+The _notify-validate postback that confirms an IPN really comes from PayPal.
+"""
+
+from urlparse import urlsplit
+
+from paypal_transport.pool import ConnectionPool
+
+POSTBACK_URLS = {
+    'sandbox': 'https://www.sandbox.paypal.com/cgi-bin/webscr',
+    'production': 'https://www.paypal.com/cgi-bin/webscr',
+}
+
+class IPNVerifier(object):
+    """
+    Posts IPN messages back to PayPal over a pool of keep-alive connections
+    shared by all worker threads.
+    """
+    def __init__(self, url=POSTBACK_URLS['sandbox'], pool_size=10, timeout=30):
+        parts = urlsplit(url)
+        self.path = parts.path
+        self.pool = ConnectionPool(parts.netloc, parts.scheme, pool_size,
+                                   timeout)
+
+    def verify(self, raw):
+        """
+        Returns True for VERIFIED and False for INVALID. Transport errors
+        and unexpected answers raise, so the message can be retried.
+        """
+        response = self.pool.request('POST', self.path,
+                                     'cmd=_notify-validate&' + raw,
+                                     { 'Content-Type':
+                                       'application/x-www-form-urlencoded' })
+        answer = response.body.strip()
+        if response.status == 200 and answer == 'VERIFIED':
+            return True
+        if response.status == 200 and answer == 'INVALID':
+            return False
+        raise IOError('Unexpected IPN postback answer: %s %s' %
+                      (response.status, answer[:100]))
@@ -26,4 +26,9 @@ EMAIL_PERSONAL = 'custX_xxxxxxxxxx_per@xxxxxxxx.com'
 VISA_ACCOUNT_NO = 'xxxxxxxxxxxxxxxx'
 # And the expiration date in the form of MMYYYY. Note that there are no slashes,
 # and single-digit month numbers have a leading 0 (IE: 03 for march).
-VISA_EXPIRATION = 'mmyyyy'
\ No newline at end of file
+VISA_EXPIRATION = 'mmyyyy'
+# To run the tests offline against the local NVP emulator instead of the
+# sandbox, uncomment these lines; it accepts any card number passing the
+# Luhn check, such as 4111111111111111, with a future expiration date.
+#import paypal_emulator
+#CONFIG.API_ENDPOINT = paypal_emulator.NvpEmulator().serve().url('/nvp')
@@ -10,11 +10,22 @@ import sys
 # one (if applicable).
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import unittest
-import t_direct_payment
-import t_express_checkout
+import t_transport
+import t_ipn
+import t_shipping
+import t_finalize
+import t_prefetch
 
-# A list of the modules under the tests package that should be ran.
-test_modules = [t_direct_payment, t_express_checkout]
+# A list of the modules under the tests package that should be ran. The
+# offline ones talk to the emulators; the others need the sandbox
+# credentials of api_details.py.
+test_modules = [t_transport, t_ipn, t_shipping, t_finalize,
+                t_prefetch]
+if os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'api_details.py')):
+    import t_direct_payment
+    import t_express_checkout
+    test_modules += [t_direct_payment, t_express_checkout]
 
 # Fire off all of the tests.
 for mod in test_modules:
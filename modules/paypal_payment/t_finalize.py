@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Offline tests of paypalnvp.finalize. PayPal is played in process by
+paypal_emulator.NvpEmulator, the paypalnvp transport.
+"""
+
+import os
+import logging
+import shutil
+import tempfile
+import unittest
+
+from paypalnvp import core, fields, requests
+from paypalnvp.finalize import FinalizationQueue, Finalizer, QUEUED, \
+    RUNNING, DONE, FAILED
+from paypal_emulator import NvpEmulator, Faults, ERROR, RESET
+from paypal_transport import Pipeline
+
+# The finalizer logs the lost answers on the root logger.
+logging.getLogger().addHandler(logging.NullHandler())
+
+
+class TestFinalizer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.faults = Faults()
+        self.emulator = NvpEmulator(faults=self.faults)
+        profile = core.BaseProfile('test_api1.example.com', '1234567890')
+        profile.set_signature('A' * 56)
+        self.paypal = core.PayPal(profile, sandbox=True,
+                                  pipeline=Pipeline([]),
+                                  transport=self.emulator)
+        self.queue = FinalizationQueue(
+            os.path.join(self.directory, 'finalization.sqlite'))
+        self.finalizer = Finalizer(self.paypal, self.queue, max_attempts=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def submit(self):
+        """Starts a checkout and submits its DoExpressCheckoutPayment."""
+        item = fields.PaymentItem()
+        item.set_name('Mug')
+        item.set_amount('10.00')
+        item.set_quantity(1)
+        payment = fields.Payment(items=[item])
+        start = requests.SetExpressCheckout(payment, 'http://shop/return',
+                                            'http://shop/cancel')
+        self.paypal.set_response(start)
+        token = start.get_nvp_response()['TOKEN']
+        details = requests.GetExpressCheckoutDetails(token)
+        self.paypal.set_response(details)
+        return self.finalizer.submit(requests.DoExpressCheckoutPayment(
+            payment, token, 'Sale', details.get_nvp_response()['PAYERID']))
+
+    def state(self, token):
+        return self.finalizer.status(token)['state']
+
+    def test_queue(self):
+        self.assertTrue(self.queue.put('EC-1', {'TOKEN': 'EC-1'}))
+        self.assertFalse(self.queue.put('EC-1', {'TOKEN': 'EC-1'}))
+        self.assertEqual(self.queue.claim(), ('EC-1', {'TOKEN': 'EC-1'}, 1))
+        self.assertEqual(self.queue.claim(), None)
+        self.assertEqual(self.queue.status('EC-1')['state'], RUNNING)
+        self.queue.finish('EC-1', DONE, {'ACK': 'Success'})
+        self.assertEqual(self.queue.status('EC-1'),
+                         {'state': DONE, 'attempts': 1,
+                          'response': {'ACK': 'Success'}})
+        self.assertEqual(self.queue.status('EC-2'), None)
+
+    def test_done(self):
+        token = self.submit()
+        self.assertEqual(self.state(token), QUEUED)
+        self.assertTrue(self.finalizer.process())
+        self.assertFalse(self.finalizer.process())
+        self.assertEqual(self.state(token), DONE)
+        self.assertEqual(self.emulator.calls['DoExpressCheckoutPayment'], 1)
+
+    def test_passing_error_is_sent_again(self):
+        token = self.submit()
+        self.faults.add(1, ERROR, ['DoExpressCheckoutPayment'], code='10001')
+        self.finalizer.process()
+        self.assertEqual(self.state(token), QUEUED)
+        del self.faults.rules[:]
+        self.finalizer.process()
+        self.assertEqual(self.state(token), DONE)
+        self.assertEqual(self.finalizer.status(token)['attempts'], 2)
+
+    def test_passing_error_up_to_max_attempts(self):
+        token = self.submit()
+        self.faults.add(1, ERROR, ['DoExpressCheckoutPayment'], code='10001')
+        while self.finalizer.process():
+            pass
+        self.assertEqual(self.state(token), FAILED)
+        self.assertEqual(self.finalizer.status(token)['attempts'], 3)
+
+    def test_final_error(self):
+        token = self.submit()
+        self.faults.add(1, ERROR, ['DoExpressCheckoutPayment'], code='10410')
+        self.finalizer.process()
+        status = self.finalizer.status(token)
+        self.assertEqual(status['state'], FAILED)
+        self.assertEqual(status['response']['L_ERRORCODE0'], '10410')
+
+    def test_lost_answer_is_reconciled(self):
+        token = self.submit()
+        self.faults.add(1, RESET, ['DoExpressCheckoutPayment'])
+        self.finalizer.process()
+        # PayPal never got it: the details say so, and it is queued again.
+        self.assertEqual(self.state(token), QUEUED)
+        del self.faults.rules[:]
+        self.finalizer.process()
+        self.assertEqual(self.state(token), DONE)
+
+    def test_completed_before_is_done(self):
+        token = self.submit()
+        self.finalizer.process()
+        self.queue.finish(token, QUEUED)
+        self.finalizer.process()
+        # 10415 from the second send, settled by the details.
+        self.assertEqual(self.state(token), DONE)
+        self.assertEqual(self.emulator.calls['DoExpressCheckoutPayment'], 2)
+
+    def test_stale_checkouts_are_claimed_once(self):
+        self.queue.put('EC-1', {'TOKEN': 'EC-1'})
+        self.queue.claim()
+        self.assertEqual(self.queue.claim_stale(60), [])
+        self.assertEqual(self.queue.claim_stale(-1), [('EC-1', 1)])
+        self.assertEqual(self.queue.claim_stale(0.5), [])
+        self.assertEqual(self.queue.status('EC-1')['state'], RUNNING)
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+Offline tests of the IPN spool and processor. PayPal's _notify-validate
+postback is played by a paypal_emulator.EmulatorServer that knows which
+messages PayPal really sent.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from urllib import urlencode
+
+from paypal_emulator import EmulatorServer, Reply
+from paypal_ipn import IPNSpool, IPNVerifier, IPNProcessor
+from paypal_ipn.spool import NEW, INVALID, APPLIED, DUPLICATE
+
+class _Postback(object):
+    """Answers VERIFIED for the bodies PayPal sent, INVALID otherwise."""
+    def __init__(self):
+        self.sent = set()
+
+    def __call__(self, verb, path, headers, body):
+        raw = body[len('cmd=_notify-validate&'):]
+        return Reply(raw in self.sent and 'VERIFIED' or 'INVALID')
+
+
+def message(txn_id, status='Completed', gross='10.00', **fields):
+    fields.update(txn_id=txn_id, payment_status=status, mc_gross=gross)
+    return urlencode(sorted(fields.items()))
+
+
+class TestIPNDedupe(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.postback = _Postback()
+        self.server = EmulatorServer(self.postback).start()
+        self.spool = IPNSpool(os.path.join(self.directory, 'ipn.sqlite'))
+        self.applied = []
+        self.processor = IPNProcessor(
+            self.spool, IPNVerifier(self.server.url('/cgi-bin/webscr')),
+            self.applied.extend)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def paypal_sends(self, raw):
+        self.postback.sent.add(raw)
+        return self.processor.submit(raw)
+
+    def test_redelivery_is_dropped(self):
+        raw = message('1AB')
+        self.assertTrue(self.paypal_sends(raw))
+        self.assertFalse(self.paypal_sends(raw))
+        self.processor.process()
+        self.assertFalse(self.paypal_sends(raw))
+        self.assertEqual([m['txn_id'] for m in self.applied], ['1AB'])
+
+    def test_status_changes_are_kept(self):
+        self.paypal_sends(message('1AB', 'Pending'))
+        self.paypal_sends(message('1AB', 'Completed'))
+        self.processor.process()
+        self.assertEqual([m['payment_status'] for m in self.applied],
+                         ['Pending', 'Completed'])
+
+    def test_forged_message_first(self):
+        self.assertTrue(self.processor.submit(message('1AB', gross='0.01')))
+        self.processor.process()
+        self.assertEqual(self.spool.counts(), {INVALID: 1})
+        self.assertTrue(self.paypal_sends(message('1AB')))
+        self.processor.process()
+        self.assertEqual([m['mc_gross'] for m in self.applied], ['10.00'])
+
+    def test_forged_message_pending(self):
+        # Both wait for verification when the genuine one comes in.
+        self.assertTrue(self.processor.submit(message('1AB', gross='0.01')))
+        self.assertTrue(self.paypal_sends(message('1AB')))
+        self.processor.process()
+        self.assertEqual([m['mc_gross'] for m in self.applied], ['10.00'])
+        self.assertEqual(self.spool.counts(), {INVALID: 1, APPLIED: 1})
+
+    def test_forged_message_after_verification(self):
+        self.paypal_sends(message('1AB'))
+        self.processor.process()
+        self.assertFalse(self.processor.submit(message('1AB', gross='0.01')))
+        self.assertEqual(self.spool.counts(), {APPLIED: 1})
+
+    def test_verified_twice_is_applied_once(self):
+        # PayPal resent the notification with a field changed.
+        self.paypal_sends(message('1AB', residence_country='US'))
+        self.paypal_sends(message('1AB', residence_country='DE'))
+        self.assertEqual(self.spool.counts(), {NEW: 2})
+        self.processor.process()
+        self.assertEqual(len(self.applied), 1)
+        self.assertEqual(self.spool.counts(), {APPLIED: 1, DUPLICATE: 1})
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""
+Offline tests of paypalnvp.prefetch. PayPal is played in process by
+paypal_emulator.NvpEmulator, the paypalnvp transport.
+"""
+
+import time
+import unittest
+
+from paypalnvp import core, fields, requests
+from paypalnvp.prefetch import TokenPrefetcher
+from paypal_emulator import NvpEmulator
+from paypal_transport import Pipeline
+
+
+def set_express_checkout(amount):
+    item = fields.PaymentItem()
+    item.set_name('Mug')
+    item.set_amount(amount)
+    item.set_quantity(1)
+    return requests.SetExpressCheckout(fields.Payment(items=[item]),
+                                       'http://shop/return',
+                                       'http://shop/cancel')
+
+
+class TestTokenPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = NvpEmulator()
+        profile = core.BaseProfile('test_api1.example.com', '1234567890')
+        profile.set_signature('A' * 56)
+        self.paypal = core.PayPal(profile, sandbox=True,
+                                  pipeline=Pipeline([]),
+                                  transport=self.emulator)
+
+    def prefetcher(self, **options):
+        return TokenPrefetcher(self.paypal, **options)
+
+    def sent(self):
+        return self.emulator.calls.get('SetExpressCheckout', 0)
+
+    def settle(self, count):
+        """Waits for ``count`` SetExpressCheckout calls to be answered."""
+        deadline = time.time() + 2
+        while self.sent() < count and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+
+    def test_prefetched_token_is_used_once(self):
+        prefetcher = self.prefetcher(workers=1)
+        prefetcher.prefetch(set_express_checkout('10.00'), 'buyer-1')
+        self.settle(1)
+        self.assertTrue(prefetcher.checkout(set_express_checkout('10.00'),
+                                            'buyer-1'))
+        self.assertEqual((prefetcher.hits, prefetcher.misses, self.sent()),
+                         (1, 0, 1))
+        # Another buyer with the same cart gets a token of their own.
+        prefetcher.checkout(set_express_checkout('10.00'), 'buyer-2')
+        self.assertEqual((prefetcher.misses, self.sent()), (1, 2))
+
+    def test_owner_is_required(self):
+        prefetcher = self.prefetcher(workers=0)
+        self.assertRaises(ValueError, prefetcher.prefetch,
+                          set_express_checkout('10.00'), None)
+        self.assertRaises(ValueError, prefetcher.checkout,
+                          set_express_checkout('10.00'), None)
+
+    def test_oldest_ready_token_makes_room(self):
+        prefetcher = self.prefetcher(workers=1, max_entries=2)
+        for amount in ('1.00', '2.00', '3.00'):
+            prefetcher.prefetch(set_express_checkout(amount), 'buyer-1')
+            self.settle(int(amount[0]))
+        self.assertEqual(prefetcher.size(), 2)
+        prefetcher.checkout(set_express_checkout('1.00'), 'buyer-1')
+        prefetcher.checkout(set_express_checkout('3.00'), 'buyer-1')
+        self.assertEqual((prefetcher.hits, prefetcher.misses), (1, 1))
+
+    def test_nothing_is_prefetched_when_full(self):
+        # No workers: the queued carts are never answered.
+        prefetcher = self.prefetcher(workers=0, max_entries=2)
+        for amount in ('1.00', '2.00', '3.00'):
+            prefetcher.prefetch(set_express_checkout(amount), 'buyer-1')
+        self.assertEqual((prefetcher.size(), prefetcher.skipped), (2, 1))
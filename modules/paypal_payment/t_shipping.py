@@ -0,0 +1,104 @@
+# coding=utf-8
+"""
+Offline tests of the Instant Update callback answers of
+paypalnvp.shipping.
+"""
+
+import unittest
+
+from paypalnvp.util import NvpEncoder
+from paypalnvp.shipping import RateTable, ShippingCallback
+
+NO_OPTIONS = 'METHOD=CallbackResponse&NO_SHIPPING_OPTION_DETAILS=1'
+
+def callback_request(country='IT', zip='20100', kgs='1.5', quantity='2',
+                     currency='EUR'):
+    """A CallbackRequest for ``quantity`` mugs of ``kgs`` each, at 10.00."""
+    return NvpEncoder().encode([
+        ('METHOD', 'CallbackRequest'), ('CURRENCYCODE', currency),
+        ('L_NAME0', 'Mug'), ('L_AMT0', '10.00'), ('L_QTY0', quantity),
+        ('L_ITEMWEIGHTVALUE0', kgs), ('L_ITEMWEIGHTUNIT0', 'kgs'),
+        ('SHIPTOCOUNTRY', country), ('SHIPTOZIP', zip)])
+
+
+class TestShippingCallback(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RateTable('EUR', 'kgs')
+        self.table.add_rate('IT', 'Standard', '4.95', max_weight=2)
+        self.table.add_rate('IT', 'Standard', '7.95', max_weight=5)
+        self.table.add_rate('IT', 'Express', '14.95')
+        self.table.add_rate('IT', 'Local', '2.00', postal_prefix='00')
+        self.table.build()
+        self.callback = ShippingCallback(self.table)
+
+    def respond(self, **request):
+        answer = self.callback.respond(callback_request(**request))
+        if answer == NO_OPTIONS:
+            return None
+        return NvpEncoder().decode(answer)
+
+    def options(self, answer):
+        options = []
+        i = 0
+        while 'L_SHIPPINGOPTIONNAME%d' % i in answer:
+            options.append((answer['L_SHIPPINGOPTIONNAME%d' % i],
+                            answer['L_SHIPPINGOPTIONAMOUNT%d' % i],
+                            answer['L_SHIPPINGOPTIONISDEFAULT%d' % i]))
+            i += 1
+        return options
+
+    def test_options_of_the_weight_band(self):
+        self.assertEqual(self.options(self.respond(quantity='1')),
+                         [('Standard', '4.95', 'true'),
+                          ('Express', '14.95', 'false')])
+        self.assertEqual(self.options(self.respond(quantity='2')),
+                         [('Standard', '7.95', 'true'),
+                          ('Express', '14.95', 'false')])
+        self.assertEqual(self.options(self.respond(quantity='4')),
+                         [('Express', '14.95', 'true')])
+
+    def test_postal_prefix_rates_come_first(self):
+        self.assertEqual(self.options(self.respond(zip='00 184')),
+                         [('Local', '2.00', 'true')])
+
+    def test_no_options(self):
+        self.assertEqual(self.respond(country='FR'), None)
+        self.assertEqual(self.respond(currency='USD'), None)
+        table = RateTable('EUR', 'kgs')
+        table.add_rate('IT', 'Standard', '4.95', max_weight=2)
+        table.build()
+        self.assertEqual(
+            ShippingCallback(table).respond(callback_request(quantity='2')),
+            NO_OPTIONS)
+
+    def test_tax_for_every_option(self):
+        self.table.set_tax_rate('IT', 0.22)
+        answer = self.respond()
+        self.assertEqual((answer['L_TAXAMT0'], answer['L_TAXAMT1']),
+                         ('4.40', '4.40'))
+        self.assertEqual(answer['CURRENCYCODE'], 'EUR')
+
+    def test_default_option(self):
+        self.table.add_rate('IT', 'Express', '12.95', default=True)
+        self.table.build()
+        self.assertEqual(self.options(self.respond(quantity='1')),
+                         [('Standard', '4.95', 'false'),
+                          ('Express', '12.95', 'true')])
+
+    def test_rebuild_replaces_the_tables(self):
+        self.table.add_rate('FR', 'Colissimo', '9.00')
+        self.assertEqual(self.respond(country='FR'), None)
+        self.table.build()
+        self.assertEqual(self.options(self.respond(country='FR')),
+                         [('Colissimo', '9.00', 'true')])
+
+    def test_flat_rate_options(self):
+        options = self.table.shipping_options('IT', '20100', 1)
+        self.assertEqual([(o.get_nvp_request()['L_SHIPPINGOPTIONNAME'],
+                           o.get_nvp_request()['L_SHIPPINGOPTIONAMOUNT'])
+                          for o in options],
+                         [('Standard', '4.95'), ('Express', '14.95')])
+
+    def test_invalid_amount(self):
+        self.assertRaises(ValueError, self.table.add_rate, 'IT', 'Free', '0,00')
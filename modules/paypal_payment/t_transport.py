@@ -0,0 +1,883 @@
+# coding=utf-8
+"""
+Offline tests of the paypal_transport policies. PayPal is played by
+paypal_emulator.NvpEmulator, served over HTTP to a PayPalInterface.
+"""
+
+import os
+import time
+import shutil
+import socket
+import urllib2
+import httplib
+import tempfile
+import threading
+import unittest
+
+import paypal_transport
+from paypal import PayPalInterface
+from paypal.exceptions import PayPalAPIResponseError
+from paypal_emulator import NvpEmulator, EmulatorServer, Reply, Faults, \
+    HTTP, HANG, RESET
+from paypal_transport import CircuitBreakerPolicy, CircuitOpenError, \
+    RateLimitTimeout, DuplicateRequestError, IdempotencyStore, \
+    IdempotencyPolicy, Journal, JournalPolicy, ConnectionPool, \
+    CoalescingPolicy, TokenBucket, RateLimitPolicy, AdaptiveLimiter, \
+    AdaptiveConcurrencyPolicy, PriorityDispatcher, PriorityPolicy, \
+    HedgingPolicy, RetryPolicy, MetricsPolicy, Exchange, Pipeline, Policy, Cassette, \
+    CassettePolicy, CassetteMiss, RECORD, CLOSED, OPEN, HALF_OPEN, \
+    CRITICAL, NORMAL, BACKGROUND
+from paypal_transport.priority import current_lane
+from paypal_transport.idempotency import current_key
+from paypal_transport.cassette import _FOOTER
+from paypal_transport import metrics
+from paypalnvp.core import MemoryTransport, ChainTransport
+
+# What a connection reset by the emulator raises.
+BROKEN = (IOError, httplib.HTTPException)
+
+class EmulatedTestCase(unittest.TestCase):
+    """Serves a fresh NvpEmulator and talks to it through ``policies``."""
+    policies = ()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.faults = Faults()
+        self.emulator = NvpEmulator(faults=self.faults)
+        self.server = self.emulator.serve()
+        self.pipeline = Pipeline(list(self.make_policies()))
+        self.interface = PayPalInterface(API_USERNAME='test_api1.example.com',
+                                         API_PASSWORD='1234567890',
+                                         API_SIGNATURE='A' * 56,
+                                         pipeline=self.pipeline)
+        self.interface.config.API_ENDPOINT = self.server.url('/nvp')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def make_policies(self):
+        return []
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def checkout(self, amt='10.00'):
+        """A token for a checkout the buyer approved, and the PayerID."""
+        token = self.interface.set_express_checkout(
+            amt=amt, returnurl='http://shop/return',
+            cancelurl='http://shop/cancel').token
+        payer_id = self.interface.get_express_checkout_details(token).payerid
+        return token, payer_id
+
+    def pay(self, token, payer_id, amt='10.00'):
+        return self.interface.do_express_checkout_payment(
+            token, amt=amt, paymentaction='Sale', payerid=payer_id)
+
+
+class _Unsent(Policy):
+    """Refuses every call before it is sent, as a rate limit would."""
+    def send(self, exchange, proceed):
+        raise RateLimitTimeout(exchange.method, 0)
+
+
+class TestCircuitBreaker(EmulatedTestCase):
+
+    def make_policies(self):
+        self.breakers = CircuitBreakerPolicy(
+            listeners=[lambda breaker, old, new: self.changes.append(new)],
+            window=4, minimum_calls=4, open_timeout=0.2, half_open_probes=2)
+        self.changes = []
+        return [self.breakers]
+
+    def lookup(self):
+        try:
+            self.interface.get_transaction_details('0')
+        except PayPalAPIResponseError:
+            # Answered, with an error: the endpoint works.
+            pass
+
+    def breaker(self):
+        return self.breakers.breaker(self.server.url())
+
+    def fail_all(self):
+        self.faults.add(1.0, HTTP, status=503)
+        while self.breaker().state == CLOSED:
+            self.assertRaises(urllib2.HTTPError, self.lookup)
+
+    def test_opens_on_failures(self):
+        self.lookup()
+        self.assertEqual(self.breaker().state, CLOSED)
+        self.fail_all()
+        self.assertEqual(self.breaker().state, OPEN)
+        sent = self.server.requests
+        self.assertRaises(CircuitOpenError, self.lookup)
+        self.assertEqual(self.server.requests, sent)
+
+    def test_closes_after_probes(self):
+        self.fail_all()
+        time.sleep(0.25)
+        self.assertEqual(self.breaker().state, HALF_OPEN)
+        del self.faults.rules[:]
+        self.lookup()
+        self.assertEqual(self.breaker().state, HALF_OPEN)
+        self.lookup()
+        self.assertEqual(self.breaker().state, CLOSED)
+        self.assertEqual(self.changes, [OPEN, HALF_OPEN, CLOSED])
+
+    def test_failed_probe_reopens(self):
+        self.fail_all()
+        time.sleep(0.25)
+        self.assertRaises(urllib2.HTTPError, self.lookup)
+        self.assertEqual(self.breaker().state, OPEN)
+        self.assertEqual(self.changes, [OPEN, HALF_OPEN, OPEN])
+
+    def test_unsent_calls_do_not_count(self):
+        self.pipeline.add(_Unsent())
+        for i in range(8):
+            self.assertRaises(RateLimitTimeout, self.lookup)
+        self.assertEqual(self.breaker().state, CLOSED)
+        self.assertEqual(self.server.requests, 0)
+
+
+class _Gate(object):
+    """
+    A transmit function holding every call until opened, answering with
+    the Authorization header it was sent with.
+    """
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+        self.opened = threading.Event()
+
+    def __call__(self, exchange):
+        token = exchange.headers.get('Authorization')
+        self.sent.append(token)
+        self.opened.wait(5)
+        if self.error is not None:
+            raise self.error
+        exchange.status = 200
+        exchange.content = 'payment seen by %s' % token
+        return exchange.content
+
+
+def concurrently(calls):
+    """Starts a thread per function in ``calls``; returns the threads and
+    the list their results, or exceptions, go to."""
+    results = [None] * len(calls)
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+class TestCoalescing(unittest.TestCase):
+    method = 'GET v1/payments/payment/{id}'
+
+    def setUp(self):
+        self.coalescing = CoalescingPolicy()
+        self.pipeline = Pipeline([self.coalescing])
+
+    def lookup(self, gate, token='Bearer A015'):
+        exchange = Exchange('rest', self.method,
+                            'https://api.paypal.com/v1/payments/payment/PAY-1',
+                            None, {'Authorization': token}, verb='GET')
+        return lambda: self.pipeline.send(exchange, gate)
+
+    def coalesced(self):
+        return self.coalescing.metrics()[self.method]['coalesced']
+
+    def test_identical_calls_share_one_request(self):
+        gate = _Gate()
+        threads, results = concurrently([self.lookup(gate)] * 3)
+        self.assertTrue(wait_for(lambda: self.coalesced() == 2))
+        gate.opened.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(gate.sent), 1)
+        self.assertEqual(results, ['payment seen by Bearer A015'] * 3)
+
+    def test_error_reaches_every_caller(self):
+        gate = _Gate(IOError('connection reset'))
+        threads, results = concurrently([self.lookup(gate)] * 2)
+        self.assertTrue(wait_for(lambda: self.coalesced() == 1))
+        gate.opened.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(gate.sent), 1)
+        self.assertEqual([type(r) for r in results], [IOError, IOError])
+
+    def test_clients_with_different_tokens_are_not_shared(self):
+        # Two paypalrestsdk.Api instances of different merchants.
+        gate = _Gate()
+        threads, results = concurrently([self.lookup(gate, 'Bearer A015'),
+                                         self.lookup(gate, 'Bearer B027')])
+        wait_for(lambda: len(gate.sent) == 2, 0.5)
+        gate.opened.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(gate.sent), ['Bearer A015', 'Bearer B027'])
+        self.assertEqual(results, ['payment seen by Bearer A015',
+                                   'payment seen by Bearer B027'])
+        self.assertEqual(self.coalesced(), 0)
+
+
+class TestIdempotency(EmulatedTestCase):
+
+    def make_policies(self):
+        self.store = IdempotencyStore(self.path('idempotency.sqlite'))
+        return [IdempotencyPolicy(self.store)]
+
+    def test_replays_completed_call(self):
+        token, payer_id = self.checkout()
+        with paypal_transport.idempotent('order-1'):
+            first = self.pay(token, payer_id)
+            second = self.pay(token, payer_id)
+        self.assertEqual(self.emulator.calls['DoExpressCheckoutPayment'], 1)
+        self.assertEqual(first.transactionid, second.transactionid)
+
+    def test_refused_call_may_be_retried(self):
+        token, payer_id = self.checkout()
+        with paypal_transport.idempotent('order-2'):
+            self.assertRaises(PayPalAPIResponseError, self.pay, 'EC-0', payer_id)
+            self.pay(token, payer_id)
+        self.assertEqual(self.emulator.calls['DoExpressCheckoutPayment'], 2)
+
+    def test_duplicate_after_unknown_outcome(self):
+        token, payer_id = self.checkout()
+        self.faults.add(1.0, RESET, methods=['DoExpressCheckoutPayment'])
+        with paypal_transport.idempotent('order-3'):
+            self.assertRaises(BROKEN, self.pay, token, payer_id)
+            del self.faults.rules[:]
+            self.assertRaises(DuplicateRequestError, self.pay, token, payer_id)
+        self.assertEqual(self.emulator.calls.get('DoExpressCheckoutPayment'),
+                         None)
+        self.assertEqual([row[0] for row in self.store.pending()], ['order-3'])
+
+    def test_calls_outside_a_key_are_not_recorded(self):
+        token, payer_id = self.checkout()
+        self.pay(token, payer_id)
+        self.assertEqual(self.store.pending(), [])
+        self.assertEqual(self.store.get(None, 'DoExpressCheckoutPayment'), None)
+
+
+class _CrashAfterSend(Policy):
+    """Sends the call, then fails as a worker dying before the answer is
+    journaled would."""
+    def send(self, exchange, proceed):
+        proceed(exchange)
+        raise IOError('worker died')
+
+
+class TestJournal(EmulatedTestCase):
+
+    def make_policies(self):
+        self.journal = Journal(self.path('journal'), size=4096)
+        return [JournalPolicy(self.journal)]
+
+    def tearDown(self):
+        self.journal.close()
+        EmulatedTestCase.tearDown(self)
+
+    def reopen(self):
+        self.journal.close()
+        self.journal = Journal(self.path('journal'), size=4096)
+
+    def test_answered_calls_are_resolved(self):
+        token, payer_id = self.checkout()
+        self.pay(token, payer_id)
+        self.reopen()
+        self.assertEqual(self.journal.unresolved(), [])
+        self.assertEqual([r['type'] for r in self.journal.records()],
+                         ['intent', 'outcome'])
+
+    def test_recovers_and_reconciles_crashed_call(self):
+        token, payer_id = self.checkout()
+        crash = _CrashAfterSend()
+        self.pipeline.add(crash)
+        self.assertRaises(IOError, self.pay, token, payer_id)
+        # The restarted worker.
+        self.pipeline.remove(crash)
+        self.reopen()
+        unresolved = self.journal.unresolved()
+        self.assertEqual(len(unresolved), 1)
+        self.assertEqual(unresolved[0]['fields']['TOKEN'], token)
+
+        results = paypal_transport.reconcile(self.journal, self.interface)
+        self.assertEqual(len(results), 1)
+        entry, details = results[0]
+        self.assertEqual(details.paymentstatus, 'Completed')
+        self.assertEqual(self.journal.unresolved(), [])
+
+    def test_unknown_outcome_stays_unresolved(self):
+        token, payer_id = self.checkout()
+        self.faults.add(1.0, RESET, methods=['DoExpressCheckoutPayment'])
+        self.assertRaises(BROKEN, self.pay, token, payer_id)
+        self.faults.add(1.0, RESET)
+        results = paypal_transport.reconcile(self.journal, self.interface)
+        self.assertEqual(results[0][1], None)
+        self.assertEqual(len(self.journal.unresolved()), 1)
+
+    def test_compaction_keeps_unresolved_intents(self):
+        for i in range(3):
+            token, payer_id = self.checkout()
+            self.pay(token, payer_id)
+        token, payer_id = self.checkout()
+        self.faults.add(1.0, RESET, methods=['DoExpressCheckoutPayment'])
+        self.assertRaises(BROKEN, self.pay, token, payer_id)
+        self.assertEqual(len(self.journal.records()), 7)
+
+        self.journal.compact()
+        self.reopen()
+        records = self.journal.records()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['fields']['TOKEN'], token)
+
+    def test_grows_when_full(self):
+        del self.faults.rules[:]
+        self.faults.add(1.0, RESET, methods=['DoExpressCheckoutPayment'])
+        tokens = []
+        for i in range(30):
+            token, payer_id = self.checkout()
+            self.assertRaises(BROKEN, self.pay, token, payer_id)
+            tokens.append(token)
+        self.reopen()
+        self.assertEqual([r['fields']['TOKEN'] for r in self.journal.unresolved()],
+                         tokens)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.faults = Faults()
+        self.server = NvpEmulator(faults=self.faults).serve()
+        self.pool = ConnectionPool('%s:%d' % (self.server.host, self.server.port),
+                                   'http', timeout=0.5)
+        # A warm connection for the requests below to reuse.
+        self.post('GetBalance')
+        self.assertEqual(self.server.requests, 1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def post(self, method, resend=True):
+        return self.pool.request('POST', '/nvp',
+                                 'METHOD=%s&USER=u&PWD=p' % method,
+                                 resend=resend)
+
+    def test_timeout_is_not_resent(self):
+        self.faults.add(1.0, HANG)
+        self.assertRaises(socket.timeout, self.post, 'GetBalance')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_unanswered_lookup_is_resent(self):
+        self.faults.add(1.0, RESET)
+        self.assertRaises(BROKEN, self.post, 'GetBalance')
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.pool.created, 2)
+
+    def test_unanswered_capture_is_not_resent(self):
+        self.faults.add(1.0, RESET)
+        self.assertRaises(BROKEN, self.post, 'DoCapture', False)
+        self.assertEqual(self.server.requests, 2)
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bucket_allows_burst_then_waits(self):
+        bucket = TokenBucket(os.path.join(self.directory, 'b'), 10, 2)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        wait = bucket.try_acquire()
+        self.assertTrue(0 < wait <= 0.1, wait)
+
+    def test_bucket_is_shared_through_its_file(self):
+        path = os.path.join(self.directory, 'b')
+        TokenBucket(path, 0.01, 1).try_acquire()
+        self.assertTrue(TokenBucket(path, 0.01, 1).try_acquire() > 0)
+
+    def test_over_budget_call_times_out_unsent(self):
+        policy = RateLimitPolicy(limits={'GetBalance': (0.01, 1)},
+                                 directory=self.directory, timeout=0.1)
+        pipeline = Pipeline([policy])
+        sent = []
+        pipeline.send(Exchange('nvp', 'GetBalance', 'http://paypal/nvp'),
+                      sent.append)
+        self.assertRaises(RateLimitTimeout, pipeline.send,
+                          Exchange('nvp', 'GetBalance', 'http://paypal/nvp'),
+                          sent.append)
+        self.assertEqual(len(sent), 1)
+        # Methods without a limit are not held back.
+        pipeline.send(Exchange('nvp', 'GetTransactionDetails',
+                               'http://paypal/nvp'), sent.append)
+        self.assertEqual(len(sent), 2)
+
+    def test_method_token_is_refunded_when_total_times_out(self):
+        policy = RateLimitPolicy(limits={'GetBalance': (0.01, 2)},
+                                 total=(0.01, 1), directory=self.directory,
+                                 timeout=0)
+        policy.acquire('GetBalance')
+        self.assertRaises(RateLimitTimeout, policy.acquire, 'GetBalance')
+        # One of the two method tokens is left.
+        bucket = policy.bucket('GetBalance')
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertTrue(bucket.try_acquire() > 0)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def limiter(self, **settings):
+        limiter = AdaptiveLimiter('http://paypal', initial_limit=4,
+                                  backoff=0.5, **settings)
+        # Settle the latency baseline at 0.1s.
+        limiter.acquire()
+        limiter.release(False, 0.1)
+        return limiter
+
+    def test_limit_grows_additively(self):
+        limiter = self.limiter()
+        # About one more slot per ``limit`` successful calls.
+        for i in range(5):
+            limiter.acquire()
+            limiter.release(False, 0.1)
+        self.assertEqual(limiter.limit, 5)
+
+    def test_spike_and_failure_cut_the_limit(self):
+        limiter = self.limiter(tolerance=2.0)
+        limiter.acquire()
+        limiter.release(False, 0.5)
+        self.assertEqual(limiter.limit, 2)
+        # Not again within one baseline interval.
+        limiter.acquire()
+        limiter.release(True, 0.1)
+        self.assertEqual(limiter.limit, 2)
+        time.sleep(0.15)
+        limiter.acquire()
+        limiter.release(True, 0.1)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_unsent_call_keeps_the_limit(self):
+        limiter = self.limiter()
+        before = limiter.metrics()['limit']
+        limiter.acquire()
+        limiter.release(None, None)
+        self.assertEqual(limiter.metrics()['limit'], before)
+        self.assertEqual(limiter.inflight, 0)
+
+    def test_callers_beyond_the_limit_wait(self):
+        limiter = AdaptiveLimiter('http://paypal', initial_limit=1)
+        self.assertTrue(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0.05))
+        limiter.release(False, 0.1)
+        self.assertTrue(limiter.acquire(0))
+
+    def test_policy_adapts_to_answers(self):
+        policy = AdaptiveConcurrencyPolicy(initial_limit=4, backoff=0.5)
+        pipeline = Pipeline([policy])
+        def unavailable(exchange):
+            exchange.status = 503
+            return 'Service unavailable'
+        pipeline.send(Exchange('nvp', 'GetBalance', 'http://paypal/nvp'),
+                      unavailable)
+        self.assertEqual(policy.metrics()['http://paypal']['limit'], 2)
+        pipeline.add(_Unsent())
+        self.assertRaises(RateLimitTimeout, pipeline.send,
+                          Exchange('nvp', 'GetBalance', 'http://paypal/nvp'),
+                          unavailable)
+        self.assertEqual(policy.metrics()['http://paypal'],
+                         {'limit': 2, 'inflight': 0, 'queued': 0,
+                          'baseline': None})
+
+
+class TestPriority(unittest.TestCase):
+
+    def test_higher_lanes_go_first(self):
+        dispatcher = PriorityDispatcher(slots=1, reserved={})
+        dispatcher.acquire(NORMAL)
+        order = []
+        def call(name):
+            def run():
+                dispatcher.acquire(name)
+                order.append(name)
+                dispatcher.release()
+            return run
+        names = [BACKGROUND, NORMAL, BACKGROUND, CRITICAL]
+        threads = []
+        for i, name in enumerate(names):
+            threads += concurrently([call(name)])[0]
+            self.assertTrue(wait_for(lambda: sum(
+                dispatcher.metrics()['waiting'].values()) == i + 1))
+        dispatcher.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [CRITICAL, NORMAL, BACKGROUND, BACKGROUND])
+
+    def test_slots_are_reserved_for_higher_lanes(self):
+        dispatcher = PriorityDispatcher(slots=20)
+        self.assertEqual([dispatcher.cap(name)
+                          for name in (CRITICAL, NORMAL, BACKGROUND)],
+                         [20, 16, 10])
+        for i in range(10):
+            self.assertTrue(dispatcher.acquire(BACKGROUND, 0))
+        self.assertFalse(dispatcher.acquire(BACKGROUND, 0))
+        self.assertTrue(dispatcher.acquire(CRITICAL, 0))
+
+    def test_lane_of_a_call(self):
+        policy = PriorityPolicy(lanes={'SetExpressCheckout': CRITICAL})
+        def lane_for(method):
+            return policy.lane_for(Exchange('nvp', method, 'http://paypal/nvp'))
+        self.assertEqual(lane_for('DoCapture'), CRITICAL)
+        self.assertEqual(lane_for('SetExpressCheckout'), CRITICAL)
+        self.assertEqual(lane_for('GetTransactionDetails'), BACKGROUND)
+        self.assertEqual(lane_for('AddressVerify'), NORMAL)
+        with paypal_transport.lane(BACKGROUND):
+            self.assertEqual(lane_for('DoCapture'), BACKGROUND)
+        self.assertRaises(ValueError, paypal_transport.lane('fast').__enter__)
+
+
+class _Delays(object):
+    """Answers the n-th request after ``delays[n]`` seconds, later ones at
+    once."""
+    def __init__(self, *delays):
+        self.delays = list(delays)
+
+    def __call__(self, verb, path, headers, body):
+        delay = self.delays and self.delays.pop(0) or 0
+        return Reply('ACK=Success&TRANSACTIONID=1', delay=delay)
+
+
+class TestHedging(unittest.TestCase):
+    method = 'GetTransactionDetails'
+
+    def hedging(self, **settings):
+        policy = HedgingPolicy(min_samples=2, **settings)
+        for i in range(2):
+            policy.tracker(self.method).add(0.05)
+        return policy
+
+    def lookup(self, pipeline, transmit):
+        return pipeline.send(Exchange('nvp', self.method, 'http://paypal/nvp'),
+                             transmit)
+
+    def serve(self, policy, *delays):
+        server = EmulatorServer(_Delays(*delays)).start()
+        self.addCleanup(server.stop)
+        interface = PayPalInterface(API_USERNAME='test_api1.example.com',
+                                    API_PASSWORD='1234567890',
+                                    API_SIGNATURE='A' * 56,
+                                    pipeline=Pipeline([policy]))
+        interface.config.API_ENDPOINT = server.url('/nvp')
+        return interface
+
+    def test_fast_calls_stay_on_the_callers_thread(self):
+        policy = self.hedging()
+        threads = []
+        def transmit(exchange):
+            threads.append(threading.current_thread())
+            return 'ACK=Success'
+        for i in range(5):
+            self.lookup(Pipeline([policy]), transmit)
+        self.assertEqual(set(threads), set([threading.current_thread()]))
+        self.assertEqual(policy.metrics(), {'calls': 5, 'hedges': 0,
+                                            'hedge_wins': 0})
+
+    def test_hedge_wins_and_slow_call_is_cancelled(self):
+        policy = self.hedging()
+        interface = self.serve(policy, 5)
+        started = time.time()
+        interface.get_transaction_details('1')
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(policy.metrics()['hedge_wins'], 1)
+
+    def test_slow_hedge_is_cancelled(self):
+        # One worker: it is free again for the second call's hedge only
+        # if the first hedge was stopped.
+        policy = self.hedging(budget=1.0, workers=1)
+        interface = self.serve(policy, 0.2, 5, 1)
+        for i in range(2):
+            interface.get_transaction_details('1')
+        self.assertEqual(policy.metrics(), {'calls': 2, 'hedges': 2,
+                                            'hedge_wins': 1})
+
+    def test_budget_caps_hedges(self):
+        policy = self.hedging(budget=0.0)
+        def slow(exchange):
+            time.sleep(0.1)
+            return 'ACK=Success'
+        for i in range(3):
+            self.lookup(Pipeline([policy]), slow)
+        self.assertEqual(policy.metrics()['hedges'], 1)
+
+    def test_hedge_runs_in_the_callers_lane_and_key(self):
+        policy = self.hedging()
+        seen = []
+        def slow(exchange):
+            seen.append((current_lane(), current_key(),
+                         threading.current_thread() is main))
+            time.sleep(0.1)
+            return 'ACK=Success'
+        main = threading.current_thread()
+        with paypal_transport.lane(BACKGROUND):
+            with paypal_transport.idempotent('order-4'):
+                self.lookup(Pipeline([policy]), slow)
+        self.assertEqual(sorted(seen), [(BACKGROUND, 'order-4', False),
+                                        (BACKGROUND, 'order-4', True)])
+
+
+CARD = dict(amt='10.00', creditcardtype='Visa', acct='4812177017895760',
+            expdate='012030', cvv2='962', firstname='John', lastname='Doe')
+
+class TestCassette(EmulatedTestCase):
+
+    def setUp(self):
+        EmulatedTestCase.setUp(self)
+        self.recording = Cassette(self.path('calls.cassette'), RECORD)
+        self.pipeline.add(CassettePolicy(self.recording))
+
+    def replaying(self, **options):
+        """A PayPalInterface answered by the recorded cassette."""
+        self.recording.close()
+        cassette = Cassette(self.path('calls.cassette'), **options)
+        self.addCleanup(cassette.close)
+        interface = PayPalInterface(API_USERNAME='test_api1.example.com',
+                                    API_PASSWORD='1234567890',
+                                    API_SIGNATURE='A' * 56,
+                                    pipeline=Pipeline([CassettePolicy(cassette)]))
+        interface.config.API_ENDPOINT = self.server.url('/nvp')
+        return interface, cassette
+
+    def test_replay(self):
+        token, payer_id = self.checkout()
+        paid = self.pay(token, payer_id)
+        interface, cassette = self.replaying()
+        self.assertEqual(cassette.methods(),
+                         {'SetExpressCheckout': 1,
+                          'GetExpressCheckoutDetails': 1,
+                          'DoExpressCheckoutPayment': 1})
+        sent = self.server.requests
+        answer = interface.do_express_checkout_payment(
+            token, amt='10.00', paymentaction='Sale', payerid=payer_id)
+        self.assertEqual(str(answer), str(paid))
+        self.assertEqual(self.server.requests, sent)
+        self.assertEqual(cassette.replayed, 1)
+
+    def test_unknown_calls_get_an_answer_of_the_method(self):
+        token, payer_id = self.checkout()
+        interface, cassette = self.replaying()
+        answer = interface.get_express_checkout_details('EC-OTHER')
+        self.assertEqual(answer.token, token)
+        self.assertRaises(CassetteMiss, interface.get_transaction_details, '0')
+        self.assertEqual(cassette.misses, 1)
+
+    def test_strict_answers_only_recorded_calls(self):
+        token, payer_id = self.checkout()
+        interface, cassette = self.replaying(strict=True)
+        self.assertEqual(interface.get_express_checkout_details(token).payerid,
+                         payer_id)
+        self.assertRaises(CassetteMiss,
+                          interface.get_express_checkout_details, 'EC-OTHER')
+
+    def test_credentials_and_card_are_masked(self):
+        self.interface.do_direct_payment(**CARD)
+        interface, cassette = self.replaying()
+        data = open(self.path('calls.cassette'), 'rb').read()
+        for secret in ('1234567890', 'A' * 56, CARD['acct'], 'CVV2=962'):
+            self.assertFalse(secret in data, secret)
+        record, = cassette.records()
+        self.assertEqual(record['method'], 'DoDirectPayment')
+        self.assertTrue('ACCT=***' in record['body'])
+        self.assertFalse('KWARGS' in record['body'])
+        # The masked fields do not count in the fingerprint.
+        self.assertEqual(interface.do_direct_payment(**CARD).ack, 'Success')
+        self.assertEqual(cassette.replayed, 1)
+
+    def test_unclosed_cassette_is_scanned(self):
+        self.checkout()
+        self.recording.close()
+        path = self.path('calls.cassette')
+        data = open(path, 'rb').read()
+        index, length, end = _FOOTER.unpack_from(data, len(data) - _FOOTER.size)
+        # Crashed while writing the last record.
+        open(path, 'wb').write(data[:index - 5])
+        interface, cassette = self.replaying()
+        self.assertEqual(cassette.methods(), {'SetExpressCheckout': 1})
+
+
+class _Flaky(object):
+    """A transmit function failing with ``failures``, in turn, then answering."""
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.sent = 0
+
+    def __call__(self, exchange):
+        self.sent += 1
+        if self.failures:
+            failure = self.failures.pop(0)
+            if isinstance(failure, int):
+                exchange.status = failure
+                exchange.content = 'Service unavailable'
+                return exchange.content
+            raise failure
+        exchange.status = 200
+        exchange.content = 'ACK=Success'
+        return exchange.content
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.retry = RetryPolicy(attempts=3, backoff=0.001)
+        self.pipeline = Pipeline([self.retry])
+
+    def call(self, transmit, method='GetTransactionDetails', service='nvp',
+             headers=None):
+        return self.pipeline.send(
+            Exchange(service, method, 'http://paypal/nvp', None, headers),
+            transmit)
+
+    def test_lookups_are_retried(self):
+        transmit = _Flaky(socket.error(104, 'reset'), 503)
+        self.assertEqual(self.call(transmit), 'ACK=Success')
+        self.assertEqual((transmit.sent, self.retry.retries), (3, 2))
+
+    def test_up_to_attempts(self):
+        transmit = _Flaky(*[socket.timeout('timed out')] * 3)
+        self.assertRaises(socket.timeout, self.call, transmit)
+        self.assertEqual(transmit.sent, 3)
+        transmit = _Flaky(503, 503, 503)
+        self.assertEqual(self.call(transmit), 'Service unavailable')
+        self.assertEqual(transmit.sent, 3)
+
+    def test_money_moving_calls_are_sent_once(self):
+        transmit = _Flaky(socket.error(104, 'reset'))
+        self.assertRaises(socket.error, self.call, transmit, 'DoCapture')
+        self.assertEqual(transmit.sent, 1)
+
+    def test_rest_calls_with_a_request_id(self):
+        method = 'POST v1/payments/payment'
+        transmit = _Flaky(socket.error(104, 'reset'))
+        self.assertEqual(self.call(transmit, method, 'rest',
+                                   {'PayPal-Request-Id': 'order-5'}),
+                         'ACK=Success')
+        transmit = _Flaky(socket.error(104, 'reset'))
+        self.assertRaises(socket.error, self.call, transmit, method, 'rest')
+
+    def test_client_errors_are_not_retried(self):
+        transmit = _Flaky(urllib2.HTTPError('http://paypal/nvp', 400,
+                                            'Bad Request', {}, None))
+        self.assertRaises(urllib2.HTTPError, self.call, transmit)
+        self.assertEqual(transmit.sent, 1)
+
+    def test_methods(self):
+        self.retry.methods = frozenset(['GetBalance'])
+        transmit = _Flaky(socket.error(104, 'reset'))
+        self.assertRaises(socket.error, self.call, transmit)
+        self.assertEqual(self.call(_Flaky(503), 'GetBalance'), 'ACK=Success')
+
+
+class _Record(Policy):
+    """Notes ``name`` in ``seen`` on the way in."""
+    def __init__(self, name, seen):
+        self.name = name
+        self.seen = seen
+
+    def send(self, exchange, proceed):
+        self.seen.append(self.name)
+        return proceed(exchange)
+
+
+class TestTransports(unittest.TestCase):
+
+    def test_memory_answers(self):
+        transport = MemoryTransport(
+            {'GetBalance': 'ACK=Success&L_AMT0=10.00',
+             'GetTransactionDetails':
+                 lambda fields: 'ACK=Success&TRANSACTIONID=' +
+                                fields['TRANSACTIONID']})
+        self.assertEqual(transport.get_response(
+            'http://paypal/nvp', 'METHOD=GetBalance'),
+            'ACK=Success&L_AMT0=10.00')
+        self.assertEqual(transport.get_response(
+            'http://paypal/nvp', 'METHOD=GetTransactionDetails&TRANSACTIONID=7'),
+            'ACK=Success&TRANSACTIONID=7')
+        self.assertEqual(transport.get_response(
+            'http://paypal/nvp', 'METHOD=DoVoid'), 'ACK=Success')
+        self.assertEqual(transport.calls, {'GetBalance': 1, 'DoVoid': 1,
+                                           'GetTransactionDetails': 1})
+
+    def test_chain_order(self):
+        seen = []
+        memory = MemoryTransport()
+        inner = ChainTransport(memory, [_Record('inner', seen)])
+        chain = ChainTransport(inner, [_Record('first', seen)])
+        chain.add(_Record('second', seen))
+        self.assertEqual(chain.get_response('http://paypal/nvp',
+                                            'METHOD=GetBalance'), 'ACK=Success')
+        self.assertEqual(seen, ['first', 'second', 'inner'])
+        self.assertEqual(memory.calls, {'GetBalance': 1})
+
+    def test_chain_retries(self):
+        retry = RetryPolicy(backoff=0.001)
+        flaky = _Flaky(socket.error(104, 'reset'))
+        class FlakyTransport(MemoryTransport):
+            def send(self, exchange):
+                return flaky(exchange)
+        chain = ChainTransport(FlakyTransport(), [retry])
+        self.assertEqual(chain.send(Exchange('nvp', 'GetBalance',
+                                             'http://paypal/nvp')),
+                         'ACK=Success')
+        self.assertEqual(retry.retries, 1)
+        self.assertRaises(ValueError, ChainTransport, flaky)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_policy_state(self):
+        pipeline = Pipeline([AdaptiveConcurrencyPolicy(initial_limit=4),
+                             CoalescingPolicy(), HedgingPolicy(),
+                             CircuitBreakerPolicy()])
+        policy = pipeline.insert(0, MetricsPolicy(pipeline=pipeline))
+        pipeline.send(Exchange('nvp', 'GetTransactionDetails',
+                               'http://paypal/nvp'), _Flaky())
+        lines = policy.render().splitlines()
+        for line in ('paypal_concurrency_limit{endpoint="http://paypal"} 4',
+                     'paypal_concurrency_queued{endpoint="http://paypal"} 0',
+                     'paypal_coalesced_total{method="GetTransactionDetails"} 0',
+                     'paypal_hedges_total 0',
+                     'paypal_circuit_breaker_state{endpoint="http://paypal",'
+                     'state="closed"} 1',
+                     'paypal_circuit_breaker_state{endpoint="http://paypal",'
+                     'state="open"} 0'):
+            self.assertTrue(line in lines, line)
+
+    def test_per_process_without_fcntl(self):
+        self.addCleanup(setattr, metrics, 'fcntl', metrics.fcntl)
+        self.addCleanup(setattr, metrics, '_installed', metrics._installed)
+        metrics.fcntl = None
+        metrics._installed = None
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        policy = metrics.install(os.path.join(directory, 'metrics.shm'),
+                                 Pipeline())
+        self.assertEqual(policy.shared, None)
+        self.assertEqual(os.listdir(directory), [])
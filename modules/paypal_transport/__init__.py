@@ -0,0 +1,36 @@
+# coding=utf-8
+"""
+Transport layer shared by the paypal, paypalnvp and paypalrestsdk client
+stacks. Every outbound API call is wrapped in an Exchange and sent through a
+Pipeline of policies.
+"""
+import logging
+
+# Breaker transitions and failing hooks are logged; stay quiet about it
+# when the application has not configured logging.
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+from exchange import Exchange, READ_ONLY_METHODS, MONEY_MOVING_METHODS
+from pool import ConnectionPool
+from pipeline import Policy, Pipeline, default as default_pipeline, set_pipeline
+from hooks import Hooks, default as default_hooks
+from timing import Timings, TimedHTTPConnection, TimedHTTPSConnection, \
+    TimedHTTPHandler, TimedHTTPSHandler
+from breaker import CircuitBreaker, CircuitBreakerPolicy, CLOSED, OPEN, HALF_OPEN
+from ratelimit import TokenBucket, RateLimitPolicy
+from concurrency import AdaptiveLimiter, AdaptiveConcurrencyPolicy
+from priority import PriorityDispatcher, PriorityPolicy, lane, \
+    CRITICAL, NORMAL, BACKGROUND
+from hedging import HedgingPolicy
+from retry import RetryPolicy
+from coalescing import CoalescingPolicy
+from idempotency import IdempotencyStore, IdempotencyPolicy, idempotent
+from journal import Journal, JournalPolicy, reconcile
+from cassette import Cassette, CassettePolicy, CassetteMiss, RECORD, REPLAY
+from log import Redactor, ExchangeLogger, redact, install as install_logging
+from profiling import Flow, profile, enable as enable_profiling, \
+    disable as disable_profiling
+from metrics import Registry, SharedMetrics, MetricsPolicy, \
+    install as install_metrics
+from exceptions import TransportError, CircuitOpenError, RateLimitTimeout, \
+    ConcurrencyLimitTimeout, DuplicateRequestError, RequestCancelled
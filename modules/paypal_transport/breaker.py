@@ -0,0 +1,193 @@
+# coding=utf-8
+"""
+Per-endpoint circuit breaking. When PayPal degrades, requests to the affected
+endpoint fail fast with CircuitOpenError instead of each worker waiting out
+the full HTTP timeout.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+
+from pipeline import Policy
+from exceptions import CircuitOpenError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of the last ``window`` calls to one endpoint.
+
+    The breaker opens once at least ``minimum_calls`` were seen and either
+    the share of failed calls reaches ``failure_rate`` or the share of calls
+    slower than ``slow_call_duration`` seconds reaches ``slow_call_rate``.
+    After ``open_timeout`` seconds it lets ``half_open_probes`` requests
+    through; if they all succeed it closes again, a single failure re-opens
+    it.
+    """
+    def __init__(self, name, failure_rate=0.5, slow_call_duration=None,
+                 slow_call_rate=0.5, window=20, minimum_calls=10,
+                 open_timeout=30, half_open_probes=3):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.minimum_calls = minimum_calls
+        self.open_timeout = open_timeout
+        self.half_open_probes = half_open_probes
+
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes_started = 0
+        self._probes_passed = 0
+
+    def __str__(self):
+        return "<CircuitBreaker %s %s>" % (self.name, self._state)
+
+    def state(self):
+        with self._lock:
+            self._refresh()
+            return self._state
+    state = property(state)
+
+    def allow(self):
+        """
+        Raises CircuitOpenError if a request may not be sent right now.
+        Every allowed request must be followed by a call to record(), or to
+        release() if it was not sent after all.
+        """
+        with self._lock:
+            self._refresh()
+            if self._state == CLOSED:
+                return
+            if (self._state == HALF_OPEN and
+                    self._probes_started < self.half_open_probes):
+                self._probes_started += 1
+                return
+            if self._state == OPEN:
+                retry_after = self._opened_at + self.open_timeout - time.time()
+            else:
+                retry_after = 0
+        raise CircuitOpenError(self.name, max(retry_after, 0))
+
+    def record(self, failed, elapsed):
+        """Records the outcome of a request that allow() let through."""
+        slow = (self.slow_call_duration is not None and
+                elapsed is not None and elapsed >= self.slow_call_duration)
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probes_passed += 1
+                    if self._probes_passed >= self.half_open_probes:
+                        self._transition(CLOSED)
+            elif self._state == CLOSED:
+                self._outcomes.append((failed, slow))
+                if self._tripped():
+                    self._transition(OPEN)
+
+    def release(self):
+        """Gives back the probe of a request that allow() let through but
+        was not sent."""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes_started > 0:
+                self._probes_started -= 1
+
+    def reset(self):
+        """Forces the breaker back to closed and forgets all outcomes."""
+        with self._lock:
+            self._transition(CLOSED)
+
+    def _tripped(self):
+        calls = len(self._outcomes)
+        if calls < self.minimum_calls:
+            return False
+        failures = len([o for o in self._outcomes if o[0]])
+        slows = len([o for o in self._outcomes if o[1]])
+        if float(failures) / calls >= self.failure_rate:
+            return True
+        return (self.slow_call_duration is not None and
+                float(slows) / calls >= self.slow_call_rate)
+
+    def _refresh(self):
+        if (self._state == OPEN and
+                time.time() - self._opened_at >= self.open_timeout):
+            self._transition(HALF_OPEN)
+
+    def _transition(self, state):
+        # Must be called with self._lock held.
+        old, self._state = self._state, state
+        self._outcomes.clear()
+        self._probes_started = 0
+        self._probes_passed = 0
+        if state == OPEN:
+            self._opened_at = time.time()
+        if old == state:
+            return
+        logging.getLogger(__name__).warning(
+            'Circuit %s: %s -> %s', self.name, old, state)
+        for listener in self.listeners:
+            try:
+                listener(self, old, state)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'Circuit breaker listener failed')
+
+
+class CircuitBreakerPolicy(Policy):
+    """
+    Pipeline policy keeping one CircuitBreaker per endpoint (scheme and
+    host). Keyword arguments are passed on to every CircuitBreaker created.
+
+    ``listeners`` are called as ``listener(breaker, old_state, new_state)``
+    on every state change, which is the place to hook alerting in.
+    """
+    def __init__(self, listeners=None, **settings):
+        self.settings = settings
+        self.listeners = list(listeners or [])
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        """Returns the breaker for ``endpoint``, creating it on first use."""
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(endpoint)
+                if breaker is None:
+                    breaker = CircuitBreaker(endpoint, **self.settings)
+                    breaker.listeners = self.listeners
+                    self._breakers[endpoint] = breaker
+        return breaker
+
+    def breakers(self):
+        """Returns all breakers created so far, keyed by endpoint."""
+        return dict(self._breakers)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def send(self, exchange, proceed):
+        breaker = self.breaker(exchange.endpoint)
+        breaker.allow()
+        attempts = exchange.attempts
+        try:
+            result = proceed(exchange)
+        except Exception:
+            # Errors raised before anything was sent (rate and concurrency
+            # limits, cassette misses) and cancelled requests say nothing
+            # about the endpoint.
+            if exchange.attempts == attempts or exchange.cancelled:
+                breaker.release()
+            else:
+                breaker.record(True, exchange.elapsed)
+            raise
+        breaker.record(exchange.failed, exchange.elapsed)
+        return result
@@ -0,0 +1,288 @@
+# coding=utf-8
+"""
+Record/replay of API traffic, to load test with production-shaped payloads
+without contacting PayPal.
+
+In record mode a Cassette appends every answered exchange to a file:
+method, URL, request body and answer, with credentials and card data masked
+by a log.Redactor, answers over ``compress_over`` bytes zlib compressed. An
+index of the records by method and request fingerprint is written when the
+cassette is closed; a cassette left unclosed by a crash is indexed by
+scanning it when it is opened.
+
+In replay mode the file is memory-mapped and exchanges are answered from
+it: the record with the same method and request fingerprint if there is
+one, else the next record of the same method, round robin, so a load test
+with fresh tokens and ids still gets answers of the recorded size and shape.
+``pace`` replays the recorded response times, scaled.
+
+CassettePolicy plugs a cassette into a Pipeline, for paypal.PayPalInterface
+and paypalrestsdk.api.Api; paypalnvp.core.CassetteTransport into
+paypalnvp.core.PayPal.
+"""
+
+import re
+import json
+import mmap
+import time
+import zlib
+import struct
+import itertools
+import threading
+from urllib import urlencode
+from urlparse import urlsplit, parse_qsl
+
+from log import Redactor
+from pipeline import Policy
+from exceptions import TransportError
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+_MAGIC = 'PPCASS01'
+_END = 'PPCASEND'
+# fingerprint, status, flags, method, url, body and content lengths, elapsed
+_RECORD = struct.Struct('<IHBHIIId')
+# index offset and length
+_FOOTER = struct.Struct('<QI8s')
+_COMPRESSED = 1
+
+_nvp_method = re.compile(r'(?:^|&)METHOD=([^&]*)')
+
+# Fields that differ between the recording and the replaying environment.
+_UNMATCHED_FIELDS = frozenset(['USER', 'PWD', 'SIGNATURE', 'SUBJECT'])
+
+class CassetteMiss(TransportError):
+    """Raised when a cassette holds no answer for a replayed call."""
+    def __init__(self, method):
+        self.method = method
+
+    def __str__(self):
+        return "No recorded answer for %s" % self.method
+
+
+class Cassette(object):
+    """
+    The cassette file at ``path``, opened to ``mode`` RECORD or REPLAY.
+
+    Replay options: with ``strict``, only calls with the same fingerprint
+    as a recorded one are answered, others raise CassetteMiss; ``pace``
+    sleeps the recorded response time multiplied by it before answering
+    (1.0 for the original timing, None to answer at once).
+    """
+    def __init__(self, path, mode=REPLAY, redactor=None, strict=False,
+                 pace=None, compress_over=512):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError('mode must be RECORD or REPLAY')
+        self.path = path
+        self.mode = mode
+        self.redactor = redactor or Redactor()
+        self.strict = strict
+        self.pace = pace
+        self.compress_over = compress_over
+        self.replayed = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # method: [(fingerprint, offset)], in recording order.
+        self._index = {}
+        if mode == RECORD:
+            self._file = open(path, 'wb')
+            self._file.write(_MAGIC)
+            self._end = len(_MAGIC)
+        else:
+            self._file = open(path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            self._index = self._read_index()
+            self._exact = {}
+            self._next = {}
+            for method, entries in self._index.items():
+                offsets = []
+                for fingerprint, offset in entries:
+                    self._exact.setdefault((method, fingerprint),
+                                           []).append(offset)
+                    offsets.append(offset)
+                self._next[method] = itertools.cycle(offsets).next
+            for key, offsets in self._exact.items():
+                self._exact[key] = itertools.cycle(offsets).next
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._index.values())
+
+    def methods(self):
+        """The recorded calls per method."""
+        return dict((method, len(entries))
+                    for method, entries in self._index.items())
+
+    def record(self, exchange):
+        """Appends the answered ``exchange``."""
+        redact = self.redactor.text
+        name = _method(exchange)
+        method = name.encode('utf-8')
+        url = redact(exchange.url).encode('utf-8')
+        body = _bytes(redact(exchange.body))
+        content = _bytes(redact(exchange.content))
+        flags = 0
+        if len(content) > self.compress_over:
+            content = zlib.compress(content, 6)
+            flags |= _COMPRESSED
+        fingerprint = _fingerprint(exchange.service, url, body)
+        data = _RECORD.pack(fingerprint, exchange.status or 200, flags,
+                            len(method), len(url), len(body), len(content),
+                            exchange.elapsed or 0.0) + \
+            method + url + body + content
+        with self._lock:
+            self._file.write(data)
+            self._index.setdefault(name, []).append(
+                (fingerprint, self._end))
+            self._end += len(data)
+
+    def replay(self, exchange):
+        """Answers ``exchange`` from the cassette and returns the content."""
+        url = self.redactor.text(exchange.url).encode('utf-8')
+        body = _bytes(self.redactor.text(exchange.body))
+        fingerprint = _fingerprint(exchange.service, url, body)
+        name = _method(exchange)
+        next_offset = self._exact.get((name, fingerprint))
+        if next_offset is None and not self.strict:
+            next_offset = self._next.get(name)
+        if next_offset is None:
+            self.misses += 1
+            raise CassetteMiss(name)
+        _, status, elapsed, content = self._read(next_offset())
+        if self.pace:
+            time.sleep(elapsed * self.pace)
+        self.replayed += 1
+        exchange.status = status
+        exchange.content = content
+        exchange.replayed = True
+        return content
+
+    def records(self):
+        """
+        Yields the records of a replaying cassette, in recording order, as
+        dicts with method, url, body, status, content and elapsed.
+        """
+        offsets = sorted(offset for entries in self._index.values()
+                         for _, offset in entries)
+        for offset in offsets:
+            (fingerprint, status, flags, method_len, url_len, body_len,
+             content_len, elapsed) = _RECORD.unpack_from(self._map, offset)
+            start = offset + _RECORD.size
+            method = self._map[start:start + method_len]
+            start += method_len
+            url = self._map[start:start + url_len]
+            start += url_len
+            body = self._map[start:start + body_len]
+            yield {'method': method.decode('utf-8'), 'url': url,
+                   'body': body, 'status': status,
+                   'content': self._read(offset)[3], 'elapsed': elapsed}
+
+    def close(self):
+        """Writes the index of a recording cassette, and closes the file."""
+        with self._lock:
+            if self._file.closed:
+                return
+            if self.mode == RECORD:
+                index = zlib.compress(json.dumps(self._index,
+                                                 separators=(',', ':')))
+                self._file.write(index)
+                self._file.write(_FOOTER.pack(self._end, len(index), _END))
+            else:
+                self._map.close()
+            self._file.close()
+
+    def _read(self, offset):
+        (fingerprint, status, flags, method_len, url_len, body_len,
+         content_len, elapsed) = _RECORD.unpack_from(self._map, offset)
+        start = offset + _RECORD.size + method_len + url_len + body_len
+        content = self._map[start:start + content_len]
+        if flags & _COMPRESSED:
+            content = zlib.decompress(content)
+        return fingerprint, status, elapsed, content
+
+    def _read_index(self):
+        data = self._map
+        if data[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('%s is not a cassette' % self.path)
+        if len(data) >= len(_MAGIC) + _FOOTER.size:
+            offset, length, end = _FOOTER.unpack_from(
+                data, len(data) - _FOOTER.size)
+            if end == _END:
+                return dict((method, [tuple(entry) for entry in entries])
+                            for method, entries in json.loads(
+                                zlib.decompress(data[offset:offset + length]))
+                            .items())
+        return self._scan()
+
+    def _scan(self):
+        # Not closed: index the complete records, drop a torn last one.
+        index = {}
+        offset = len(_MAGIC)
+        while offset + _RECORD.size <= len(self._map):
+            fields = _RECORD.unpack_from(self._map, offset)
+            size = _RECORD.size + sum(fields[3:7])
+            if offset + size > len(self._map):
+                break
+            start = offset + _RECORD.size
+            method = self._map[start:start + fields[3]].decode('utf-8')
+            index.setdefault(method, []).append((fields[0], offset))
+            offset += size
+        return index
+
+
+class CassettePolicy(Policy):
+    """
+    Pipeline policy recording every answered exchange into ``cassette``, or
+    answering from it without sending anything, depending on the cassette's
+    mode. Put it first in the pipeline, so replayed calls skip the other
+    policies.
+    """
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def send(self, exchange, proceed):
+        if self.cassette.mode == REPLAY:
+            return self.cassette.replay(exchange)
+        result = proceed(exchange)
+        if exchange.content is not None and exchange.error is None:
+            self.cassette.record(exchange)
+        return result
+
+
+def _method(exchange):
+    # Exchanges made by Transport.get_response carry no method.
+    if exchange.method is None and exchange.service == 'nvp':
+        match = _nvp_method.search(exchange.body or '')
+        return match and match.group(1) or ''
+    return exchange.method or ''
+
+def _bytes(text):
+    if text is None:
+        return ''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def _fingerprint(service, url, body):
+    """A checksum of the request, blind to credentials and field order."""
+    if service == 'nvp':
+        pairs = sorted((name, value) for name, value in
+                       parse_qsl(body, keep_blank_values=True)
+                       if name not in _UNMATCHED_FIELDS)
+        request = urlencode(pairs)
+    else:
+        parts = urlsplit(url)
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True) if body else ''
+        except ValueError:
+            pass
+        request = '%s?%s %s' % (parts.path, parts.query, body)
+    return zlib.crc32(request) & 0xffffffff
@@ -0,0 +1,84 @@
+# coding=utf-8
+"""
+Single-flight coalescing of identical read-only calls. When many threads ask
+for the same transaction at once, only one request goes out and every caller
+gets its answer, or its exception.
+"""
+
+import time
+import threading
+
+from pipeline import Policy
+
+class _Flight(object):
+    """One in-flight call and the callers waiting for it."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.exchange = None
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class CoalescingPolicy(Policy):
+    """
+    Pipeline policy letting concurrent read-only exchanges with the same
+    verb, URL, body and credentials share one request. Calls that change
+    state are always sent on their own.
+
+    metrics() reports, per method, the number of calls seen, how many of
+    them were absorbed by joining another caller's request, and the total
+    seconds those callers waited.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def metrics(self):
+        with self._lock:
+            return dict((method, dict(stats))
+                        for method, stats in self._stats.items())
+
+    def send(self, exchange, proceed):
+        if not exchange.read_only:
+            return proceed(exchange)
+
+        # NVP credentials are part of the body, REST ones of the headers.
+        key = (exchange.verb, exchange.url, exchange.body,
+               exchange.headers.get('Authorization'),
+               exchange.headers.get('PayPal-Auth-Assertion'))
+        with self._lock:
+            stats = self._stats.setdefault(exchange.method, {
+                'calls': 0, 'coalesced': 0, 'wait_seconds': 0.0 })
+            stats['calls'] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+                stats['coalesced'] += 1
+
+        if leader:
+            try:
+                flight.result = proceed(exchange)
+            except Exception as e:
+                flight.error = e
+            finally:
+                flight.exchange = exchange
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        started = time.time()
+        flight.done.wait()
+        with self._lock:
+            stats['wait_seconds'] += time.time() - started
+        exchange.adopt(flight.exchange)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
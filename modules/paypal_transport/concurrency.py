@@ -0,0 +1,162 @@
+# coding=utf-8
+"""
+Adaptive concurrency limiting. Instead of a fixed number of threads talking
+to PayPal, the number of calls in flight follows PayPal's latency: it grows
+additively while responses stay close to the baseline and is cut
+multiplicatively on latency spikes and 5xx answers (AIMD).
+"""
+
+import time
+import threading
+
+from pipeline import Policy
+from exceptions import ConcurrencyLimitTimeout
+
+class AdaptiveLimiter(object):
+    """
+    AIMD limit on concurrent calls to one endpoint.
+
+    The baseline is a slow moving average of observed latency. A call
+    counts as a spike when it takes longer than ``tolerance`` times the
+    baseline. Successful calls raise the limit by about one per ``limit``
+    calls; a spike or failure multiplies it by ``backoff``, at most once per
+    baseline interval so one burst of slow answers does not collapse it.
+    """
+    def __init__(self, name, initial_limit=10, min_limit=1, max_limit=200,
+                 tolerance=2.0, backoff=0.7, smoothing=0.02):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+
+        self._limit = float(initial_limit)
+        self._inflight = 0
+        self._queued = 0
+        self._baseline = None
+        self._last_decrease = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def limit(self):
+        return int(self._limit)
+    limit = property(limit)
+
+    def inflight(self):
+        return self._inflight
+    inflight = property(inflight)
+
+    def queued(self):
+        return self._queued
+    queued = property(queued)
+
+    def metrics(self):
+        """Current limit, calls in flight, callers queued and baseline."""
+        with self._cond:
+            return {
+                'limit': int(self._limit),
+                'inflight': self._inflight,
+                'queued': self._queued,
+                'baseline': self._baseline,
+            }
+
+    def acquire(self, timeout=None):
+        """
+        Waits for a free slot. Returns False if none became free within
+        ``timeout`` seconds, True otherwise. Every successful acquire must be
+        paired with a call to release().
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._queued += 1
+            try:
+                while self._inflight >= int(self._limit):
+                    if deadline is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self._inflight += 1
+                return True
+            finally:
+                self._queued -= 1
+
+    def release(self, failed=None, elapsed=None):
+        """
+        Frees a slot and adjusts the limit from the call's outcome. With
+        ``failed`` None the call was not sent and the limit is kept.
+        """
+        with self._cond:
+            self._inflight -= 1
+            if failed is None:
+                self._cond.notify_all()
+                return
+            now = time.time()
+            if elapsed is not None and not failed:
+                if self._baseline is None:
+                    self._baseline = elapsed
+                else:
+                    self._baseline += self.smoothing * (elapsed - self._baseline)
+            spike = (elapsed is not None and self._baseline is not None and
+                     elapsed > self._baseline * self.tolerance)
+            if failed or spike:
+                if now - self._last_decrease >= (self._baseline or 0):
+                    self._limit = max(self.min_limit,
+                                      self._limit * self.backoff)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self.max_limit,
+                                  self._limit + 1.0 / self._limit)
+            self._cond.notify_all()
+
+
+class AdaptiveConcurrencyPolicy(Policy):
+    """
+    Pipeline policy keeping one AdaptiveLimiter per endpoint. Callers beyond
+    the current limit queue for up to ``timeout`` seconds, after which
+    ConcurrencyLimitTimeout is raised. Keyword arguments are passed on to
+    every AdaptiveLimiter created.
+    """
+    def __init__(self, timeout=10, **settings):
+        self.timeout = timeout
+        self.settings = settings
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, endpoint):
+        """Returns the limiter for ``endpoint``, creating it on first use."""
+        limiter = self._limiters.get(endpoint)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(endpoint)
+                if limiter is None:
+                    limiter = AdaptiveLimiter(endpoint, **self.settings)
+                    self._limiters[endpoint] = limiter
+        return limiter
+
+    def metrics(self):
+        """Limiter metrics keyed by endpoint."""
+        return dict((endpoint, limiter.metrics())
+                    for endpoint, limiter in self._limiters.items())
+
+    def send(self, exchange, proceed):
+        limiter = self.limiter(exchange.endpoint)
+        if not limiter.acquire(self.timeout):
+            raise ConcurrencyLimitTimeout(exchange.endpoint, limiter.limit)
+        attempts = exchange.attempts
+        failed = None
+        try:
+            result = proceed(exchange)
+            failed = exchange.failed
+            return result
+        except Exception:
+            # Only calls that reached PayPal tell about its latency; local
+            # errors (rate limits, cassette misses) and cancelled requests
+            # leave the limit alone.
+            if exchange.attempts != attempts and not exchange.cancelled:
+                failed = True
+            raise
+        finally:
+            limiter.release(failed, exchange.elapsed)
@@ -0,0 +1,79 @@
+# coding=utf-8
+"""
+Errors raised by the transport layer itself, as opposed to errors coming back
+from the PayPal APIs.
+"""
+
+class TransportError(Exception):
+    """
+    Base class for everything the transport pipeline raises on its own
+    account. The client stacks let these propagate unchanged.
+    """
+    pass
+
+
+class CircuitOpenError(TransportError):
+    """
+    Raised instead of sending a request while the circuit breaker for the
+    endpoint is open.
+    """
+    def __init__(self, endpoint, retry_after):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "Circuit open for %s, retry in %.1fs" % (self.endpoint,
+                                                        self.retry_after)
+
+
+class RateLimitTimeout(TransportError):
+    """
+    Raised when a request could not get a rate limit token before its
+    deadline.
+    """
+    def __init__(self, method, timeout):
+        self.method = method
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Rate limit for %s not available within %ss" % (self.method,
+                                                               self.timeout)
+
+
+class ConcurrencyLimitTimeout(TransportError):
+    """
+    Raised when a request waited too long for a slot under the adaptive
+    concurrency limit.
+    """
+    def __init__(self, endpoint, limit):
+        self.endpoint = endpoint
+        self.limit = limit
+
+    def __str__(self):
+        return "No free slot for %s (limit %d)" % (self.endpoint, self.limit)
+
+
+class DuplicateRequestError(TransportError):
+    """
+    Raised when a money moving NVP call is attempted again under an
+    idempotency key whose earlier attempt has no known outcome.
+    """
+    def __init__(self, key, method):
+        self.key = key
+        self.method = method
+
+    def __str__(self):
+        return "%s for %s was already sent, outcome unknown" % (self.method,
+                                                                self.key)
+
+
+class RequestCancelled(TransportError):
+    """
+    Raised by a request that was cancelled with Exchange.cancel(), for
+    instance the slower attempt of a hedged call.
+    """
+    def __init__(self, method):
+        self.method = method
+
+    def __str__(self):
+        return "%s was cancelled" % self.method
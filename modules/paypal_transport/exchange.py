@@ -0,0 +1,177 @@
+# coding=utf-8
+"""
+The Exchange object describes a single outbound API call while it travels
+through the transport pipeline.
+"""
+
+import re
+import threading
+from urlparse import urlsplit
+
+from exceptions import RequestCancelled
+
+# NVP methods that never change state at PayPal. REST calls are read-only
+# when they use GET.
+READ_ONLY_METHODS = frozenset([
+    'GetTransactionDetails',
+    'GetExpressCheckoutDetails',
+    'GetBalance',
+    'TransactionSearch',
+    'AddressVerify',
+])
+
+# Calls that move or commit money, in NVP METHOD or REST method form.
+MONEY_MOVING_METHODS = frozenset([
+    'DoCapture',
+    'DoDirectPayment',
+    'DoExpressCheckoutPayment',
+    'DoAuthorization',
+    'DoVoid',
+    'RefundTransaction',
+    'POST v1/payments/payment',
+    'POST v1/payments/payment/{id}/execute',
+    'POST v1/payments/sale/{id}/refund',
+])
+
+_ack = re.compile(r'(?:^|&)ACK=([A-Za-z]+)')
+
+# The exchange each thread is transmitting, for the connections it opens.
+_local = threading.local()
+# Guards the connections of all exchanges against cancel().
+_connections_lock = threading.Lock()
+
+def current():
+    """The Exchange the calling thread is transmitting, or None."""
+    return getattr(_local, 'exchange', None)
+
+def set_current(exchange):
+    """Makes ``exchange`` the one the calling thread transmits; returns the
+    previous one."""
+    previous = getattr(_local, 'exchange', None)
+    _local.exchange = exchange
+    return previous
+
+class Exchange(object):
+    """
+    One request/response pair. The client stacks create an Exchange per API
+    call and hand it to a Pipeline; policies read the request side and the
+    transmit function fills in the response side.
+    """
+    def __init__(self, service, method, url, body=None, headers=None,
+                 verb='POST'):
+        """
+        ``service`` is 'nvp' or 'rest'. ``method`` is the NVP METHOD name, or
+        the HTTP verb plus path template for REST calls, for example
+        'POST v1/payments/payment/{id}/execute'. ``verb`` is the HTTP verb.
+        """
+        self.service = service
+        self.method = method
+        self.verb = verb
+        self.url = url
+        self.body = body
+        self.headers = headers or {}
+        parts = urlsplit(url)
+        self.endpoint = "%s://%s" % (parts.scheme, parts.netloc)
+
+        # Filled in by the transmit function.
+        self.status = None
+        self.response = None
+        self.content = None
+        self.error = None
+        # True when the response was served locally instead of by PayPal.
+        self.replayed = False
+        # timing.Timings of the HTTP request, when the transport measured it.
+        self.timings = None
+
+        # Filled in by the pipeline, in seconds.
+        self.started = None
+        self.elapsed = None
+        # Times this exchange was transmitted; more than one means retries.
+        self.attempts = 0
+        # Set by cancel(); the connections carrying the request meanwhile.
+        self.cancelled = False
+        self._connections = []
+
+    def __str__(self):
+        return "<Exchange %s %s %s>" % (self.service, self.method, self.status)
+
+    def copy(self):
+        """Returns a new Exchange for the same request, without a response."""
+        return Exchange(self.service, self.method, self.url, self.body,
+                        dict(self.headers), self.verb)
+
+    def adopt(self, other):
+        """Takes over the response side of ``other``, an Exchange for the same request."""
+        for name in ('status', 'response', 'content', 'error', 'replayed',
+                     'started', 'elapsed', 'timings', 'attempts'):
+            setattr(self, name, getattr(other, name))
+
+    def cancel(self):
+        """
+        Stops the request: the connection it is being sent or answered on
+        is shut down, and sending it from now on raises RequestCancelled.
+        Requests of transports that do not use timing's connections run to
+        completion.
+        """
+        with _connections_lock:
+            self.cancelled = True
+            for connection in self._connections:
+                connection.abort()
+
+    def attach(self, connection):
+        """
+        Called by a connection starting to send this exchange, so cancel()
+        can reach it. Raises RequestCancelled if the exchange was cancelled.
+        """
+        with _connections_lock:
+            if self.cancelled:
+                raise RequestCancelled(self.method)
+            self._connections.append(connection)
+
+    def detach(self, connection=None):
+        """Forgets ``connection``, or all connections when None."""
+        with _connections_lock:
+            if connection is None:
+                del self._connections[:]
+            elif connection in self._connections:
+                self._connections.remove(connection)
+
+    def read_only(self):
+        """True when sending the request twice cannot change anything."""
+        return self.verb == 'GET' or self.method in READ_ONLY_METHODS
+    read_only = property(read_only)
+
+    def failed(self):
+        """
+        True when the call did not produce a usable answer: it raised, PayPal
+        answered with a 5xx, or no body came back at all.
+        """
+        if self.error is not None:
+            return True
+        if self.status is not None:
+            return self.status >= 500
+        return self.content is None
+    failed = property(failed)
+
+    def ack(self):
+        """The ACK of an NVP answer ('Success', 'Failure', ...), else None."""
+        if self.service != 'nvp' or not self.content:
+            return None
+        match = _ack.search(self.content)
+        return match and match.group(1) or None
+    ack = property(ack)
+
+    def outcome(self):
+        """
+        How the call ended: 'error' when it raised, the ACK of an NVP answer,
+        otherwise the HTTP status as a string; None before it was sent.
+        """
+        if self.error is not None:
+            return 'error'
+        ack = self.ack
+        if ack is not None:
+            return ack
+        if self.status is not None:
+            return str(self.status)
+        return None
+    outcome = property(outcome)
@@ -0,0 +1,258 @@
+# coding=utf-8
+"""
+Hedged requests for read-only calls. When the first attempt is slower than
+most recent calls of the same method, an identical second request is sent;
+whichever answers first is used and the other one is cancelled. Only
+read-only exchanges are hedged.
+"""
+
+import time
+import heapq
+import Queue
+import logging
+import itertools
+import threading
+from collections import deque
+
+from pipeline import Policy
+from priority import lane, current_lane
+from idempotency import idempotent, current_key
+
+class LatencyTracker(object):
+    """Keeps the last ``window`` latencies of one method."""
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, elapsed):
+        with self._lock:
+            self._samples.append(elapsed)
+
+    def percentile(self, p):
+        """The ``p`` (0 to 1) percentile of the recorded latencies, or None."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class _Pool(object):
+    """
+    Up to ``size`` daemon threads running the functions submitted. Nothing
+    is queued: submit() returns False when every thread is busy.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._tasks = Queue.Queue()
+        self._threads = 0
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func):
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            elif self._threads < self.size:
+                self._threads += 1
+                thread = threading.Thread(target=self._work,
+                                          name='paypal-hedge-%d' % self._threads)
+                thread.daemon = True
+                thread.start()
+            else:
+                return False
+        self._tasks.put(func)
+        return True
+
+    def _work(self):
+        while True:
+            self._tasks.get()()
+            with self._lock:
+                self._idle += 1
+
+
+class _Timer(object):
+    """Runs functions at given times from one daemon thread, started on
+    first use."""
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def at(self, when, func):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), func))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='paypal-hedge-timer')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0][2] is func:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    if self._heap:
+                        self._cond.wait(self._heap[0][0] - time.time())
+                    else:
+                        self._cond.wait()
+                when, seq, func = heapq.heappop(self._heap)
+            try:
+                func()
+            except Exception:
+                logging.getLogger(__name__).exception('Hedge failed to start')
+
+
+class _Race(object):
+    """A call sent from the caller's thread and, maybe, its hedge."""
+    def __init__(self, exchange):
+        self.exchange = exchange
+        # Set once the caller's attempt is over; no hedge starts after.
+        self.done = False
+        # The hedge's Exchange once started, and its (error, result).
+        self.hedge = None
+        self.answer = None
+        self.winner = None
+        self.cond = threading.Condition(threading.Lock())
+
+
+class HedgingPolicy(Policy):
+    """
+    Pipeline policy sending a second, identical request when a read-only
+    call has not answered after the ``percentile`` latency of its method's
+    recent calls. The first successful answer wins and the other attempt is
+    cancelled: its connection is shut down (see Exchange.cancel()), which
+    frees its thread and the slots it holds in other policies.
+
+    ``budget`` is the fraction of calls that may be hedged, so a slow PayPal
+    sees at most that much extra traffic. Nothing is hedged until
+    ``min_samples`` calls of a method have been seen. ``methods`` restricts
+    hedging to the given methods; it still only ever applies to read-only
+    exchanges.
+
+    The call itself is sent from the caller's thread. Hedges run on a pool
+    of at most ``workers`` threads, in the lane and idempotency key of the
+    caller; none is sent while the pool is busy.
+    """
+    def __init__(self, percentile=0.95, budget=0.05, min_samples=20,
+                 methods=None, window=200, workers=16):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.methods = methods and frozenset(methods)
+        self.window = window
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._credit = 1.0
+        self._trackers = {}
+        self._pool = _Pool(workers)
+        self._timer = _Timer()
+        self._lock = threading.Lock()
+
+    def tracker(self, method):
+        tracker = self._trackers.get(method)
+        if tracker is None:
+            with self._lock:
+                tracker = self._trackers.setdefault(method,
+                                                    LatencyTracker(self.window))
+        return tracker
+
+    def metrics(self):
+        return { 'calls': self.calls, 'hedges': self.hedges,
+                 'hedge_wins': self.hedge_wins }
+
+    def send(self, exchange, proceed):
+        if not exchange.read_only or (self.methods and
+                                      exchange.method not in self.methods):
+            return proceed(exchange)
+
+        tracker = self.tracker(exchange.method)
+        with self._lock:
+            self.calls += 1
+            self._credit = min(self._credit + self.budget, 10.0)
+        started = time.time()
+        if len(tracker) < self.min_samples:
+            result = proceed(exchange)
+            tracker.add(time.time() - started)
+            return result
+
+        race = _Race(exchange)
+        contexts = current_lane(), current_key()
+        self._timer.at(started + tracker.percentile(self.percentile),
+                       lambda: self._hedge(race, proceed, contexts))
+        try:
+            result = proceed(exchange)
+            error = None
+        except Exception as e:
+            result, error = None, e
+        with race.cond:
+            race.done = True
+            if error is None and race.winner is None:
+                race.winner = exchange
+            # A failed attempt waits for the hedge, which may still succeed.
+            while race.winner is None and race.hedge is not None and \
+                    race.answer is None:
+                race.cond.wait()
+            hedge = race.hedge
+        tracker.add(time.time() - started)
+
+        if race.winner is exchange and hedge is not None:
+            hedge.cancel()
+        if hedge is not None and race.winner is hedge:
+            with self._lock:
+                self.hedge_wins += 1
+            # The caller's exchange goes on with the hedge's answer.
+            exchange.cancelled = False
+            exchange.adopt(hedge)
+            error, result = race.answer
+        if error is not None:
+            raise error
+        return result
+
+    def _hedge(self, race, proceed, contexts):
+        # Runs on the timer thread once the call is slower than the
+        # percentile.
+        with race.cond:
+            if race.done or not self._take_credit():
+                return
+            copy = race.hedge = race.exchange.copy()
+            if not self._pool.submit(lambda: self._run(race, proceed, copy,
+                                                       contexts)):
+                race.hedge = None
+                self._return_credit()
+
+    def _run(self, race, proceed, copy, contexts):
+        name, key = contexts
+        try:
+            with lane(name):
+                with idempotent(key):
+                    answer = None, proceed(copy)
+        except Exception as e:
+            answer = e, None
+        with race.cond:
+            race.answer = answer
+            if answer[0] is None and race.winner is None:
+                race.winner = copy
+                race.exchange.cancel()
+            race.cond.notify_all()
+
+    def _take_credit(self):
+        with self._lock:
+            if self._credit < 1:
+                return False
+            self._credit -= 1
+            self.hedges += 1
+            return True
+
+    def _return_credit(self):
+        with self._lock:
+            self._credit += 1
+            self.hedges -= 1
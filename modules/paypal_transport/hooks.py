@@ -0,0 +1,71 @@
+# coding=utf-8
+"""
+Hook points around every API call of the three client stacks. Request hooks
+see the Exchange before it is sent; response hooks see it afterwards, with
+``exchange.timings`` (a timing.Timings, None when the call never reached the
+network) and ``exchange.outcome``.
+"""
+
+import logging
+import threading
+
+class Hooks(object):
+    """
+    Lists of request and response hooks, each a function taking the
+    Exchange. A hook that raises is logged and does not affect the call.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_hooks = []
+        self.response_hooks = []
+
+    def on_request(self, hook):
+        """Adds ``hook`` to the request hooks and returns it, so it can decorate."""
+        with self._lock:
+            self.request_hooks = self.request_hooks + [hook]
+        return hook
+
+    def on_response(self, hook):
+        """Adds ``hook`` to the response hooks and returns it, so it can decorate."""
+        with self._lock:
+            self.response_hooks = self.response_hooks + [hook]
+        return hook
+
+    def remove(self, hook):
+        with self._lock:
+            self.request_hooks = [h for h in self.request_hooks if h is not hook]
+            self.response_hooks = [h for h in self.response_hooks if h is not hook]
+
+    def call(self, exchange, send, *args):
+        """
+        Runs the request hooks, then ``send(exchange, *args)``, then the
+        response hooks, also when send raised. Returns what send returned.
+        """
+        # The lists are replaced, never mutated; these are snapshots.
+        request_hooks, response_hooks = self.request_hooks, self.response_hooks
+        if not request_hooks and not response_hooks:
+            return send(exchange, *args)
+        self._run(request_hooks, exchange)
+        try:
+            return send(exchange, *args)
+        except Exception as e:
+            if exchange.error is None:
+                exchange.error = e
+            raise
+        finally:
+            self._run(response_hooks, exchange)
+
+    def _run(self, hooks, exchange):
+        for hook in hooks:
+            try:
+                hook(exchange)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'PayPal hook %r failed', hook)
+
+
+__hooks__ = Hooks()
+
+def default():
+    """Returns the process wide hooks, run by all clients."""
+    return __hooks__
@@ -0,0 +1,232 @@
+# coding=utf-8
+"""
+A local, sqlite backed idempotency store for money moving calls.
+
+Calls made inside ``with paypal_transport.idempotent(order_id):`` are
+recorded under that key before they are sent. Once PayPal answered
+successfully the response is kept, and repeating the call with the same key
+returns it again without a network round trip. REST calls reuse the stored
+PayPal-Request-Id, so a retry after a crash between sending and storing the
+result is deduplicated by PayPal itself.
+"""
+
+import re
+import time
+import uuid
+import Queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from pipeline import Policy
+from exchange import MONEY_MOVING_METHODS
+from exceptions import DuplicateRequestError
+
+PENDING = 'pending'
+DONE = 'done'
+
+_local = threading.local()
+
+@contextmanager
+def idempotent(key):
+    """
+    Records money moving calls the current thread makes inside the with
+    block under ``key``, typically the order id. A key covers one call per
+    method; use distinct keys such as 'order-42/capture-2' for repeated
+    partial captures of the same order.
+    """
+    previous = getattr(_local, 'key', None)
+    _local.key = key
+    try:
+        yield
+    finally:
+        _local.key = previous
+
+def current_key():
+    """The key set by the innermost idempotent() block, or None."""
+    return getattr(_local, 'key', None)
+
+
+class IdempotencyStore(object):
+    """
+    The sqlite file at ``path`` holding one row per (key, method).
+
+    Writes are handed to a single writer thread which commits everything
+    queued since its last commit in one transaction (group commit), so
+    concurrent checkouts share the cost of the fsync. A writing caller
+    still waits until its own row is durable.
+    """
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS idempotency (
+            key TEXT NOT NULL,
+            method TEXT NOT NULL,
+            request_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            status INTEGER,
+            content BLOB,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (key, method)
+        )"""
+
+    def __init__(self, path, max_batch=256):
+        self.path = path
+        self.max_batch = max_batch
+        self.commits = 0
+        self.writes = 0
+        self._local = threading.local()
+        self._queue = Queue.Queue()
+        db = self._connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(self._SCHEMA)
+        db.commit()
+        writer = threading.Thread(target=self._write_loop,
+                                  name='paypal-idempotency-writer')
+        writer.daemon = True
+        writer.start()
+
+    def get(self, key, method):
+        """
+        Returns the row for ``key`` and ``method`` as a dict with request_id,
+        state, status and content, or None.
+        """
+        row = self._connection().execute(
+            'SELECT request_id, state, status, content FROM idempotency '
+            'WHERE key = ? AND method = ?', (key, method)).fetchone()
+        if row is None:
+            return None
+        content = row[3]
+        if content is not None:
+            content = str(content)
+        return { 'request_id': row[0], 'state': row[1], 'status': row[2],
+                 'content': content }
+
+    def begin(self, key, method):
+        """
+        Records a call as pending unless a row exists already. Returns the
+        stored row, with 'new' set to True if this call created it.
+        """
+        now = time.time()
+        request_id = str(uuid.uuid4())
+        self._write('INSERT OR IGNORE INTO idempotency (key, method, '
+                    'request_id, state, created, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, method, request_id, PENDING, now, now))
+        row = self.get(key, method)
+        row['new'] = row['request_id'] == request_id
+        return row
+
+    def complete(self, key, method, status, content):
+        """Stores the final response of a call."""
+        self._write('UPDATE idempotency SET state = ?, status = ?, '
+                    'content = ?, updated = ? WHERE key = ? AND method = ?',
+                    (DONE, status, sqlite3.Binary(content or ''), time.time(),
+                     key, method))
+
+    def discard(self, key, method):
+        """Forgets a call, so the next attempt starts afresh."""
+        self._write('DELETE FROM idempotency WHERE key = ? AND method = ?',
+                    (key, method))
+
+    def pending(self):
+        """Returns (key, method, request_id, created) of all pending calls."""
+        return self._connection().execute(
+            'SELECT key, method, request_id, created FROM idempotency '
+            'WHERE state = ? ORDER BY created', (PENDING,)).fetchall()
+
+    def purge(self, older_than):
+        """Deletes completed rows last updated more than ``older_than`` seconds ago."""
+        self._write('DELETE FROM idempotency WHERE state = ? AND updated < ?',
+                    (DONE, time.time() - older_than))
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+        return db
+
+    def _write(self, sql, params):
+        done = threading.Event()
+        outcome = []
+        self._queue.put((sql, params, done, outcome))
+        done.wait()
+        if outcome:
+            raise outcome[0]
+
+    def _write_loop(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                for sql, params, done, outcome in batch:
+                    db.execute(sql, params)
+                db.commit()
+                self.commits += 1
+                self.writes += len(batch)
+            except Exception as e:
+                db.rollback()
+                for sql, params, done, outcome in batch:
+                    outcome.append(e)
+            for sql, params, done, outcome in batch:
+                done.set()
+
+
+class IdempotencyPolicy(Policy):
+    """
+    Pipeline policy consulting an IdempotencyStore for ``methods`` (money
+    moving calls by default) made inside an idempotent() block.
+
+    A call already answered successfully is replayed from the store. A call
+    still pending is resent with the same PayPal-Request-Id when it is a
+    REST call; an NVP call cannot be deduplicated by PayPal, so
+    DuplicateRequestError is raised and the order must be reconciled first.
+    Unsuccessful answers are not kept, so the call may be retried.
+
+    Put it first in the pipeline, so replays do not wait for rate limits.
+    """
+    def __init__(self, store, methods=MONEY_MOVING_METHODS):
+        self.store = store
+        self.methods = frozenset(methods)
+
+    def send(self, exchange, proceed):
+        key = current_key()
+        if key is None or exchange.method not in self.methods:
+            return proceed(exchange)
+
+        row = self.store.begin(key, exchange.method)
+        if row['state'] == DONE:
+            exchange.status = row['status']
+            exchange.content = row['content']
+            exchange.replayed = True
+            return exchange.content
+
+        if exchange.service == 'rest':
+            exchange.headers['PayPal-Request-Id'] = row['request_id']
+        elif not row['new']:
+            # Sent before, by a worker that crashed or is still waiting for
+            # PayPal. Resending an NVP call could move the money twice.
+            raise DuplicateRequestError(key, exchange.method)
+
+        result = proceed(exchange)
+        if _succeeded(exchange):
+            self.store.complete(key, exchange.method, exchange.status,
+                                exchange.content)
+        elif not exchange.failed:
+            # PayPal answered and refused: nothing happened, allow a retry.
+            self.store.discard(key, exchange.method)
+        return result
+
+
+_ack_success = re.compile(r'(^|&)ACK=Success(WithWarning)?(&|$)', re.I)
+
+def _succeeded(exchange):
+    if exchange.failed:
+        return False
+    if exchange.service == 'rest':
+        return 200 <= (exchange.status or 0) <= 299
+    return _ack_success.search(exchange.content) is not None
@@ -0,0 +1,330 @@
+# coding=utf-8
+"""
+A write-ahead journal of money moving calls, for crash recovery.
+
+Before a DoCapture, DoDirectPayment, DoExpressCheckoutPayment or refund is
+sent, its intent is appended to a memory-mapped, append-only file; once
+PayPal answered, the outcome is appended as well. After a crash, the intents
+without an outcome are the calls that were in flight, and reconcile() looks
+them up at PayPal.
+
+Appending is a memory copy. Making intents durable is left to a flusher
+thread that syncs everything appended so far in one go (group commit), so
+threads checking out at the same time share one msync.
+"""
+
+import os
+import json
+import mmap
+import time
+import uuid
+import zlib
+import atexit
+import struct
+import weakref
+import logging
+import threading
+from urlparse import parse_qs
+
+from pipeline import Policy
+from exchange import MONEY_MOVING_METHODS
+from idempotency import current_key
+
+INTENT = 'intent'
+OUTCOME = 'outcome'
+
+_HEADER = struct.Struct('<II')
+
+# Open journals, closed at exit before the interpreter tears down the
+# modules their flusher threads use.
+_open = weakref.WeakSet()
+
+# Request fields worth keeping for reconciliation. Credentials and card
+# data never make it into the journal.
+_KEPT_FIELDS = ('AMT', 'CURRENCYCODE', 'AUTHORIZATIONID', 'TRANSACTIONID',
+                'TOKEN', 'PAYERID', 'INVNUM', 'PAYMENTACTION', 'COMPLETETYPE')
+
+class Journal(object):
+    """
+    The journal file at ``path``, mapped into memory ``size`` bytes at a
+    time. Records are length and CRC prefixed JSON documents; a zero length
+    marks the end of the data.
+
+    The flusher waits ``commit_delay`` seconds after the first unsynced
+    append before syncing, to let more threads join the same commit.
+    """
+    def __init__(self, path, size=4 * 1024 * 1024, commit_delay=0.002):
+        self.path = path
+        self.commit_delay = commit_delay
+        self.commits = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, os.fstat(self._fd).st_size)
+        self._end = self._scan_end()
+        # Records appended and records known to be on disk. Offsets cannot
+        # be used for this as compaction moves records.
+        self._appended = 0
+        self._synced = 0
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop,
+                                         name='paypal-journal-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+        _open.add(self)
+
+    def append(self, record, durable=True):
+        """
+        Appends ``record``, a JSON serializable dict. With ``durable`` the
+        call returns only once the record is synced to disk.
+        """
+        payload = json.dumps(record, separators=(',', ':'))
+        data = _HEADER.pack(len(payload),
+                            zlib.crc32(payload) & 0xffffffff) + payload
+        with self._cond:
+            if self._end + len(data) + _HEADER.size > len(self._map):
+                self._make_room(len(data) + _HEADER.size)
+            self._map[self._end:self._end + len(data)] = data
+            self._end += len(data)
+            self._appended += 1
+            seq = self._appended
+            self._cond.notify_all()
+            while durable and self._synced < seq:
+                self._cond.wait()
+
+    def records(self):
+        """Returns all records in the journal, oldest first."""
+        with self._cond:
+            return list(self._read(0, self._end))
+
+    def unresolved(self):
+        """
+        Returns the intent records that have no outcome record, that is the
+        calls whose result is unknown, oldest first.
+        """
+        with self._cond:
+            return self._unresolved()
+
+    def compact(self):
+        """Rewrites the journal keeping only unresolved intents."""
+        with self._cond:
+            self._rewrite(self._unresolved(), len(self._map))
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._map.flush()
+            self._synced = self._appended
+            self._cond.notify_all()
+        self._flusher.join()
+        self._map.close()
+        os.close(self._fd)
+        _open.discard(self)
+
+    def _read(self, start, end):
+        offset = start
+        while offset + _HEADER.size <= end:
+            length, crc = _HEADER.unpack_from(self._map, offset)
+            if length == 0:
+                break
+            payload = self._map[offset + _HEADER.size:
+                                offset + _HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                # Torn write at crash time; nothing valid follows.
+                break
+            yield json.loads(payload)
+            offset += _HEADER.size + length
+
+    def _scan_end(self):
+        offset = 0
+        limit = len(self._map)
+        while offset + _HEADER.size <= limit:
+            length, crc = _HEADER.unpack_from(self._map, offset)
+            payload = self._map[offset + _HEADER.size:
+                                offset + _HEADER.size + length]
+            if (length == 0 or len(payload) < length or
+                    zlib.crc32(payload) & 0xffffffff != crc):
+                break
+            offset += _HEADER.size + length
+        return offset
+
+    def _unresolved(self):
+        # Must be called with self._cond held.
+        intents = {}
+        for record in self._read(0, self._end):
+            if record['type'] == INTENT:
+                intents[record['id']] = record
+            else:
+                intents.pop(record['id'], None)
+        return sorted(intents.values(), key=lambda r: r['ts'])
+
+    def _make_room(self, needed):
+        # Must be called with self._cond held. Compaction first; only grow
+        # the file when the unresolved intents alone fill most of it.
+        keep = self._unresolved()
+        size = len(self._map)
+        used = sum(len(json.dumps(r, separators=(',', ':'))) + _HEADER.size
+                   for r in keep)
+        while used + needed > size / 2:
+            size *= 2
+        self._rewrite(keep, size)
+
+    def _rewrite(self, records, size):
+        # Must be called with self._cond held.
+        tmp = self.path + '.compact'
+        with open(tmp, 'wb') as f:
+            for record in records:
+                payload = json.dumps(record, separators=(',', ':'))
+                f.write(_HEADER.pack(len(payload),
+                                     zlib.crc32(payload) & 0xffffffff))
+                f.write(payload)
+            f.truncate(size)
+            f.flush()
+            os.fsync(f.fileno())
+        self._map.close()
+        os.close(self._fd)
+        os.rename(tmp, self.path)
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._map = mmap.mmap(self._fd, size)
+        self._end = self._scan_end()
+        self._synced = self._appended
+        self._cond.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while self._synced >= self._appended and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self._cond:
+                if self._closed:
+                    return
+                seq = self._appended
+                self._map.flush()
+                self._synced = seq
+                self.commits += 1
+                self._cond.notify_all()
+
+
+class JournalPolicy(Policy):
+    """
+    Pipeline policy journaling ``methods`` (money moving calls by default).
+    The intent is durable before the request leaves; the outcome is only
+    written once PayPal answered, so timeouts and crashes leave the intent
+    unresolved.
+    """
+    def __init__(self, journal, methods=MONEY_MOVING_METHODS):
+        self.journal = journal
+        self.methods = frozenset(methods)
+
+    def send(self, exchange, proceed):
+        if exchange.method not in self.methods:
+            return proceed(exchange)
+
+        entry_id = uuid.uuid4().hex
+        self.journal.append(_intent(entry_id, exchange), durable=True)
+        result = proceed(exchange)
+        if exchange.content is not None and not exchange.failed:
+            self.journal.append({
+                'type': OUTCOME,
+                'id': entry_id,
+                'ts': time.time(),
+                'status': exchange.status,
+                'replayed': exchange.replayed,
+                'transactionid': _transaction_id(exchange),
+            }, durable=False)
+        return result
+
+
+def _intent(entry_id, exchange):
+    record = {
+        'type': INTENT,
+        'id': entry_id,
+        'ts': time.time(),
+        'service': exchange.service,
+        'method': exchange.method,
+        'url': exchange.url,
+    }
+    if exchange.service == 'nvp':
+        fields = parse_qs(exchange.body or '')
+        record['fields'] = dict((k, fields[k][0]) for k in _KEPT_FIELDS
+                                if k in fields)
+    else:
+        record['request_id'] = exchange.headers.get('PayPal-Request-Id')
+    record['key'] = current_key()
+    return record
+
+def _transaction_id(exchange):
+    try:
+        if exchange.service == 'nvp':
+            fields = parse_qs(exchange.content)
+            for name in ('TRANSACTIONID', 'PAYMENTINFO_0_TRANSACTIONID',
+                         'AUTHORIZATIONID'):
+                if name in fields:
+                    return fields[name][0]
+            return None
+        return json.loads(exchange.content).get('id')
+    except (ValueError, AttributeError):
+        return None
+
+
+def reconcile(journal, interface):
+    """
+    Looks up every unresolved journal entry at PayPal through ``interface``,
+    a paypal.PayPalInterface, and returns a list of ``(entry, details)``.
+
+    ``details`` is the GetTransactionDetails response of the transaction the
+    call acted on, which tells whether e.g. a capture went through, or None
+    when the entry carries nothing to look up (DoDirectPayment, REST
+    payment creation). Looked-up entries get an outcome record marked
+    'reconciled'; the others stay unresolved for manual review, as do
+    entries whose lookup failed.
+    """
+    results = []
+    for entry in journal.unresolved():
+        fields = entry.get('fields', {})
+        lookup = None
+        details = None
+        method = entry['method']
+        try:
+            if method in ('DoCapture', 'DoVoid'):
+                lookup = fields.get('AUTHORIZATIONID')
+            elif method == 'DoAuthorization':
+                lookup = fields.get('TRANSACTIONID')
+            elif method == 'DoExpressCheckoutPayment' and 'TOKEN' in fields:
+                checkout = interface.get_express_checkout_details(
+                    fields['TOKEN'])
+                lookup = (getattr(checkout, 'PAYMENTREQUEST_0_TRANSACTIONID',
+                                  None) or
+                          getattr(checkout, 'TRANSACTIONID', None))
+            elif method == 'POST v1/payments/sale/{id}/refund':
+                # REST sale ids are PayPal transaction ids.
+                lookup = entry['url'].rstrip('/').split('/')[-2]
+            if lookup:
+                details = interface.get_transaction_details(lookup)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                'Could not reconcile journal entry %s', entry['id'])
+        if details is not None:
+            journal.append({
+                'type': OUTCOME,
+                'id': entry['id'],
+                'ts': time.time(),
+                'reconciled': True,
+                'transactionid': lookup,
+                'paymentstatus': getattr(details, 'PAYMENTSTATUS', None),
+            }, durable=True)
+        results.append((entry, details))
+    return results
+
+
+@atexit.register
+def _close_all():
+    for journal in list(_open):
+        journal.close()
@@ -0,0 +1,173 @@
+# coding=utf-8
+"""
+Structured logging of API calls that costs next to nothing while nothing is
+written: calls are sampled per method, messages are only formatted by the
+logging handlers, and credentials are masked with precompiled patterns only
+when a record is actually emitted.
+
+The last calls are kept in a ring buffer and written out in full, redacted,
+when a call fails, so an error comes with the traffic that led up to it.
+"""
+
+import re
+import random
+import logging
+import threading
+from collections import deque
+
+from hooks import default as default_hooks
+
+MASK = '***'
+
+# NVP fields and JSON keys holding credentials or card data.
+NVP_FIELDS = ('USER', 'PWD', 'SIGNATURE', 'ACCT', 'CVV2')
+JSON_FIELDS = ('number', 'cvv2', 'access_token', 'client_secret')
+
+class Redactor(object):
+    """Masks credentials in NVP strings, JSON bodies, dicts and headers."""
+
+    def __init__(self, nvp_fields=NVP_FIELDS, json_fields=JSON_FIELDS):
+        self._names = frozenset(f.upper() for f in nvp_fields) | \
+            frozenset(f.upper() for f in json_fields)
+        self._nvp = re.compile(r'(^|&)(%s)=[^&]*' % '|'.join(
+            re.escape(f) for f in nvp_fields), re.I)
+        self._json = re.compile(r'("(?:%s)"\s*:\s*)"[^"]*"' % '|'.join(
+            re.escape(f) for f in json_fields))
+        self._auth = re.compile(r'\b(Bearer|Basic)\s+[A-Za-z0-9._~+/=-]+', re.I)
+
+    def text(self, text):
+        """``text``, an NVP string or JSON body, with credentials masked."""
+        if not text:
+            return text
+        text = self._nvp.sub(r'\1\2=' + MASK, text)
+        text = self._json.sub(r'\1"' + MASK + '"', text)
+        return self._auth.sub(r'\1 ' + MASK, text)
+
+    def pairs(self, pairs):
+        """A copy of the dict ``pairs`` (NVP fields or headers), masked."""
+        masked = {}
+        for name, value in pairs.items():
+            if name.upper() in self._names:
+                value = MASK
+            elif name.lower() == 'authorization':
+                value = self.text(value)
+            masked[name] = value
+        return masked
+
+
+def is_error(exchange):
+    """True for calls that raised, 4xx and 5xx answers and failed ACKs."""
+    return (exchange.failed or (exchange.status or 0) >= 400 or
+            (exchange.ack or '').startswith('Failure'))
+
+
+class _Dump(object):
+    """An exchange in full, formatted and redacted only if it is logged."""
+
+    def __init__(self, exchange, redactor):
+        self.exchange = exchange
+        self.redactor = redactor
+
+    def __str__(self):
+        e, redact = self.exchange, self.redactor
+        lines = ['%s %s %s -> %s %s' % (
+            e.verb, e.url, e.method, e.outcome,
+            '%.3fs' % e.elapsed if e.elapsed is not None else '')]
+        for name, value in sorted(redact.pairs(e.headers).items()):
+            lines.append('> %s: %s' % (name, value))
+        if e.body:
+            lines.append('> %s' % redact.text(e.body))
+        if e.error is not None:
+            lines.append('! %r' % e.error)
+        if e.content:
+            lines.append('< %s' % redact.text(e.content))
+        return '\n'.join(lines)
+
+
+class ExchangeLogger(object):
+    """
+    Response hook logging calls to ``logger``. A call is logged at INFO
+    with probability ``rates.get(method, default_rate)``; failed calls are
+    always logged, at ERROR, followed by the last ``ring_size`` calls.
+
+    Records carry the fields paypal_service, paypal_method, paypal_outcome,
+    paypal_status, paypal_elapsed, paypal_attempts and paypal_timings for
+    structured formatters.
+    """
+    def __init__(self, logger=None, rates=None, default_rate=1.0,
+                 ring_size=20, redactor=None):
+        self.logger = logger or logging.getLogger('paypal_transport')
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.redactor = redactor or Redactor()
+        self._ring = deque(maxlen=ring_size)
+        self._lock = threading.Lock()
+
+    def sampled(self, method):
+        rate = self.rates.get(method, self.default_rate)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def __call__(self, exchange):
+        # Only a reference; nothing is formatted unless it is dumped.
+        self._ring.append(exchange)
+        if is_error(exchange):
+            self._error(exchange)
+        elif self.logger.isEnabledFor(logging.INFO) and \
+                self.sampled(exchange.method):
+            self.logger.info('PayPal %s %s: %s in %.3fs', exchange.service,
+                             exchange.method, exchange.outcome,
+                             exchange.elapsed or 0, extra=_fields(exchange))
+
+    def _error(self, exchange):
+        if not self.logger.isEnabledFor(logging.ERROR):
+            return
+        with self._lock:
+            recent = list(self._ring)
+            self._ring.clear()
+        self.logger.error('PayPal %s %s failed: %s', exchange.service,
+                          exchange.method, exchange.outcome,
+                          extra=_fields(exchange))
+        for n, previous in enumerate(recent):
+            self.logger.error('PayPal call %d of the last %d:\n%s', n + 1,
+                              len(recent), _Dump(previous, self.redactor),
+                              extra=_fields(previous))
+
+
+def _fields(exchange):
+    return {
+        'paypal_service': exchange.service,
+        'paypal_method': exchange.method,
+        'paypal_outcome': exchange.outcome,
+        'paypal_status': exchange.status,
+        'paypal_elapsed': exchange.elapsed,
+        'paypal_attempts': exchange.attempts,
+        'paypal_timings': exchange.timings and exchange.timings.as_dict(),
+    }
+
+
+_installed = None
+_install_lock = threading.Lock()
+
+def install(rates=None, default_rate=1.0, ring_size=20, logger=None,
+            hooks=None):
+    """
+    Adds an ExchangeLogger to the response hooks of ``hooks`` (the process
+    wide default) unless one was installed before, and returns it.
+    """
+    global _installed
+    hooks = hooks or default_hooks()
+    with _install_lock:
+        if _installed is None:
+            _installed = ExchangeLogger(logger, rates, default_rate, ring_size)
+        if _installed not in hooks.response_hooks:
+            hooks.on_response(_installed)
+    return _installed
+
+
+__redactor__ = Redactor()
+
+def redact(value):
+    """Masks credentials in an NVP or JSON string, or a dict of fields."""
+    if isinstance(value, dict):
+        return __redactor__.pairs(value)
+    return __redactor__.text(value)
@@ -0,0 +1,404 @@
+# coding=utf-8
+"""
+Per-method metrics of outbound calls in Prometheus text format: latency
+histograms, calls by ACK and HTTP status, errors, retries and bytes sent
+and received; and the state of the policies of the pipeline: adaptive
+concurrency limits and queues, coalesced calls, hedges and circuit breakers.
+
+Each thread counts into its own shard, so recording a call takes no lock.
+Every process publishes its totals to its slot of a shared memory file; the
+metrics endpoint of any process reads all slots and adds them up.
+"""
+
+import os
+import json
+import mmap
+import time
+import errno
+import struct
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks (Windows): metrics are per process only.
+    fcntl = None
+
+from pipeline import Policy, default as default_pipeline
+from breaker import CircuitBreakerPolicy, CLOSED, HALF_OPEN, OPEN
+from concurrency import AdaptiveConcurrencyPolicy
+from coalescing import CoalescingPolicy
+from hedging import HedgingPolicy
+
+# Latency histogram bucket bounds, in seconds.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_HELP = (
+    ('paypal_request_duration_seconds', 'histogram',
+     'Duration of PayPal API calls.'),
+    ('paypal_requests_total', 'counter',
+     'PayPal API calls by ACK and HTTP status.'),
+    ('paypal_errors_total', 'counter',
+     'PayPal API calls that raised, by exception type.'),
+    ('paypal_retries_total', 'counter',
+     'Retransmissions of PayPal API calls.'),
+    ('paypal_request_bytes_total', 'counter',
+     'Request body bytes sent to PayPal.'),
+    ('paypal_response_bytes_total', 'counter',
+     'Response body bytes received from PayPal.'),
+    ('paypal_concurrency_limit', 'gauge',
+     'Adaptive concurrency limit, added up over the processes.'),
+    ('paypal_concurrency_inflight', 'gauge',
+     'Calls in flight under the adaptive concurrency limit.'),
+    ('paypal_concurrency_queued', 'gauge',
+     'Callers waiting for the adaptive concurrency limit.'),
+    ('paypal_coalesced_total', 'counter',
+     'Read-only calls answered by the request of another caller.'),
+    ('paypal_hedges_total', 'counter',
+     'Hedged requests sent for slow read-only calls.'),
+    ('paypal_hedge_wins_total', 'counter',
+     'Hedged requests that answered before the first one.'),
+    ('paypal_circuit_breaker_state', 'gauge',
+     'Processes whose circuit breaker of the endpoint is in the state.'),
+)
+
+
+class _Shard(object):
+    """The counters of one thread."""
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, key, value=1):
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, method, seconds):
+        histogram = self.histograms.get(method)
+        if histogram is None:
+            histogram = self.histograms[method] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(BUCKETS)] += 1
+        # Sum of the observations in microseconds, to stay an integer.
+        histogram[-1] += int(seconds * 1e6)
+
+
+class Registry(object):
+    """
+    The metrics of this process. Threads record into their own shard;
+    snapshot() adds the shards up.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def record(self, exchange, seconds):
+        """Records one finished call."""
+        shard = self.shard()
+        method = exchange.method or 'unknown'
+        shard.observe(method, seconds)
+        shard.count(('paypal_requests_total', method, exchange.ack or '',
+                     str(exchange.status or '')))
+        if exchange.error is not None:
+            shard.count(('paypal_errors_total', method,
+                         type(exchange.error).__name__))
+        if exchange.attempts > 1:
+            shard.count(('paypal_retries_total', method), exchange.attempts - 1)
+        shard.count(('paypal_request_bytes_total', method),
+                    len(exchange.body or ''))
+        shard.count(('paypal_response_bytes_total', method),
+                    len(exchange.content or ''))
+
+    def snapshot(self):
+        """
+        The totals of all threads as a JSON serializable dict, with
+        'counters' and 'histograms' lists.
+        """
+        counters = {}
+        histograms = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            # Copies first; the owning thread may be adding keys.
+            for key, value in shard.counters.items():
+                counters[key] = counters.get(key, 0) + value
+            for method, values in shard.histograms.items():
+                total = histograms.setdefault(method, [0] * len(values))
+                for i, value in enumerate(list(values)):
+                    total[i] += value
+        return { 'counters': [list(k) + [v] for k, v in counters.items()],
+                 'histograms': [[m] + v for m, v in histograms.items()] }
+
+
+_SLOT_HEADER = struct.Struct('<III')  # pid, sequence, length
+
+class SharedMetrics(object):
+    """
+    The shared memory file at ``path`` with one slot of ``slot_size``
+    bytes per process, for up to ``slots`` processes.
+
+    A process claims a free slot (or the slot of a process that exited) and
+    overwrites it with its snapshot; a sequence number that is odd while
+    the slot is written tells readers to try again.
+
+    Slots are claimed under a file lock, so this needs fcntl; it is not
+    available on Windows.
+    """
+    def __init__(self, path, slots=64, slot_size=64 * 1024):
+        if fcntl is None:
+            raise RuntimeError('SharedMetrics needs fcntl file locks, '
+                               'which this platform lacks')
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < slots * slot_size:
+            os.ftruncate(self._fd, slots * slot_size)
+        self._map = mmap.mmap(self._fd, slots * slot_size)
+        self._slot = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def publish(self, snapshot):
+        """Writes ``snapshot`` to the slot of this process."""
+        data = json.dumps(snapshot, separators=(',', ':'))
+        if len(data) > self.slot_size - _SLOT_HEADER.size:
+            raise ValueError('Metrics snapshot does not fit a %d byte slot'
+                             % self.slot_size)
+        with self._lock:
+            offset = self._own_slot() * self.slot_size
+            pid, seq, length = _SLOT_HEADER.unpack_from(self._map, offset)
+            _SLOT_HEADER.pack_into(self._map, offset, self._pid, seq + 1, length)
+            start = offset + _SLOT_HEADER.size
+            self._map[start:start + len(data)] = data
+            _SLOT_HEADER.pack_into(self._map, offset, self._pid, seq + 2,
+                                   len(data))
+
+    def snapshots(self):
+        """The snapshots of all running processes."""
+        found = []
+        for slot in range(self.slots):
+            offset = slot * self.slot_size
+            for attempt in range(10):
+                pid, seq, length = _SLOT_HEADER.unpack_from(self._map, offset)
+                if not pid or not length or not _alive(pid):
+                    break
+                if seq % 2:
+                    time.sleep(0.001)
+                    continue
+                start = offset + _SLOT_HEADER.size
+                data = self._map[start:start + length]
+                if _SLOT_HEADER.unpack_from(self._map, offset)[1] != seq:
+                    continue
+                found.append(json.loads(data))
+                break
+        return found
+
+    def _own_slot(self):
+        # Must be called with self._lock held. A forked child claims a slot
+        # of its own.
+        pid = os.getpid()
+        if self._slot is not None and self._pid == pid:
+            return self._slot
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for slot in range(self.slots):
+                offset = slot * self.slot_size
+                owner = _SLOT_HEADER.unpack_from(self._map, offset)[0]
+                if not owner or not _alive(owner):
+                    _SLOT_HEADER.pack_into(self._map, offset, pid, 0, 0)
+                    self._slot, self._pid = slot, pid
+                    return slot
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        raise RuntimeError('All %d metrics slots are in use' % self.slots)
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class MetricsPolicy(Policy):
+    """
+    Pipeline policy recording every call into ``registry``. Add it
+    outermost, so the latency includes the time spent waiting in other
+    policies, and retries and hedges count towards the one call.
+
+    With ``shared`` (a SharedMetrics), the totals of this process are
+    published every ``interval`` seconds and render() reports all
+    processes. The state of the concurrency, coalescing, hedging and
+    circuit breaker policies of ``pipeline`` is reported along.
+    """
+    def __init__(self, registry=None, shared=None, interval=5.0,
+                 pipeline=None):
+        self.registry = registry or Registry()
+        self.shared = shared
+        self.interval = interval
+        self.pipeline = pipeline
+        if shared is not None:
+            publisher = threading.Thread(target=self._publish_loop,
+                                         name='paypal-metrics-publisher')
+            publisher.daemon = True
+            publisher.start()
+
+    def send(self, exchange, proceed):
+        started = time.time()
+        try:
+            return proceed(exchange)
+        finally:
+            self.registry.record(exchange, time.time() - started)
+
+    def snapshot(self):
+        """The registry snapshot, with the state of the pipeline policies."""
+        snapshot = self.registry.snapshot()
+        snapshot['counters'].extend(self._policy_rows())
+        return snapshot
+
+    def render(self):
+        """The metrics in Prometheus text format, of all processes when shared."""
+        if self.shared is None:
+            return render([self.snapshot()])
+        self.shared.publish(self.snapshot())
+        return render(self.shared.snapshots())
+
+    def _policy_rows(self):
+        rows = []
+        policies = self.pipeline and self.pipeline.policies or ()
+        for policy in policies:
+            if isinstance(policy, AdaptiveConcurrencyPolicy):
+                for endpoint, limiter in policy.metrics().items():
+                    for name in ('limit', 'inflight', 'queued'):
+                        rows.append(['paypal_concurrency_' + name, endpoint,
+                                     limiter[name]])
+            elif isinstance(policy, CoalescingPolicy):
+                for method, stats in policy.metrics().items():
+                    rows.append(['paypal_coalesced_total', method or 'unknown',
+                                 stats['coalesced']])
+            elif isinstance(policy, HedgingPolicy):
+                hedging = policy.metrics()
+                rows.append(['paypal_hedges_total', hedging['hedges']])
+                rows.append(['paypal_hedge_wins_total', hedging['hedge_wins']])
+            elif isinstance(policy, CircuitBreakerPolicy):
+                for endpoint, breaker in policy.breakers().items():
+                    current = breaker.state
+                    for state in (CLOSED, HALF_OPEN, OPEN):
+                        rows.append(['paypal_circuit_breaker_state', endpoint,
+                                     state, int(state == current)])
+        return rows
+
+    def _publish_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.shared.publish(self.snapshot())
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'Could not publish PayPal metrics')
+
+
+def render(snapshots):
+    """Adds ``snapshots`` up and returns them in Prometheus text format."""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for row in snapshot['counters']:
+            key = tuple(row[:-1])
+            counters[key] = counters.get(key, 0) + row[-1]
+        for row in snapshot['histograms']:
+            total = histograms.setdefault(row[0], [0] * (len(row) - 1))
+            for i, value in enumerate(row[1:]):
+                total[i] += value
+
+    lines = []
+    for name, kind, text in _HELP:
+        lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        if kind == 'histogram':
+            for method in sorted(histograms):
+                values = histograms[method]
+                cumulative = 0
+                for bound, value in zip(BUCKETS + ('+Inf',), values):
+                    cumulative += value
+                    lines.append('%s_bucket{method="%s",le="%s"} %d' % (
+                        name, _escape(method), bound, cumulative))
+                lines.append('%s_sum{method="%s"} %.6f' % (
+                    name, _escape(method), values[-1] / 1e6))
+                lines.append('%s_count{method="%s"} %d' % (
+                    name, _escape(method), cumulative))
+            continue
+        labels = _LABELS[name]
+        for key in sorted(k for k in counters if k[0] == name):
+            pairs = ','.join('%s="%s"' % (label, _escape(value))
+                             for label, value in zip(labels, key[1:]))
+            if pairs:
+                lines.append('%s{%s} %d' % (name, pairs, counters[key]))
+            else:
+                lines.append('%s %d' % (name, counters[key]))
+    return '\n'.join(lines) + '\n'
+
+_LABELS = {
+    'paypal_requests_total': ('method', 'ack', 'status'),
+    'paypal_errors_total': ('method', 'error'),
+    'paypal_retries_total': ('method',),
+    'paypal_request_bytes_total': ('method',),
+    'paypal_response_bytes_total': ('method',),
+    'paypal_concurrency_limit': ('endpoint',),
+    'paypal_concurrency_inflight': ('endpoint',),
+    'paypal_concurrency_queued': ('endpoint',),
+    'paypal_coalesced_total': ('method',),
+    'paypal_hedges_total': (),
+    'paypal_hedge_wins_total': (),
+    'paypal_circuit_breaker_state': ('endpoint', 'state'),
+}
+
+def _escape(value):
+    return unicode(value).encode('utf-8').replace('\\', '\\\\') \
+        .replace('"', '\\"').replace('\n', '\\n')
+
+
+_installed = None
+_install_lock = threading.Lock()
+
+def install(path=None, pipeline=None):
+    """
+    Adds a MetricsPolicy as outermost policy of ``pipeline`` (the process
+    wide default) unless it has one, and returns it. With ``path`` the
+    metrics are shared across processes through that file, where the
+    platform has fcntl; elsewhere each process reports its own.
+    """
+    global _installed
+    pipeline = pipeline or default_pipeline()
+    with _install_lock:
+        policy = pipeline.find(MetricsPolicy)
+        if policy is None:
+            policy = _installed
+            if policy is None:
+                if path and fcntl is None:
+                    logging.getLogger(__name__).warning(
+                        'No fcntl file locks on this platform: PayPal '
+                        'metrics are reported per process')
+                    path = None
+                shared = path and SharedMetrics(path) or None
+                policy = _installed = MetricsPolicy(shared=shared,
+                                                    pipeline=pipeline)
+            pipeline.insert(0, policy)
+    return policy
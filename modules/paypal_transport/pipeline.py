@@ -0,0 +1,113 @@
+# coding=utf-8
+"""
+The pipeline every outbound call of paypal.PayPalInterface,
+paypalnvp.core.PayPal and paypalrestsdk.api.Api goes through. Policies such as
+the circuit breaker are stacked around the function that does the actual HTTP
+request.
+"""
+
+import time
+import threading
+
+from exchange import set_current
+from exceptions import RequestCancelled
+
+class Policy(object):
+    """
+    Base class for pipeline policies. Subclasses override send() and call
+    ``proceed(exchange)`` to hand the exchange on to the next policy; not
+    calling it short-circuits the request.
+    """
+    def send(self, exchange, proceed):
+        return proceed(exchange)
+
+
+class Pipeline(object):
+    """
+    An ordered list of policies. The first policy added is the outermost one,
+    so it sees the exchange first and the result last.
+    """
+    def __init__(self, policies=None):
+        self._lock = threading.Lock()
+        self.policies = list(policies or [])
+
+    def add(self, policy):
+        """Appends ``policy`` as the innermost policy and returns it."""
+        with self._lock:
+            self.policies = self.policies + [policy]
+        return policy
+
+    def insert(self, index, policy):
+        """Inserts ``policy`` at ``index``, 0 being outermost, and returns it."""
+        with self._lock:
+            policies = list(self.policies)
+            policies.insert(index, policy)
+            self.policies = policies
+        return policy
+
+    def remove(self, policy):
+        with self._lock:
+            self.policies = [p for p in self.policies if p is not policy]
+
+    def find(self, klass):
+        """Returns the first policy that is an instance of ``klass``, or None."""
+        for policy in self.policies:
+            if isinstance(policy, klass):
+                return policy
+        return None
+
+    def send(self, exchange, transmit):
+        """
+        Runs ``exchange`` through the policies and finally through
+        ``transmit``, which performs the HTTP request and returns whatever
+        the calling stack expects back. That value is returned unchanged.
+        """
+        def terminal(exchange):
+            if exchange.cancelled:
+                raise RequestCancelled(exchange.method)
+            exchange.attempts += 1
+            exchange.started = time.time()
+            previous = set_current(exchange)
+            try:
+                return transmit(exchange)
+            except Exception as e:
+                if exchange.cancelled and not isinstance(e, RequestCancelled):
+                    # The connection broke because cancel() shut it down.
+                    exchange.error = RequestCancelled(exchange.method)
+                    raise exchange.error
+                exchange.error = e
+                raise
+            finally:
+                set_current(previous)
+                exchange.detach()
+                exchange.elapsed = time.time() - exchange.started
+
+        proceed = terminal
+        # self.policies is replaced, never mutated, so this is a snapshot.
+        for policy in reversed(self.policies):
+            proceed = _bind(policy, proceed)
+        return proceed(exchange)
+
+
+def _bind(policy, proceed):
+    return lambda exchange: policy.send(exchange, proceed)
+
+
+__pipeline__ = None
+
+def default():
+    """
+    Returns the process wide pipeline used by clients that were not given
+    one explicitly. It starts out with a CircuitBreakerPolicy.
+    """
+    global __pipeline__
+    if __pipeline__ is None:
+        from breaker import CircuitBreakerPolicy
+        __pipeline__ = Pipeline([CircuitBreakerPolicy()])
+    return __pipeline__
+
+def set_pipeline(pipeline):
+    """Replaces the process wide pipeline and returns it."""
+    global __pipeline__
+    __pipeline__ = pipeline
+    return __pipeline__
@@ -0,0 +1,111 @@
+# coding=utf-8
+"""
+A small pool of keep-alive HTTP(S) connections to one host, so repeated
+calls skip the TCP and TLS handshakes.
+"""
+
+import errno
+import socket
+import httplib
+import threading
+
+from timing import TimedHTTPConnection, TimedHTTPSConnection
+
+class ConnectionPool(object):
+    """
+    Up to ``size`` idle connections to ``host`` are kept for reuse. A request
+    on a reused connection that the server closed in the meantime is sent
+    once more on a fresh connection.
+    """
+    def __init__(self, host, scheme='https', size=10, timeout=15):
+        self.host = host
+        self.scheme = scheme
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body=None, headers=None, resend=True):
+        """
+        Sends one request and returns the httplib response with its body
+        already read into ``response.body`` and its timing.Timings in
+        ``response.timings``.
+
+        A request failing on a reused connection is sent again, on a new
+        one, only when the server reset or closed the connection before a
+        byte of the answer came back; never after a timeout, when PayPal may
+        still be working on it. With ``resend`` False, as for calls that
+        move money, only a request that failed before it was fully written
+        is sent again.
+        """
+        conn, reused = self._get()
+        written = False
+        try:
+            conn.request(method, path, body, headers or {})
+            written = True
+            response = self._receive(conn)
+        except Exception as e:
+            conn.close()
+            if not (reused and _unanswered(e) and (resend or not written)):
+                raise
+            # The server closed the idle connection in the meantime.
+            conn, reused = self._new(), False
+            try:
+                conn.request(method, path, body, headers or {})
+                response = self._receive(conn)
+            except Exception:
+                conn.close()
+                raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+        return response
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _receive(self, conn):
+        response = conn.getresponse()
+        response.body = response.read()
+        return response
+
+    def _get(self):
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop(), True
+        return self._new(), False
+
+    def _put(self, conn):
+        conn.detach()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _new(self):
+        with self._lock:
+            self.created += 1
+        if self.scheme == 'https':
+            return TimedHTTPSConnection(self.host, timeout=self.timeout)
+        return TimedHTTPConnection(self.host, timeout=self.timeout)
+
+
+# What sending on, or reading from, a connection the server has closed
+# raises, before anything of the answer was read.
+_CLOSED_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+def _unanswered(error):
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        # An empty status line: closed without a byte of answer.
+        return not error.line or error.line.startswith('No status line')
+    return isinstance(error, socket.error) and error.errno in _CLOSED_ERRNOS
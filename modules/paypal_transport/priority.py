@@ -0,0 +1,164 @@
+# coding=utf-8
+"""
+Priority lanes for outbound calls. Money moving calls (captures, checkout
+completion, voids, refunds) are dispatched before lookups, and part of the
+connection slots is reserved for them so batch jobs cannot starve checkout.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+from pipeline import Policy
+from exchange import MONEY_MOVING_METHODS
+from exceptions import ConcurrencyLimitTimeout
+
+CRITICAL = 'critical'
+NORMAL = 'normal'
+BACKGROUND = 'background'
+
+# Lower sorts first.
+_RANK = { CRITICAL: 0, NORMAL: 1, BACKGROUND: 2 }
+
+DEFAULT_LANES = dict((method, CRITICAL) for method in MONEY_MOVING_METHODS)
+DEFAULT_LANES.update({
+    'GetTransactionDetails': BACKGROUND,
+    'TransactionSearch': BACKGROUND,
+    'GetBalance': BACKGROUND,
+    'GET v1/payments/payment': BACKGROUND,
+    'GET v1/payments/payment/{id}': BACKGROUND,
+    'GET v1/payments/sale/{id}': BACKGROUND,
+    'GET v1/payments/refund/{id}': BACKGROUND,
+    'GET v1/vault/credit-card/{id}': BACKGROUND,
+})
+
+_local = threading.local()
+
+@contextmanager
+def lane(name):
+    """
+    Sends every call made by the current thread inside the with block in
+    lane ``name``, whatever its method. Meant for batch jobs:
+
+        with paypal_transport.lane(paypal_transport.BACKGROUND):
+            reconcile_orders()
+
+    With ``name`` None calls go by method again.
+    """
+    if name is not None and name not in _RANK:
+        raise ValueError('Unknown lane: %s' % name)
+    previous = getattr(_local, 'lane', None)
+    _local.lane = name
+    try:
+        yield
+    finally:
+        _local.lane = previous
+
+def current_lane():
+    """The lane set by the innermost lane() block, or None."""
+    return getattr(_local, 'lane', None)
+
+
+class PriorityDispatcher(object):
+    """
+    Hands out ``slots`` concurrent slots, always to the waiting caller of
+    the highest priority lane first, first come first served within a lane.
+
+    ``reserved`` maps a lane to the fraction of slots only that lane and
+    lanes above it may use. With the defaults and 20 slots, background calls
+    use at most 10 slots, normal calls at most 16, and critical calls all 20.
+    """
+    def __init__(self, slots=20, reserved=None):
+        if reserved is None:
+            reserved = { CRITICAL: 0.2, NORMAL: 0.3 }
+        self.slots = slots
+        self.reserved = reserved
+        self._caps = {}
+        held_back = 0.0
+        for name in sorted(_RANK, key=_RANK.get):
+            self._caps[name] = max(1, int(round(slots * (1 - held_back))))
+            held_back += reserved.get(name, 0)
+
+        self._in_use = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+
+    def cap(self, lane):
+        """The maximum number of slots calls in ``lane`` may occupy."""
+        return self._caps[lane]
+
+    def metrics(self):
+        """Slots in use and callers waiting per lane."""
+        with self._cond:
+            waiting = dict((name, 0) for name in _RANK)
+            for rank, seq, name in self._waiting:
+                waiting[name] += 1
+            return { 'in_use': self._in_use, 'slots': self.slots,
+                     'waiting': waiting }
+
+    def acquire(self, lane, timeout=None):
+        """
+        Waits for a slot for a call in ``lane``. Returns False if none was
+        granted within ``timeout`` seconds; otherwise True, and the slot must
+        be handed back with release().
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        entry = (_RANK[lane], next(self._counter), lane)
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while not (self._waiting[0] is entry and
+                           self._in_use < self._caps[lane]):
+                    if deadline is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                heapq.heappop(self._waiting)
+                self._in_use += 1
+                return True
+            finally:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                # The head of the queue may have changed either way.
+                self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify_all()
+
+
+class PriorityPolicy(Policy):
+    """
+    Pipeline policy dispatching calls through a PriorityDispatcher. The lane
+    of a call comes from lane() if the thread is inside one, else from
+    ``lanes`` (method to lane, merged over DEFAULT_LANES), else NORMAL.
+
+    Add it in front of the RateLimitPolicy so the rate budget is also spent
+    in priority order. Calls that wait longer than ``timeout`` seconds raise
+    ConcurrencyLimitTimeout.
+    """
+    def __init__(self, slots=20, reserved=None, lanes=None, timeout=10):
+        self.dispatcher = PriorityDispatcher(slots, reserved)
+        self.lanes = dict(DEFAULT_LANES)
+        self.lanes.update(lanes or {})
+        self.timeout = timeout
+
+    def lane_for(self, exchange):
+        return current_lane() or self.lanes.get(exchange.method, NORMAL)
+
+    def send(self, exchange, proceed):
+        name = self.lane_for(exchange)
+        if not self.dispatcher.acquire(name, self.timeout):
+            raise ConcurrencyLimitTimeout(name, self.dispatcher.cap(name))
+        try:
+            return proceed(exchange)
+        finally:
+            self.dispatcher.release()
@@ -0,0 +1,215 @@
+# coding=utf-8
+"""
+Opt-in profiling of checkout flows: building carts, sending the calls and
+reading the answers, across the paypal, paypalnvp and paypalrestsdk stacks.
+
+Each profiled flow writes three files to the profile directory:
+
+``<name>-<stamp>.prof``
+    cProfile statistics, for pstats or snakeviz.
+``<name>-<stamp>.collapsed``
+    Stacks of the flow's thread sampled every ``interval`` seconds, one
+    ``frame;frame;frame count`` line per stack, for flamegraph.pl or
+    speedscope.
+``<name>-<stamp>.mem``
+    The allocation growth of the flow: the top lines from tracemalloc when
+    it is available, else the change in live objects per type.
+
+Profiling is off unless a directory is passed, enable() was called or the
+PAYPAL_PROFILE_DIR environment variable is set; a disabled flow costs one
+check. Flows nested in a running flow of the same thread are part of it.
+"""
+
+import os
+import sys
+import gc
+import time
+import pstats
+import cProfile
+import StringIO
+import threading
+from functools import wraps
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__directory__ = os.environ.get('PAYPAL_PROFILE_DIR') or None
+_local = threading.local()
+_counter_lock = threading.Lock()
+_counter = [0]
+
+def enable(directory):
+    """Profiles all flows from now on, writing to ``directory``."""
+    global __directory__
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    __directory__ = directory
+
+def disable():
+    global __directory__
+    __directory__ = None
+
+
+class Flow(object):
+    """
+    A profiled flow named ``name``; use it as context manager or as
+    decorator:
+
+        with paypal_transport.profile('checkout'):
+            ...
+
+        @paypal_transport.profile('capture')
+        def capture(order):
+            ...
+    """
+    def __init__(self, name, directory=None, interval=0.001, memory=True):
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.memory = memory
+        # Paths of the files the last run wrote, None if it was not profiled.
+        self.files = None
+
+    def __call__(self, func):
+        @wraps(func)
+        def profiled(*args, **kwargs):
+            flow = Flow(self.name, self.directory, self.interval, self.memory)
+            try:
+                with flow:
+                    return func(*args, **kwargs)
+            finally:
+                self.files = flow.files
+        return profiled
+
+    def __enter__(self):
+        self._run = None
+        directory = self.directory or __directory__
+        if directory is None or getattr(_local, 'active', False):
+            return self
+        _local.active = True
+        self._run = _Run(self, directory)
+        self._run.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        run, self._run = self._run, None
+        if run is not None:
+            try:
+                self.files = run.stop()
+            finally:
+                _local.active = False
+        return False
+
+profile = Flow
+
+
+class _Run(object):
+    """The profilers of one flow."""
+
+    def __init__(self, flow, directory):
+        self.flow = flow
+        self.directory = directory
+        self.stacks = {}
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.flow.memory:
+            if tracemalloc is not None:
+                self._tracing = not tracemalloc.is_tracing()
+                if self._tracing:
+                    tracemalloc.start(10)
+                self._before = tracemalloc.take_snapshot()
+            else:
+                self._before = _object_counts()
+            self._rss = _max_rss()
+        self._thread_id = threading.current_thread().ident
+        sampler = threading.Thread(target=self._sample,
+                                   name='paypal-profile-sampler')
+        sampler.daemon = True
+        self._sampler = sampler
+        self._profile = cProfile.Profile()
+        self._started = time.time()
+        sampler.start()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        elapsed = time.time() - self._started
+        self._stopped.set()
+        self._sampler.join()
+
+        with _counter_lock:
+            _counter[0] += 1
+            n = _counter[0]
+        base = os.path.join(self.directory, '%s-%s-%d-%d' % (
+            self.flow.name, time.strftime('%Y%m%d%H%M%S'), os.getpid(), n))
+        files = [base + '.prof', base + '.collapsed']
+        self._profile.dump_stats(files[0])
+        with open(files[1], 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+        if self.flow.memory:
+            files.append(base + '.mem')
+            with open(files[2], 'w') as f:
+                f.write('flow %s: %.3fs\n' % (self.flow.name, elapsed))
+                f.write('max rss growth: %s KiB\n' % (
+                    _max_rss() - self._rss if self._rss is not None else '?'))
+                self._write_memory(f)
+        return files
+
+    def _write_memory(self, f):
+        if tracemalloc is not None:
+            after = tracemalloc.take_snapshot()
+            if self._tracing:
+                tracemalloc.stop()
+            for stat in after.compare_to(self._before, 'lineno')[:50]:
+                f.write('%s\n' % stat)
+            return
+        after = _object_counts()
+        growth = [(after[t] - self._before.get(t, 0), t) for t in after]
+        f.write('live objects by type (no tracemalloc):\n')
+        for delta, name in sorted(growth, reverse=True)[:50]:
+            if delta <= 0:
+                break
+            f.write('%+d %s\n' % (delta, name))
+
+    def _sample(self):
+        stacks = self.stacks
+        while not self._stopped.wait(self.flow.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('%s (%s:%d)' % (code.co_name,
+                    os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+
+def _object_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def _max_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summary(path, limit=20):
+    """The ``limit`` costliest functions of a .prof file, as text."""
+    out = StringIO.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,157 @@
+# coding=utf-8
+"""
+Client side rate limiting shared by all processes on one host. Every web2py
+worker calls PayPal on its own, so the token buckets live in small lock
+protected files instead of process memory.
+"""
+
+import os
+import re
+import time
+import struct
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks (Windows): buckets are only shared between the
+    # threads of one process.
+    fcntl = None
+
+from pipeline import Policy
+from exceptions import RateLimitTimeout
+
+_RECORD = struct.Struct('dd')
+_unsafe_chars = re.compile(r'[^A-Za-z0-9_.-]+')
+
+class TokenBucket(object):
+    """
+    A token bucket refilled at ``rate`` tokens per second that holds at most
+    ``burst`` tokens. The state is kept in the file at ``path`` and guarded
+    by an exclusive lock on that file while it is being updated.
+    """
+    def __init__(self, path, rate, burst=None):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Takes one token. Returns 0 on success, otherwise the number of
+        seconds until a token will be available; nothing is taken then.
+        """
+        return self._update(take=True)
+
+    def refund(self):
+        """Puts back a token taken for a request that was not sent."""
+        self._update(take=False)
+
+    def _update(self, take):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                now = time.time()
+                data = os.read(fd, _RECORD.size)
+                if len(data) == _RECORD.size:
+                    tokens, last = _RECORD.unpack(data)
+                    tokens = min(self.burst,
+                                 tokens + max(now - last, 0) * self.rate)
+                else:
+                    tokens = self.burst
+                wait = 0
+                if not take:
+                    tokens = min(self.burst, tokens + 1)
+                elif tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.rate
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, _RECORD.pack(tokens, now))
+                return wait
+            finally:
+                # Closing the descriptor releases the flock.
+                os.close(fd)
+
+
+class RateLimitPolicy(Policy):
+    """
+    Pipeline policy that caps outbound calls per API method.
+
+    ``limits`` maps a method (NVP METHOD such as 'TransactionSearch', or a
+    REST method such as 'POST v1/payments/payment') to a ``(rate, burst)``
+    tuple, rate being requests per second across all processes using the
+    same ``directory``. Methods not listed share the ``default`` budget, or
+    are not limited when it is None. ``total`` caps all methods together.
+
+    Requests over the budget are queued, not rejected: the calling thread
+    sleeps until a token frees up. RateLimitTimeout is raised only when that
+    would take longer than ``timeout`` seconds.
+    """
+    def __init__(self, limits=None, default=None, total=None, directory=None,
+                 timeout=10):
+        self.limits = dict(limits or {})
+        self.default = default
+        self.timeout = timeout
+        self.directory = directory or os.path.join(tempfile.gettempdir(),
+                                                   'paypal_ratelimit')
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another worker created it first.
+                pass
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._total = None
+        if total is not None:
+            self._total = TokenBucket(os.path.join(self.directory,
+                                                   '_total.bucket'), *total)
+
+    def bucket(self, method):
+        """Returns the TokenBucket for ``method``, or None if not limited."""
+        if method in self._buckets:
+            return self._buckets[method]
+        limit = self.limits.get(method, self.default)
+        with self._lock:
+            if limit is None:
+                bucket = None
+            else:
+                rate, burst = limit
+                key = method if method in self.limits else '_default'
+                path = os.path.join(self.directory,
+                                    _unsafe_chars.sub('_', key) + '.bucket')
+                bucket = TokenBucket(path, rate, burst)
+            self._buckets[method] = bucket
+        return bucket
+
+    def acquire(self, method, timeout=None):
+        """
+        Blocks until a request for ``method`` may be sent. Raises
+        RateLimitTimeout if that is not possible within ``timeout`` seconds;
+        the tokens taken by then are put back.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        taken = []
+        for bucket in (self.bucket(method), self._total):
+            if bucket is None:
+                continue
+            while True:
+                wait = bucket.try_acquire()
+                if not wait:
+                    taken.append(bucket)
+                    break
+                if wait > deadline - time.time():
+                    for bucket in taken:
+                        bucket.refund()
+                    raise RateLimitTimeout(method, timeout)
+                time.sleep(wait)
+
+    def send(self, exchange, proceed):
+        self.acquire(exchange.method)
+        return proceed(exchange)
@@ -0,0 +1,62 @@
+# coding=utf-8
+"""
+Retries of calls that failed on the way: the connection broke, timed out or
+PayPal answered with a 5xx. Only calls that are safe to repeat are retried:
+read-only ones, and REST calls carrying a PayPal-Request-Id, which PayPal
+deduplicates. Money moving NVP calls are never sent twice.
+"""
+
+import time
+import random
+import socket
+import urllib2
+import httplib
+
+from pipeline import Policy
+
+# Errors raised while sending that mean the request may be sent again. An
+# urllib2.HTTPError is one only for a 5xx.
+RETRIABLE_ERRORS = (socket.error, httplib.HTTPException, urllib2.URLError)
+
+class RetryPolicy(Policy):
+    """
+    Pipeline policy sending a failed call up to ``attempts`` times in all,
+    sleeping an exponential, jittered backoff of ``backoff`` seconds
+    doubling up to ``max_backoff`` in between. ``methods`` restricts retries
+    to the given methods; they still only apply to calls safe to repeat.
+
+    ``retries`` counts the repeated sends.
+    """
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=2.0, methods=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.methods = methods and frozenset(methods)
+        self.retries = 0
+
+    def retriable(self, exchange):
+        if self.methods is not None and exchange.method not in self.methods:
+            return False
+        return exchange.read_only or (exchange.service == 'rest' and
+                                      'PayPal-Request-Id' in exchange.headers)
+
+    def send(self, exchange, proceed):
+        if not self.retriable(exchange):
+            return proceed(exchange)
+
+        delay = self.backoff
+        for attempt in range(1, self.attempts + 1):
+            try:
+                result = proceed(exchange)
+            except RETRIABLE_ERRORS as e:
+                if attempt == self.attempts or \
+                        isinstance(e, urllib2.HTTPError) and e.code < 500:
+                    raise
+            else:
+                if not exchange.failed or attempt == self.attempts:
+                    return result
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, self.max_backoff)
+            self.retries += 1
+            exchange.status = exchange.response = exchange.content = None
+            exchange.error = None
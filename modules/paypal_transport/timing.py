@@ -0,0 +1,222 @@
+# coding=utf-8
+"""
+HTTP connections that time each phase of a request: name resolution, TCP
+connect, TLS handshake, sending the request, waiting for the first byte of
+the answer and reading it.
+
+They are drop-in replacements for httplib's connections and can be handed
+to urllib2 (TimedHTTPHandler, TimedHTTPSHandler) and to httplib2 (as
+``connection_type``).
+"""
+
+import ssl
+import time
+import socket
+import urllib
+import urllib2
+import httplib
+from urlparse import urlsplit
+
+from exchange import current as current_exchange
+
+PHASES = ('dns', 'connect', 'tls', 'send', 'ttfb', 'read')
+
+class Timings(object):
+    """
+    Seconds spent in each phase of one request. dns, connect and tls are
+    None when the request went out on a connection opened before.
+    """
+    __slots__ = PHASES
+
+    def __init__(self):
+        for phase in PHASES:
+            setattr(self, phase, None)
+
+    def as_dict(self):
+        return dict((phase, getattr(self, phase)) for phase in PHASES)
+
+    def __repr__(self):
+        return '<Timings %s>' % ' '.join(
+            '%s=%.4f' % (phase, getattr(self, phase))
+            for phase in PHASES if getattr(self, phase) is not None)
+
+
+class TimedHTTPResponse(httplib.HTTPResponse):
+    """Adds the time spent reading the body to the request's timings."""
+    timings = None
+
+    def read(self, amt=None):
+        started = time.time()
+        try:
+            return httplib.HTTPResponse.read(self, amt)
+        finally:
+            if self.timings is not None:
+                self.timings.read = ((self.timings.read or 0) +
+                                     time.time() - started)
+
+
+class TimedHTTPConnection(httplib.HTTPConnection):
+    """
+    httplib.HTTPConnection handing the Timings of each request to its
+    response, as ``response.timings``; ``timings`` holds those of the last
+    response. Keyword arguments httplib2 passes and plain HTTP has no use
+    for (proxy_info, ca_certs, ...) are ignored.
+
+    A request sent while the pipeline transmits an Exchange is attached to
+    it, so Exchange.cancel() shuts the connection down.
+    """
+    response_class = TimedHTTPResponse
+
+    def __init__(self, host, port=None, strict=None,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None,
+                 **ignored):
+        httplib.HTTPConnection.__init__(self, host, port, strict, timeout,
+                                        source_address)
+        self.timings = None
+        # The Exchange of the request in progress, if any.
+        self.exchange = None
+        # Filled in by the request in progress; connect() may come first.
+        self._pending = Timings()
+
+    def connect(self):
+        self.sock = self._open_socket()
+        if self._tunnel_host:
+            self._tunnel()
+
+    def request(self, method, url, body=None, headers={}):
+        exchange = current_exchange()
+        if exchange is not None:
+            exchange.attach(self)
+            self.exchange = exchange
+        setup = self._setup_time()
+        started = time.time()
+        httplib.HTTPConnection.request(self, method, url, body, headers)
+        # Less a connect() done on the way.
+        self._pending.send = (time.time() - started -
+                              (self._setup_time() - setup))
+
+    def getresponse(self, *args, **kwargs):
+        started = time.time()
+        response = httplib.HTTPConnection.getresponse(self, *args, **kwargs)
+        timings, self._pending = self._pending, Timings()
+        timings.ttfb = time.time() - started
+        response.timings = self.timings = timings
+        return response
+
+    def detach(self):
+        """Unties the connection from its Exchange, before it is reused."""
+        if self.exchange is not None:
+            self.exchange.detach(self)
+            self.exchange = None
+
+    def abort(self):
+        """Shuts the socket down, failing a request blocked on it in another
+        thread."""
+        sock = self.sock
+        if sock is not None:
+            try:
+                # The plain socket under an SSL one.
+                getattr(sock, '_sock', sock).shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _setup_time(self):
+        timings = self._pending
+        return (timings.dns or 0) + (timings.connect or 0) + (timings.tls or 0)
+
+    def _open_socket(self):
+        started = time.time()
+        addresses = socket.getaddrinfo(self.host, self.port, 0,
+                                       socket.SOCK_STREAM)
+        resolved = time.time()
+        self._pending.dns = resolved - started
+        error = socket.error('getaddrinfo returns an empty list')
+        for family, socktype, proto, canonname, address in addresses:
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                if self.source_address:
+                    sock.bind(self.source_address)
+                sock.connect(address)
+                self._pending.connect = time.time() - resolved
+                return sock
+            except socket.error as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        raise error
+
+
+class TimedHTTPSConnection(TimedHTTPConnection, httplib.HTTPSConnection):
+    """
+    httplib.HTTPSConnection with timings. Certificates are verified unless
+    ``disable_ssl_certificate_validation`` is set, against ``ca_certs`` when
+    given (httplib2 passes its bundle) or the system store.
+    """
+    default_port = httplib.HTTPS_PORT
+
+    def __init__(self, host, port=None, key_file=None, cert_file=None,
+                 strict=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 source_address=None, context=None, ca_certs=None,
+                 disable_ssl_certificate_validation=False, **ignored):
+        if context is None:
+            context = ssl.create_default_context(cafile=ca_certs)
+            if disable_ssl_certificate_validation:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+        TimedHTTPConnection.__init__(self, host, port, strict, timeout,
+                                     source_address)
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self._context = context
+
+    def connect(self):
+        sock = self._open_socket()
+        if self._tunnel_host:
+            self.sock = sock
+            self._tunnel()
+            sock = self.sock
+        started = time.time()
+        self.sock = self._context.wrap_socket(
+            sock, server_hostname=self._tunnel_host or self.host)
+        self._pending.tls = time.time() - started
+
+
+class TimedHTTPHandler(urllib2.HTTPHandler):
+    """
+    urllib2 handler leaving the connection it used in ``req.connection``;
+    its ``timings`` are complete once the response has been read.
+    """
+    def http_open(self, req):
+        return self.do_open(_keeping(TimedHTTPConnection, req), req)
+
+
+class TimedHTTPSHandler(urllib2.HTTPSHandler):
+    """The https counterpart of TimedHTTPHandler."""
+    def https_open(self, req):
+        return self.do_open(_keeping(TimedHTTPSConnection, req), req,
+                            context=self._context)
+
+def _keeping(klass, req):
+    def connection(host, **kwargs):
+        req.connection = klass(host, **kwargs)
+        return req.connection
+    return connection
+
+
+def connection_type(url):
+    """
+    The timed connection class for ``url``, for httplib2's
+    ``connection_type``; None when a proxy from the environment applies,
+    which httplib2 then handles itself.
+    """
+    parts = urlsplit(url)
+    if parts.scheme in urllib.getproxies() and not urllib.proxy_bypass(parts.hostname):
+        return None
+    if parts.scheme == 'https':
+        return TimedHTTPSConnection
+    return TimedHTTPConnection
@@ -14,14 +14,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import abc
+import inspect
 import httplib
-import urllib
-import urllib2
 import urlparse
 import logging
+import threading
 import StringIO
 import copy
 
+import paypal_transport
+
+import util
+
+# ACK values of the requests PayPal carried out.
+SUCCESS_ACKS = ( 'Success', 'SuccessWithWarning' )
 
 
 class Profile:
@@ -103,9 +109,29 @@ class Transport( object ):
 		"""Sends request (msg attribute) to the specified url and returns response as a string."""
 
 
+	def send( self, exchange ):
+		"""Sends a paypal_transport.Exchange and returns the response string.
+		Transports that can report the HTTP status should override this 
+		and set exchange.status as well."""
+		exchange.content = self.get_response( exchange.url, exchange.body )
+		return exchange.content
+
+
 class HttpPost( Transport ):
 
+	def __init__( self, timeout=10 ):
+		"""timeout is the socket timeout in seconds."""
+		self._timeout = timeout
+
+
 	def get_response( self, urlString, msg, debug=False ):
+		"""Runs the paypal_transport hooks around the request, 
+		as PayPal.set_response does for the requests it sends."""
+		exchange = paypal_transport.Exchange( 'nvp', None, urlString, msg )
+		return paypal_transport.default_hooks().call( exchange, self.send, debug )
+
+
+	def send( self, exchange, debug=False ):
 
 		if debug:
 			httplib.HTTPConnection.debuglevel = 1
@@ -115,18 +141,21 @@ class HttpPost( Transport ):
 			'Accept': 'text/plain'
 		}
 
-		url = urlparse.urlparse( urlString )
+		url = urlparse.urlparse( exchange.url )
 		conn = None		
 		if url.scheme == 'https':
-			conn = httplib.HTTPSConnection( url.netloc, timeout=10 )
+			conn = paypal_transport.TimedHTTPSConnection( url.netloc, timeout=self._timeout )
 		else:
-			conn = httplib.HTTPConnection( url.netloc, 80, timeout=10 )
+			conn = paypal_transport.TimedHTTPConnection( url.netloc, timeout=self._timeout )
 		try:
-			conn.request('POST', url.path, msg, headers)
+			conn.request('POST', url.path, exchange.body, headers)
 			response = conn.getresponse()
 			logging.getLogger().debug( '%s: %s', response.status, response.reason )
 
-			return response.read()
+			exchange.status = response.status
+			exchange.content = response.read()
+			exchange.timings = response.timings
+			return exchange.content
 			
 		except httplib.HTTPException as e:
 			logging.getLogger().error( e )
@@ -135,10 +164,179 @@ class HttpPost( Transport ):
 
 
 
+class PooledHttpPost( Transport ):
+	"""Sends requests over keep-alive connections, kept in one 
+	paypal_transport.ConnectionPool per host, so repeated calls skip the
+	TCP and TLS handshakes. One instance can be shared by many threads."""
+
+	def __init__( self, size=10, timeout=10 ):
+		"""size is the number of idle connections kept per host, 
+		timeout the socket timeout in seconds."""
+		self._size = size
+		self._timeout = timeout
+		self._pools = dict()
+		self._lock = threading.Lock()
+
+
+	def get_response( self, urlString, msg ):
+		exchange = paypal_transport.Exchange( 'nvp', None, urlString, msg )
+		return self.send( exchange )
+
+
+	def send( self, exchange ):
+
+		headers = {
+			'Content-type': 'application/x-www-form-urlencoded',
+			'Accept': 'text/plain'
+		}
+
+		# A money moving call, or one of unknown method, that may have 
+		# reached PayPal is never sent twice.
+		resend = exchange.method is not None and \
+			exchange.method not in paypal_transport.MONEY_MOVING_METHODS
+
+		url = urlparse.urlparse( exchange.url )
+		try:
+			response = self.pool( url.scheme, url.netloc ).request( 
+				'POST', url.path, exchange.body, headers, resend )
+			logging.getLogger().debug( '%s: %s', response.status, response.reason )
+
+			exchange.status = response.status
+			exchange.content = response.body
+			exchange.timings = response.timings
+			return exchange.content
+
+		except httplib.HTTPException as e:
+			logging.getLogger().error( e )
+
+
+	def pool( self, scheme, netloc ):
+		"""Returns the connection pool for scheme and host."""
+		with self._lock:
+			pool = self._pools.get( (scheme, netloc) )
+			if pool is None:
+				pool = paypal_transport.ConnectionPool( netloc, scheme, 
+					self._size, self._timeout )
+				self._pools[(scheme, netloc)] = pool
+			return pool
+
+
+	def close( self ):
+		with self._lock:
+			pools, self._pools = self._pools, dict()
+		for pool in pools.values():
+			pool.close()
+
+
+
+class MemoryTransport( Transport ):
+	"""Answers from memory without sending anything, for benchmarks and 
+	tests. One instance can be shared by many threads."""
+
+	def __init__( self, answers=None, default='ACK=Success' ):
+		"""answers maps NVP METHOD names to the NVP answer string, or to 
+		a function of the request fields returning it; methods not listed get 
+		default. calls counts the requests per method."""
+		self._answers = dict( answers or {} )
+		self._default = default
+		self.calls = dict()
+
+
+	def get_response( self, urlString, msg ):
+		exchange = paypal_transport.Exchange( 'nvp', None, urlString, msg )
+		return self.send( exchange )
+
+
+	def send( self, exchange ):
+
+		fields = dict( urlparse.parse_qsl(exchange.body or '', True) )
+		method = fields.get( 'METHOD' )
+		self.calls[method] = self.calls.get( method, 0 ) + 1
+
+		answer = self._answers.get( method, self._default )
+		if callable( answer ):
+			answer = answer( fields )
+
+		exchange.status = 200
+		exchange.content = answer
+		return exchange.content
+
+
+
+class ChainTransport( Transport ):
+	"""Sends through transport with a chain of paypal_transport policies 
+	around it, such as MetricsPolicy, RetryPolicy and RateLimitPolicy, 
+	for this transport only:
+
+		ChainTransport( PooledHttpPost(), [ paypal_transport.MetricsPolicy(),
+			paypal_transport.RetryPolicy(), paypal_transport.RateLimitPolicy(limits) ] )
+	
+	The first policy is the outermost one. Chains nest: transport may be a 
+	ChainTransport as well."""
+
+	def __init__( self, transport, policies=None ):
+		if not isinstance(transport, Transport):
+			raise ValueError( 'transport must be an instance of <Transport> class' )
+
+		self.transport = transport
+		self.pipeline = paypal_transport.Pipeline( policies )
+
+
+	def add( self, policy ):
+		"""Appends policy as the innermost policy and returns the chain."""
+		self.pipeline.add( policy )
+		return self
+
+
+	def get_response( self, urlString, msg ):
+		exchange = paypal_transport.Exchange( 'nvp', None, urlString, msg )
+		return self.send( exchange )
+
+
+	def send( self, exchange ):
+		return self.pipeline.send( exchange, self.transport.send )
+
+
+
+class CassetteTransport( Transport ):
+	"""Records what transport sends and PayPal answers into a 
+	paypal_transport.Cassette, or answers from the cassette without sending
+	anything, depending on the cassette's mode."""
+
+	def __init__( self, cassette, transport=None ):
+		"""transport sends the requests while recording, 
+		a new HttpPost when it is not set."""
+		self.cassette = cassette
+		self._transport = transport or HttpPost()
+
+
+	def get_response( self, urlString, msg ):
+		exchange = paypal_transport.Exchange( 'nvp', None, urlString, msg )
+		return self.send( exchange )
+
+
+	def send( self, exchange ):
+
+		if self.cassette.mode == paypal_transport.REPLAY:
+			return self.cassette.replay( exchange )
+
+		result = self._transport.send( exchange )
+		if exchange.content is not None:
+			self.cassette.record( exchange )
+		return result
+
+
+
 class PayPal( object ):
 
 
-	def __init__( self, profile, sandbox=False, apiSignature=True ):
+	def __init__( self, profile, sandbox=False, apiSignature=True, pipeline=None, transport=None ):
+		"""pipeline is the paypal_transport.Pipeline requests are sent through,
+		the process wide default is used when it is not set.
+		transport is the Transport sending the requests, or any object 
+		with its send method (a paypal_emulator.NvpEmulator), or a class 
+		or function returning one, called once here; the transport is kept 
+		for the lifetime of the client. A HttpPost when it is not set."""
 		if not isinstance(profile, Profile): 
 			raise ValueError( 'profile must be an instance of <Profile> class' )
 
@@ -146,6 +344,15 @@ class PayPal( object ):
 		self._sandbox = sandbox
 		self._version = '61.0'
 		self._apiSignature = apiSignature;
+		self._pipeline = pipeline
+
+		if transport is None:
+			transport = HttpPost()
+		elif inspect.isclass(transport) or ( not hasattr(transport, 'send') and callable(transport) ):
+			transport = transport()
+		if not hasattr(transport, 'send'):
+			raise ValueError( 'transport must have a send method like <Transport> class, or be a factory of it' )
+		self._transport = transport
 
 
 	def set_response( self, request ):
@@ -156,27 +363,21 @@ class PayPal( object ):
 		if not isinstance(request, Request): 
 			raise ValueError( 'request must be an instance of <Request> class' )
 
+		encoder = util.NvpEncoder()
 		sb = StringIO.StringIO()
 
 		# profile part
-		params = self._profile.get_nvp_map()
-		for k,v in params.items():
-			params[k] = self._encode_if_necessary( v )
-		sb.write( urllib.urlencode(params) )
-		del ( params )
+		sb.write( encoder.encode(self._profile.get_nvp_map()) )
 		
 		# request part
 		params = request.get_nvp_request()
+		method = params.get( 'METHOD' )
 		if len(params) > 0: sb.write( '&' )
-		for k,v in params.items():
-			params[k] = self._encode_if_necessary( v )
-		sb.write( urllib.urlencode(params) )
+		sb.write( encoder.encode(params) )
 		del ( params )
 
-		params = { 'VERSION': '61.0' }
 		sb.write( '&' )
-		sb.write( urllib.urlencode(params) )
-		del ( params )
+		sb.write( encoder.encode({ 'VERSION': '61.0' }) )
 
 		endpointUrl = StringIO.StringIO()
 		if self._apiSignature:
@@ -187,17 +388,14 @@ class PayPal( object ):
 			endpointUrl.write( 'sandbox.' )
 		endpointUrl.write( 'paypal.com/nvp' )
 
-		transport = HttpPost()
-		response = transport.get_response( endpointUrl.getvalue(), sb.getvalue() )
+		exchange = paypal_transport.Exchange( 'nvp', method, 
+			endpointUrl.getvalue(), sb.getvalue() )
+		pipeline = self._pipeline or paypal_transport.default_pipeline()
+		response = paypal_transport.default_hooks().call( exchange, 
+			pipeline.send, self._transport.send )
 		
 		if response:
-			responseMap = dict()
-			response = urllib2.unquote( response )
-			for data in response.split('&'):
-				keyval = data.split( '=' )
-				responseMap[keyval[0]] = keyval[1]
-			
-			request.set_nvp_response( responseMap )
+			request.set_nvp_response( encoder.decode(response) )
 
 
 	def get_redirect_url( self, request ):
@@ -214,7 +412,7 @@ class PayPal( object ):
 		token    = response['TOKEN']
 
 		# ack is not successfull or token is not set 
-		if ( (ack is None) or (ack not in ['Success',]) ): return None
+		if ( (ack is None) or (ack not in SUCCESS_ACKS) ): return None
 		if ( (token is None) or (len(token) == 0) ): return None
 
 		# return redirect url
@@ -227,8 +425,3 @@ class PayPal( object ):
 		
 		return url.getvalue()
 
-
-	def _encode_if_necessary(self, s):
-		if isinstance(s, unicode):
-			return s.encode('utf-8')
-		return s
\ No newline at end of file
@@ -331,7 +331,7 @@ class PaymentItem( RequestFields ):
 			raise ValueError( 'Value has to be positive integer' )
 
 		self._nvp_request['L_ITEMWEIGHTVALUE'] = '{0}'.format( val )
-		self._nvp_request['L_ITEMWEGHTUNIT'] = unit
+		self._nvp_request['L_ITEMWEIGHTUNIT'] = unit
 
 	
 	def set_length( self, value, unit ):
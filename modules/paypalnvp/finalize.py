@@ -0,0 +1,354 @@
+# Copyright (C) 2011 Luca Sepe <luca.sepe@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+import core
+import requests
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# DoExpressCheckoutPayment errors that sending it again cannot fix: the
+# token is invalid or expired, the invoice id was used, or the buyer has to
+# choose another funding source. Other errors, such as 10001 Internal Error
+# or 10445, may pass, and the checkout is settled with reconcile().
+_FINAL_ERRORS = ( '10410', '10411', '10412', '10417', '10422', '10486' )
+
+# Seconds an Express Checkout token is valid
+TOKEN_LIFETIME = 3 * 60 * 60
+
+
+class _RecordedRequest( core.Request ):
+	"""Request restored from the nvp fields it was queued with."""
+
+	def __init__( self, nvp ):
+		self._nvp_request = nvp
+		self._nvp_response = dict()
+
+
+	def get_nvp_request( self ):
+		return dict( self._nvp_request )
+
+
+	def set_nvp_response( self, nvp_response ):
+		self._nvp_response = dict( nvp_response )
+
+
+	def get_nvp_response( self ):
+		return dict( self._nvp_response )
+
+
+
+class FinalizationQueue( object ):
+	"""DoExpressCheckoutPayment requests waiting to be sent, and the
+	outcome of the ones sent, keyed by token in the sqlite file at path.
+	The file is shared by all web2py processes.
+
+	A checkout moves from queued to running (a worker is sending it), and
+	on to done or failed. attempts counts the sends, checks the times a
+	running checkout was looked at without being settled."""
+
+	_SCHEMA = ( """
+		CREATE TABLE IF NOT EXISTS finalization (
+			token TEXT PRIMARY KEY,
+			request TEXT NOT NULL,
+			state TEXT NOT NULL,
+			attempts INTEGER NOT NULL DEFAULT 0,
+			checks INTEGER NOT NULL DEFAULT 0,
+			response TEXT,
+			created REAL NOT NULL,
+			updated REAL NOT NULL
+		)""",
+		"CREATE INDEX IF NOT EXISTS finalization_state ON finalization (state, updated)",
+	)
+
+	def __init__( self, path ):
+		self._path = path
+		self._local = threading.local()
+		db = self._connection()
+		db.execute( 'PRAGMA journal_mode=WAL' )
+		for statement in self._SCHEMA:
+			db.execute( statement )
+		columns = [ row[1] for row in db.execute( 'PRAGMA table_info(finalization)' ) ]
+		if 'checks' not in columns:
+			# Files made before checks were counted.
+			db.execute( 'ALTER TABLE finalization ADD COLUMN checks INTEGER NOT NULL DEFAULT 0' )
+
+
+	def put( self, token, nvp ):
+		"""Queues the nvp request of a DoExpressCheckoutPayment.
+		Returns False if token was queued before."""
+
+		now = time.time()
+		cursor = self._connection().execute(
+			'INSERT OR IGNORE INTO finalization (token, request, state, created, updated) '
+			'VALUES (?, ?, ?, ?, ?)', ( token, json.dumps(nvp), QUEUED, now, now ) )
+		return cursor.rowcount == 1
+
+
+	def claim( self ):
+		"""Marks the oldest queued checkout running and returns its
+		(token, nvp request, attempts), None if nothing is queued."""
+
+		db = self._connection()
+		db.execute( 'BEGIN IMMEDIATE' )
+		try:
+			row = db.execute(
+				'SELECT token, request, attempts FROM finalization '
+				'WHERE state = ? ORDER BY updated LIMIT 1', (QUEUED,) ).fetchone()
+			if row is not None:
+				db.execute( 'UPDATE finalization SET state = ?, attempts = attempts + 1, '
+					'updated = ? WHERE token = ?', ( RUNNING, time.time(), row[0] ) )
+			db.execute( 'COMMIT' )
+		except Exception:
+			db.execute( 'ROLLBACK' )
+			raise
+		if row is None: return None
+		return ( row[0], json.loads(row[1]), row[2] + 1 )
+
+
+	def finish( self, token, state, response=None ):
+		"""Moves token to state, keeping PayPal's response."""
+		self._connection().execute(
+			'UPDATE finalization SET state = ?, response = ?, updated = ? WHERE token = ?',
+			( state, json.dumps(response) if response is not None else None,
+			  time.time(), token ) )
+
+
+	def touch( self, token ):
+		"""Leaves a running checkout running, to be looked at again later.
+		Returns (checks, created): how many times it was looked at so far,
+		and when it was queued."""
+
+		db = self._connection()
+		db.execute( 'BEGIN IMMEDIATE' )
+		try:
+			db.execute( 'UPDATE finalization SET checks = checks + 1, updated = ? '
+				'WHERE token = ?', ( time.time(), token ) )
+			row = db.execute( 'SELECT checks, created FROM finalization WHERE token = ?',
+				(token,) ).fetchone()
+			db.execute( 'COMMIT' )
+		except Exception:
+			db.execute( 'ROLLBACK' )
+			raise
+		return tuple( row ) if row is not None else ( 0, time.time() )
+
+
+	def claim_stale( self, older_than ):
+		"""Returns (token, attempts) of the checkouts running for more than
+		older_than seconds, and restarts their clock, so only one caller
+		gets each to look at."""
+
+		db = self._connection()
+		db.execute( 'BEGIN IMMEDIATE' )
+		try:
+			now = time.time()
+			rows = db.execute(
+				'SELECT token, attempts FROM finalization WHERE state = ? AND updated < ?',
+				( RUNNING, now - older_than ) ).fetchall()
+			db.execute( 'UPDATE finalization SET updated = ? WHERE state = ? AND updated < ?',
+				( now, RUNNING, now - older_than ) )
+			db.execute( 'COMMIT' )
+		except Exception:
+			db.execute( 'ROLLBACK' )
+			raise
+		return rows
+
+
+	def status( self, token ):
+		"""Returns a dict with the state of token and PayPal's response,
+		None if token was never queued."""
+
+		row = self._connection().execute(
+			'SELECT state, response, attempts FROM finalization WHERE token = ?',
+			(token,) ).fetchone()
+		if row is None: return None
+		return { 'state': row[0], 'attempts': row[2],
+			'response': json.loads(row[1]) if row[1] else None }
+
+
+	def counts( self ):
+		"""Number of checkouts per state."""
+		return dict( self._connection().execute(
+			'SELECT state, COUNT(*) FROM finalization GROUP BY state' ).fetchall() )
+
+
+	def purge( self, older_than ):
+		"""Removes done and failed checkouts older than older_than seconds."""
+		self._connection().execute(
+			'DELETE FROM finalization WHERE state IN (?, ?) AND updated < ?',
+			( DONE, FAILED, time.time() - older_than ) )
+
+
+	def _connection( self ):
+		db = getattr( self._local, 'db', None )
+		if db is None:
+			# Autocommit; multi-statement writes use explicit transactions.
+			db = sqlite3.connect( self._path, timeout=30, isolation_level=None )
+			db.execute( 'PRAGMA synchronous=NORMAL' )
+			self._local.db = db
+		return db
+
+
+
+class Finalizer( object ):
+	"""Completes Express Checkouts in the background.
+
+	The return url handler submit()s the DoExpressCheckoutPayment and shows
+	a "processing" page polling status(); workers threads send the queued
+	requests through paypal, which should use a shared PooledHttpPost so
+	the workers reuse their connections.
+
+	A checkout whose outcome is unknown (no answer from PayPal, or a worker
+	that died mid call, found after claim_timeout seconds) is reconciled
+	with GetExpressCheckoutDetails: completed checkouts are marked done,
+	checkouts PayPal never started are queued again, up to max_attempts.
+	So are checkouts PayPal refused with an error that may pass. The
+	stale checkouts are claimed by one worker at a time.
+	A checkout still unsettled after max_checks lookups, or once its token
+	expired, is marked failed with the last answer."""
+
+	def __init__( self, paypal, queue, workers=4, poll_interval=0.5,
+			claim_timeout=120, max_attempts=5, max_checks=20 ):
+		if not isinstance(paypal, core.PayPal):
+			raise ValueError( 'paypal must be an instance of <PayPal> class' )
+
+		self._paypal = paypal
+		self._queue = queue
+		self._workers = workers
+		self._poll_interval = poll_interval
+		self._claim_timeout = claim_timeout
+		self._max_attempts = max_attempts
+		self._max_checks = max_checks
+		self._wakeup = threading.Event()
+		self._threads = list()
+
+
+	def start( self ):
+		"""Starts the worker threads."""
+		if self._threads: return self
+		for i in range( self._workers ):
+			thread = threading.Thread( target=self._run, name='paypal-finalizer-%d' % i )
+			thread.daemon = True
+			thread.start()
+			self._threads.append( thread )
+		return self
+
+
+	def submit( self, request ):
+		"""Queues request, a DoExpressCheckoutPayment, and returns its token.
+		Submitting the same token again does not queue it twice."""
+
+		if not isinstance(request, requests.DoExpressCheckoutPayment):
+			raise ValueError( 'request must be an instance of <DoExpressCheckoutPayment> class' )
+
+		nvp = request.get_nvp_request()
+		token = nvp['TOKEN']
+		if self._queue.put( token, nvp ):
+			self._wakeup.set()
+		return token
+
+
+	def status( self, token ):
+		"""The state of the checkout token (queued, running, done or
+		failed) and PayPal's response, as a dict; None if unknown."""
+		return self._queue.status( token )
+
+
+	def process( self ):
+		"""Sends one queued checkout. Returns False if nothing was queued.
+		Used by the worker threads, and handy from a scheduler task."""
+
+		claimed = self._queue.claim()
+		if claimed is None: return False
+
+		token, nvp, attempts = claimed
+		request = _RecordedRequest( nvp )
+		try:
+			self._paypal.set_response( request )
+		except Exception:
+			logging.getLogger().exception( 'DoExpressCheckoutPayment %s failed', token )
+
+		response = request.get_nvp_response()
+		ack = response.get( 'ACK' )
+		if ack in core.SUCCESS_ACKS:
+			self._queue.finish( token, DONE, response )
+		elif ack and response.get( 'L_ERRORCODE0' ) in _FINAL_ERRORS:
+			self._queue.finish( token, FAILED, response )
+		else:
+			# No answer, done before (10415, 11607) or a passing error:
+			# ask PayPal what happened, queue it again if nothing did.
+			self.reconcile( token, attempts )
+		return True
+
+
+	def reconcile( self, token, attempts ):
+		"""Settles the running checkout token from GetExpressCheckoutDetails."""
+
+		details = requests.GetExpressCheckoutDetails( str(token) )
+		try:
+			self._paypal.set_response( details )
+		except Exception:
+			logging.getLogger().exception( 'GetExpressCheckoutDetails %s failed', token )
+		response = details.get_nvp_response()
+		status = response.get( 'CHECKOUTSTATUS' )
+
+		if response.get( 'ACK' ) not in core.SUCCESS_ACKS:
+			# PayPal unreachable; look again after claim_timeout.
+			self._unsettled( token, response )
+		elif status == 'PaymentActionCompleted':
+			self._queue.finish( token, DONE, response )
+		elif status == 'PaymentActionFailed':
+			self._queue.finish( token, FAILED, response )
+		elif status == 'PaymentActionNotInitiated':
+			if attempts >= self._max_attempts:
+				self._queue.finish( token, FAILED, response )
+			else:
+				self._queue.finish( token, QUEUED )
+				self._wakeup.set()
+		else:
+			# PaymentActionInProgress
+			self._unsettled( token, response )
+
+
+	def _unsettled( self, token, response ):
+		checks, created = self._queue.touch( token )
+		if checks >= self._max_checks or time.time() - created >= TOKEN_LIFETIME:
+			logging.getLogger().error( 'Express Checkout %s unsettled after %d checks, '
+				'marked failed', token, checks )
+			self._queue.finish( token, FAILED, response )
+
+
+	def _run( self ):
+		last_check = 0
+		while True:
+			try:
+				if time.time() - last_check > self._claim_timeout / 2.0:
+					last_check = time.time()
+					for token, attempts in self._queue.claim_stale( self._claim_timeout ):
+						self.reconcile( token, attempts )
+				if not self.process():
+					self._wakeup.wait( self._poll_interval )
+					self._wakeup.clear()
+			except Exception:
+				logging.getLogger().exception( 'Finalizer worker failed' )
+				time.sleep( self._poll_interval )
@@ -0,0 +1,219 @@
+# Copyright (C) 2011 Luca Sepe <luca.sepe@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import Queue
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import core
+
+# PayPal expires Express Checkout tokens after three hours.
+TOKEN_LIFETIME = 3 * 60 * 60
+
+
+def cart_hash( request, owner=None ):
+	"""Hash of the nvp request of a SetExpressCheckout request, that
+	is of the cart contents, amounts and urls. owner (typically the
+	session id) is part of the hash, so buyers never share a token."""
+
+	h = hashlib.sha1()
+	h.update( repr(owner) )
+	for k, v in sorted( request.get_nvp_request().items() ):
+		if isinstance( v, unicode ):
+			v = v.encode( 'utf-8' )
+		h.update( '\x00%s=%s' % (k, v) )
+	return h.hexdigest()
+
+
+class _Entry( object ):
+
+	def __init__( self, request ):
+		self.request = request
+		self.created = time.time()
+		self.done = threading.Event()
+
+
+class TokenPrefetcher( object ):
+	"""Requests Express Checkout tokens in the background while the
+	buyer looks at the cart, so the checkout click can redirect at once.
+
+	prefetch() is called when the cart or review page renders and
+	queues the SetExpressCheckout. checkout() is called on the click:
+	if a token for the very same cart is ready (or arrives within wait
+	seconds) its response is copied into the request, otherwise the
+	SetExpressCheckout is sent synchronously. Either way the redirect
+	url is returned. A token is handed out once and tokens are dropped
+	max_age seconds after they were requested, well before PayPal
+	expires them. At most max_entries tokens are kept: the oldest ready
+	one makes room for a new cart, and nothing is prefetched while all
+	of them are still being requested.
+
+	checkout() also keeps an index of the checkouts in flight: a second
+	checkout of the same cart by the same owner while the first is being
+	sent, or up to window seconds after it was submitted (a double click,
+	a reload), joins the first one and gets the same token and redirect
+	url instead of sending another SetExpressCheckout. With workers=0
+	nothing is prefetched and only the index is used.
+
+	owner identifies the buyer (the session id) and is required: buyers
+	without one would share each other's tokens."""
+
+	def __init__( self, paypal, workers=2, max_age=TOKEN_LIFETIME - 30 * 60, wait=1.0,
+			window=30, join_timeout=15, max_entries=1000 ):
+		if not isinstance(paypal, core.PayPal):
+			raise ValueError( 'paypal must be an instance of <PayPal> class' )
+
+		self._paypal = paypal
+		self._max_age = max_age
+		self._wait = wait
+		self._window = window
+		self._join_timeout = join_timeout
+		self._max_entries = max_entries
+		# Oldest first.
+		self._entries = OrderedDict()
+		self._checkouts = dict()
+		self._lock = threading.Lock()
+		self._queue = Queue.Queue()
+		self.hits = 0
+		self.misses = 0
+		self.joined = 0
+		self.skipped = 0
+
+		for i in range( workers ):
+			worker = threading.Thread( target=self._work, name='paypal-ec-prefetch-%d' % i )
+			worker.daemon = True
+			worker.start()
+
+
+	def prefetch( self, request, owner ):
+		"""Queues request, a SetExpressCheckout, unless a token for the
+		same cart is already available or on its way. Returns the cart hash."""
+
+		if owner is None:
+			raise ValueError( 'owner must be set' )
+		key = cart_hash( request, owner )
+		with self._lock:
+			self._evict()
+			if key in self._entries: return key
+			if not self._make_room():
+				self.skipped += 1
+				return key
+			entry = _Entry( request )
+			self._entries[key] = entry
+		self._queue.put( entry )
+		return key
+
+
+	def checkout( self, request, owner ):
+		"""Sets the response of request, a SetExpressCheckout, from a
+		prefetched token if there is one for the same cart, or by sending
+		it. Returns the redirect url, None if PayPal refused the request."""
+
+		if owner is None:
+			raise ValueError( 'owner must be set' )
+		key = cart_hash( request, owner )
+		with self._lock:
+			self._evict()
+			current = self._checkouts.get( key )
+			joining = current is not None
+			if not joining:
+				current = self._checkouts[key] = _Entry( request )
+
+		if joining:
+			# Same cart submitted again: hand out the same token.
+			if current.done.wait( self._join_timeout ):
+				response = current.request.get_nvp_response()
+				if response and response.get( 'ACK' ) in core.SUCCESS_ACKS:
+					self.joined += 1
+					request.set_nvp_response( dict(response) )
+					return self._paypal.get_redirect_url( request )
+			return self._checkout( key, request )
+
+		try:
+			return self._checkout( key, request )
+		finally:
+			response = request.get_nvp_response()
+			if not response or response.get( 'ACK' ) not in core.SUCCESS_ACKS:
+				# Failed; let the next submission try on its own.
+				with self._lock:
+					if self._checkouts.get( key ) is current: del self._checkouts[key]
+			current.done.set()
+
+
+	def size( self ):
+		"""Number of tokens ready or being requested."""
+		with self._lock:
+			return len( self._entries )
+
+
+	def _checkout( self, key, request ):
+		with self._lock:
+			entry = self._entries.get( key )
+
+		if entry is not None and entry.done.wait( self._wait ):
+			with self._lock:
+				# Tokens are single use; whoever pops the entry gets it.
+				claimed = self._entries.pop( key, None ) is entry
+			response = entry.request.get_nvp_response()
+			if claimed and response and response.get( 'ACK' ) in core.SUCCESS_ACKS:
+				self.hits += 1
+				request.set_nvp_response( dict(response) )
+				return self._paypal.get_redirect_url( request )
+
+		self.misses += 1
+		self._paypal.set_response( request )
+		return self._paypal.get_redirect_url( request )
+
+
+	def _evict( self ):
+		# Must be called with self._lock held.
+		limit = time.time() - self._max_age
+		for key, entry in self._entries.items():
+			if entry.created >= limit: break
+			del self._entries[key]
+		limit = time.time() - self._window
+		for key, entry in self._checkouts.items():
+			if entry.created < limit and entry.done.is_set():
+				del self._checkouts[key]
+
+
+	def _make_room( self ):
+		# Must be called with self._lock held. Drops the oldest ready
+		# token when full; False if every entry is still being requested.
+		if len( self._entries ) < self._max_entries: return True
+		for key, entry in self._entries.items():
+			if entry.done.is_set():
+				del self._entries[key]
+				return True
+		return False
+
+
+	def _work( self ):
+		while True:
+			entry = self._queue.get()
+			try:
+				self._paypal.set_response( entry.request )
+			except Exception:
+				logging.getLogger().exception( 'Express Checkout prefetch failed' )
+			response = entry.request.get_nvp_response()
+			if not response or response.get( 'ACK' ) not in core.SUCCESS_ACKS:
+				# Let the next prefetch of this cart try again.
+				with self._lock:
+					for key, other in self._entries.items():
+						if other is entry: del self._entries[key]
+			entry.done.set()
@@ -400,16 +400,18 @@ class SetExpressCheckout( core.Request ):
 		# shipping options
 		i = 0
 		for option in self._shipping_options:
-			for k, v in option:
+			for k, v in option.items():
 				# KEYn VALUE
 				nvp['{0}{1}'.format(k,i)] = v	
+			i = i + 1
 
 		# billing agreement 
 		i = 0
 		for agreement in self._billing_agreement:
-			for k, v in agreement:
+			for k, v in agreement.items():
 				# KEYn VALUE
 				nvp['{0}{1}'.format(k,i)] = v
+			i = i + 1
 
 		return nvp
 
@@ -427,9 +429,6 @@ class GetExpressCheckoutDetails( core.Request ):
 		self._nvp_response = dict()
 		self._nvp_request = dict()
 		self._nvp_request['METHOD'] = 'GetExpressCheckoutDetails'
-		
-		nvp = copy.deepcopy( payment.get_nvp_request() )
-		self._nvp_request.update( nvp )
 		self._nvp_request['TOKEN'] = token
 
 	
@@ -0,0 +1,148 @@
+# Copyright (C) 2011 Luca Sepe <luca.sepe@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import json
+import time
+import sqlite3
+import threading
+
+import core
+import fields
+import requests
+import prefetch
+
+class _RecordedPayment( fields.Payment ):
+	"""Payment restored from the nvp fields it was sent with."""
+
+	def __init__( self, nvp ):
+		fields.Payment.__init__( self )
+		self._nvp = copy.deepcopy( nvp )
+
+
+	def get_nvp_request( self ):
+		return copy.deepcopy( self._nvp )
+
+
+class CheckoutSessionStore( object ):
+	"""Keeps every SetExpressCheckout sent, with its payment and response,
+	keyed by token in the sqlite file at path.
+
+	When the buyer comes back from PayPal, the DoExpressCheckoutPayment can
+	then be built from the recorded payment and the PayerID of the return
+	url, without asking PayPal for the details with GetExpressCheckoutDetails.
+	The file is shared by all web2py processes."""
+
+	_SCHEMA = """
+		CREATE TABLE IF NOT EXISTS checkout_session (
+			token TEXT PRIMARY KEY,
+			payment TEXT NOT NULL,
+			request TEXT NOT NULL,
+			response TEXT NOT NULL,
+			created REAL NOT NULL
+		)"""
+
+	def __init__( self, path, max_age=prefetch.TOKEN_LIFETIME ):
+		self._path = path
+		self._max_age = max_age
+		self._local = threading.local()
+		db = self._connection()
+		db.execute( 'PRAGMA journal_mode=WAL' )
+		db.execute( self._SCHEMA )
+
+
+	def record( self, request, payment ):
+		"""Records request, a SetExpressCheckout PayPal answered, and
+		payment, the fields.Payment it was created with.
+		Returns the token, None if PayPal did not hand one out."""
+
+		if not isinstance(request, requests.SetExpressCheckout):
+			raise ValueError( 'request must be an instance of <SetExpressCheckout> class' )
+		if not isinstance(payment, fields.Payment):
+			raise ValueError( 'payment must be an instance of class <Payment>.' )
+
+		response = request.get_nvp_response()
+		token = response.get( 'TOKEN' )
+		if not token or response.get( 'ACK' ) not in core.SUCCESS_ACKS: return None
+
+		self._connection().execute(
+			'INSERT OR REPLACE INTO checkout_session VALUES (?, ?, ?, ?, ?)',
+			( token, json.dumps(payment.get_nvp_request()),
+			  json.dumps(request.get_nvp_request()), json.dumps(response), time.time() ) )
+		return token
+
+
+	def get( self, token ):
+		"""Returns the recorded session as a dict with payment, request
+		and response nvp maps, None if the token is unknown or expired."""
+
+		row = self._connection().execute(
+			'SELECT payment, request, response FROM checkout_session '
+			'WHERE token = ? AND created > ?',
+			( token, time.time() - self._max_age ) ).fetchone()
+		if row is None: return None
+		return { 'payment': json.loads(row[0]), 'request': json.loads(row[1]),
+			'response': json.loads(row[2]) }
+
+
+	def needs_details( self, token, need_address=False ):
+		"""True when GetExpressCheckoutDetails has to be called before
+		the payment is completed: the token is not recorded here, the
+		buyer picked the shipping option at PayPal through the Instant
+		Update callback, so the amounts may have changed, or the shipping
+		address the buyer chose at PayPal is needed (need_address)."""
+
+		session = self.get( token )
+		if session is None: return True
+		request = session['request']
+		if 'CALLBACK' in request: return True
+		return need_address and request.get( 'NOSHIPPING' ) != '1'
+
+
+	def do_express_checkout_payment( self, token, payer_id, payment_action=None ):
+		"""Returns the DoExpressCheckoutPayment request completing the
+		recorded checkout for payer_id, the PayerID parameter of the return
+		url. payment_action defaults to the one of the SetExpressCheckout,
+		else Sale. Returns None if the token is not recorded."""
+
+		session = self.get( token )
+		if session is None: return None
+
+		if payment_action is None:
+			payment_action = session['request'].get( 'PAYMENTACTION', 'Sale' )
+		payment = _RecordedPayment( session['payment'] )
+		return requests.DoExpressCheckoutPayment( payment, str(token),
+			payment_action, str(payer_id) )
+
+
+	def forget( self, token ):
+		"""Removes a completed or cancelled checkout."""
+		self._connection().execute(
+			'DELETE FROM checkout_session WHERE token = ?', (token,) )
+
+
+	def purge( self ):
+		"""Removes the checkouts whose token expired."""
+		self._connection().execute(
+			'DELETE FROM checkout_session WHERE created <= ?',
+			( time.time() - self._max_age, ) )
+
+
+	def _connection( self ):
+		db = getattr( self._local, 'db', None )
+		if db is None:
+			db = self._local.db = sqlite3.connect( self._path, timeout=30,
+				isolation_level=None )
+		return db
@@ -0,0 +1,233 @@
+# Copyright (C) 2011 Luca Sepe <luca.sepe@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import threading
+
+import util
+import fields
+
+# Weight units PayPal sends with the items (L_ITEMWEIGHTUNITn), in grams.
+WEIGHT_UNITS = { 'g': 1.0, 'kg': 1000.0, 'kgs': 1000.0,
+	'oz': 28.349523125, 'lb': 453.59237, 'lbs': 453.59237 }
+
+_NO_OPTIONS = 'METHOD=CallbackResponse&NO_SHIPPING_OPTION_DETAILS=1'
+
+
+class RateTable( object ):
+	"""Shipping rates by destination and weight, for answering Instant
+	Update callbacks.
+
+	Rates are added per country and postal code prefix ('' for the whole
+	country) with the maximum weight they apply to. build() turns them into
+	lookup tables: a dict keyed by country and prefix holding the weight
+	band bounds, and per band the shipping options already NVP encoded, so
+	answering a callback takes a few dict lookups and one bisect."""
+
+	def __init__( self, currency='EUR', weight_unit='kgs' ):
+		self._currency = currency
+		self._unit = WEIGHT_UNITS[weight_unit]
+		self._rates = list()
+		self._tax = dict()
+		# (index, prefix lengths by country), replaced as a whole by build()
+		self._tables = ( dict(), dict() )
+		self._lock = threading.Lock()
+
+
+	def get_currency( self ):
+		return self._currency
+
+
+	def add_rate( self, country, name, amount, max_weight=None,
+			postal_prefix='', label=None, default=False ):
+		"""Offers shipping option name for amount (string with two
+		decimals, like "4.95") to country, or to the postal codes starting
+		with postal_prefix, for orders weighing up to max_weight (in the
+		weight unit of the table, None for any weight).
+
+		When several rates of one name apply, the one with the lowest
+		max_weight is used. default marks the option PayPal selects; without
+		one the cheapest option is the default."""
+
+		v = util.Validator()
+		if not v.is_valid_amount( amount ):
+			raise ValueError( 'Amount {0} is not valid.'.format(amount) )
+
+		self._rates.append( ( country.upper(), self._normalize(postal_prefix),
+			max_weight, name, label or name, amount, default ) )
+
+
+	def set_tax_rate( self, country, rate ):
+		"""Tax on the item amount for country, as a fraction (0.21)."""
+		self._tax[country.upper()] = rate
+
+
+	def build( self ):
+		"""Precomputes the lookup tables. Call it after adding the rates;
+		the tables are swapped in at once, lookups never see half of them."""
+
+		encoder = util.NvpEncoder()
+		grouped = dict()
+		for rate in self._rates:
+			grouped.setdefault( (rate[0], rate[1]), list() ).append( rate )
+
+		index = dict()
+		prefix_lengths = dict()
+		for (country, prefix), rates in grouped.items():
+			bounds = sorted( set( r[2] for r in rates if r[2] is not None ) )
+			if [ r for r in rates if r[2] is None ]:
+				bounds.append( None )
+
+			bands = list()
+			for bound in bounds:
+				chosen = dict()
+				for rate in rates:
+					if not _covers( rate[2], bound ): continue
+					best = chosen.get( rate[3] )
+					if best is None or _covers( best[2], rate[2] ):
+						chosen[rate[3]] = rate
+				options = sorted( chosen.values(), key=lambda r: _cents(r[5]) )
+				bands.append( (len(options), encoder.encode(self._encode(options))) )
+
+			limits = [ b for b in bounds if b is not None ]
+			index[(country, prefix)] = ( [ b * self._unit for b in limits ], bands )
+			prefix_lengths.setdefault( country, set() ).add( len(prefix) )
+
+		prefix_lengths = dict( (c, tuple(sorted(l, reverse=True)))
+			for c, l in prefix_lengths.items() )
+		with self._lock:
+			self._tables = ( index, prefix_lengths )
+
+
+	def lookup( self, country, postal_code, grams ):
+		"""Returns (number of options, encoded options) for a shipment of
+		grams to country and postal_code, None if no rate applies."""
+
+		index, prefix_lengths = self._tables
+		country = (country or '').upper()
+		postal_code = self._normalize( postal_code )
+		for length in prefix_lengths.get( country, () ):
+			entry = index.get( (country, postal_code[:length]) )
+			if entry is None: continue
+			limits, bands = entry
+			i = bisect.bisect_left( limits, grams )
+			if i < len(bands):
+				return bands[i]
+		return None
+
+
+	def tax_rate( self, country ):
+		return self._tax.get( (country or '').upper() )
+
+
+	def shipping_options( self, country, postal_code='', weight=0 ):
+		"""The options for a shipment of weight (in the weight unit of the
+		table) as fields.ShippingOptions, for the flat rates
+		SetExpressCheckout has to carry along with a callback url."""
+
+		found = self.lookup( country, postal_code, weight * self._unit )
+		if found is None: return list()
+		nvp = util.NvpEncoder().decode( found[1] )
+		options = list()
+		for i in range( found[0] ):
+			option = fields.ShippingOptions()
+			option.set_shipping_name( nvp['L_SHIPPINGOPTIONNAME%d' % i] )
+			option.set_shipping_label( nvp['L_SHIPPINGOPTIONLABEL%d' % i] )
+			option.set_shipping_amount( nvp['L_SHIPPINGOPTIONAMOUNT%d' % i] )
+			option.set_default_shipping_option(
+				nvp['L_SHIPPINGOPTIONISDEFAULT%d' % i] == 'true' )
+			options.append( option )
+		return options
+
+
+	def _encode( self, options ):
+		default = [ r for r in options if r[6] ][:1] or options[:1]
+		pairs = list()
+		for i, rate in enumerate( options ):
+			pairs.append( ('L_SHIPPINGOPTIONNAME%d' % i, rate[3]) )
+			pairs.append( ('L_SHIPPINGOPTIONLABEL%d' % i, rate[4]) )
+			pairs.append( ('L_SHIPPINGOPTIONAMOUNT%d' % i, rate[5]) )
+			pairs.append( ('L_SHIPPINGOPTIONISDEFAULT%d' % i,
+				'true' if rate is default[0] else 'false') )
+		return pairs
+
+
+	def _normalize( self, postal_code ):
+		return (postal_code or '').replace( ' ', '' ).upper()
+
+
+
+class ShippingCallback( object ):
+	"""Answers PayPal's Instant Update callback requests from a RateTable.
+
+	The weight of the order is the sum of L_ITEMWEIGHTVALUEn times L_QTYn,
+	as set with PaymentItem.set_weight and set_quantity on the items of the
+	SetExpressCheckout."""
+
+	def __init__( self, table ):
+		if not isinstance(table, RateTable):
+			raise ValueError( 'table must be an instance of <RateTable> class' )
+		self._table = table
+		self._encoder = util.NvpEncoder()
+
+
+	def respond( self, body ):
+		"""Returns the CallbackResponse NVP string for the callback request body."""
+
+		nvp = self._encoder.decode( body )
+		currency = nvp.get( 'CURRENCYCODE', self._table.get_currency() )
+		if currency != self._table.get_currency():
+			return _NO_OPTIONS
+
+		grams = 0.0
+		items = 0
+		i = 0
+		while 'L_AMT%d' % i in nvp or 'L_NAME%d' % i in nvp:
+			quantity = int( nvp.get('L_QTY%d' % i) or 1 )
+			weight = nvp.get( 'L_ITEMWEIGHTVALUE%d' % i )
+			if weight:
+				unit = WEIGHT_UNITS.get( nvp.get('L_ITEMWEIGHTUNIT%d' % i, 'kgs').lower(), 1000.0 )
+				grams += float( weight ) * unit * quantity
+			items += _cents( nvp.get('L_AMT%d' % i) ) * quantity
+			i = i + 1
+
+		country = nvp.get( 'SHIPTOCOUNTRY' )
+		found = self._table.lookup( country, nvp.get('SHIPTOZIP'), grams )
+		if found is None:
+			return _NO_OPTIONS
+
+		count, options = found
+		parts = [ 'METHOD=CallbackResponse&CURRENCYCODE=', currency, '&', options ]
+		rate = self._table.tax_rate( country )
+		if rate:
+			tax = '%d.%02d' % divmod( int(round(items * rate)), 100 )
+			for n in range( count ):
+				parts.append( '&L_TAXAMT%d=%s' % (n, tax) )
+		return ''.join( parts )
+
+
+
+def _covers( max_weight, bound ):
+	# True if a rate up to max_weight (None: any) covers weights up to bound
+	if max_weight is None: return True
+	if bound is None: return False
+	return max_weight >= bound
+
+
+def _cents( amount ):
+	try:
+		return int( round(float(amount or 0) * 100) )
+	except ValueError:
+		return 0
@@ -17,6 +17,8 @@
 
 import datetime
 import re
+import urllib
+import urlparse
 
 
 
@@ -79,6 +81,39 @@ class FormatFields( object ):
 
 
 
+class NvpEncoder( object ):
+
+	"""Encodes and decodes NVP (name value pair) messages, 
+	the body of PayPal requests and responses."""
+
+
+	def encode( self, params ):
+		"""Returns params, a dict or a list of (name, value) pairs, 
+		as an url encoded NVP string. Unicode values are sent as utf-8."""
+
+		if isinstance( params, dict ):
+			params = params.items()
+		return urllib.urlencode( [ (k, self._utf8(v)) for k, v in params ] )
+
+
+	def decode( self, text ):
+		"""Returns the NVP string text as a dict. 
+		A name repeated in text keeps its first value."""
+
+		nvp = dict()
+		for k, v in urlparse.parse_qsl( text, keep_blank_values=True ):
+			nvp.setdefault( k, v )
+		return nvp
+
+
+	def _utf8( self, s ):
+		if isinstance( s, unicode ):
+			return s.encode( 'utf-8' )
+		return s
+
+
+
+
 class Validator( object ):
 
 	def __init__( self ):
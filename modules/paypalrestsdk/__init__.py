@@ -1,5 +1,6 @@
 from paypalrestsdk.api         import Api, set_config
 from paypalrestsdk.payments    import Payment, Sale, Refund
 from paypalrestsdk.vault       import CreditCard
+from paypalrestsdk.webhooks    import WebhookReceiver, CertificateCache, DedupeIndex
 from paypalrestsdk.exceptions  import *
 from paypalrestsdk.version     import __version__
@@ -5,10 +5,14 @@ import logging, datetime, os, platform
 #from paypalrestsdk.exceptions import *
 #from paypalrestsdk.version    import __version__
 
+import paypal_transport
+
 import util
 from exceptions import *
 from version import __version__
 
+log = logging.getLogger(__name__)
+
 class Api:
 
   # User-Agent for HTTP request
@@ -19,6 +23,8 @@ class Api:
   #   import paypalrestsdk
   #   api = paypalrestsdk.Api( mode="sandbox", 
   #          client_id='CLIENT_ID', client_secret='CLIENT_SECRET', ssl_options={} )
+  #
+  # Pass pipeline= to use a paypal_transport.Pipeline other than the default.
   def __init__(self, **args):
     self.mode           = args.get("mode", "sandbox")
     self.endpoint       = args.get("endpoint", self.default_endpoint())
@@ -26,6 +32,7 @@ class Api:
     self.client_id      = args.get("client_id")
     self.client_secret  = args.get("client_secret")
     self.ssl_options    = args.get("ssl_options", {})
+    self.pipeline       = args.get("pipeline")
 
     self.token_hash       = None
     self.token_request_at = None
@@ -79,7 +86,7 @@ class Api:
     http_headers = util.merge_dict(self.headers(), headers)
 
     if http_headers.get('PayPal-Request-Id'):
-      logging.info('PayPal-Request-Id: %s'%(http_headers['PayPal-Request-Id']))
+      log.info('PayPal-Request-Id: %s', http_headers['PayPal-Request-Id'])
 
     try:
       return self.http_call(url, method, body= body, headers= http_headers)
@@ -98,14 +105,32 @@ class Api:
 
   # Make http Call
   def http_call(self, url, method, **args):
-    logging.info('Request[%s]: %s'%(method, url))
-    http = httplib2.Http(**self.ssl_options)
-    start_time = datetime.datetime.now()
-    response, content = http.request(url, method, **args)
-    duration   = datetime.datetime.now() - start_time
-    logging.info('Response[%d]: %s, Duration: %s.%ss'%(response.status, response.reason, duration.seconds, duration.microseconds))
+    log.debug('Request[%s]: %s', method, url)
+    exchange = paypal_transport.Exchange('rest', "%s %s"%(method, util.path_template(url)),
+      url, args.get("body"), args.get("headers"), verb= method)
+    pipeline = self.pipeline or paypal_transport.default_pipeline()
+    content  = paypal_transport.default_hooks().call(exchange, pipeline.send, self.transmit)
+    response = exchange.response
+    if response is None:
+      # Served by the transport layer, e.g. replayed from an idempotency store
+      response = httplib2.Response({ "status": exchange.status })
+    else:
+      log.debug('Response[%d]: %s, Duration: %.3fs', response.status, response.reason, exchange.elapsed)
     return self.handle_response(response, content.decode('utf-8'))
 
+  # Send the request of a paypal_transport.Exchange, called through the pipeline
+  def transmit(self, exchange):
+    http = httplib2.Http(**self.ssl_options)
+    response, content = http.request(exchange.url, exchange.verb,
+      body= exchange.body, headers= exchange.headers,
+      connection_type= paypal_transport.timing.connection_type(exchange.url))
+    exchange.status   = response.status
+    exchange.response = response
+    exchange.content  = content
+    for connection in http.connections.values():
+      exchange.timings = getattr(connection, "timings", None)
+    return content
+
   # Validate HTTP response
   def handle_response(self, response, content):
     status = response.status
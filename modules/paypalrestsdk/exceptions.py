@@ -69,3 +69,6 @@ class ServerError(ConnectionError): pass
 class MethodNotAllowed(ClientError):
   def allowed_methods(self):
     return self.response['Allow']
+
+# Webhook delivery with a missing or invalid signature
+class WebhookVerificationError(Exception): pass
@@ -1,8 +1,9 @@
 import re
 try:
-  from urllib.parse import urlencode
+  from urllib.parse import urlencode, urlsplit
 except ImportError:
   from urllib import urlencode
+  from urlparse import urlsplit
 
 # Join given url
 # == Example
@@ -22,3 +23,13 @@ def merge_dict(data, *override):
   for value in override:
     dict_list = dict_list + list(value.items())
   return dict(dict_list)
+
+# Path of url with resource ids replaced by {id}
+# == Example
+#   path_template("https://api.paypal.com/v1/payments/sale/4RR959492F879224U/refund")
+#   # Return "v1/payments/sale/{id}/refund"
+id_segment = re.compile(r'^(?=.*[0-9])[A-Za-z0-9-]{8,}$')
+
+def path_template(url):
+  segments = urlsplit(url).path.strip('/').split('/')
+  return '/'.join([ '{id}' if id_segment.match(s) else s for s in segments ])
@@ -0,0 +1,207 @@
+import json, zlib, base64, threading, logging
+import httplib2
+from collections import OrderedDict
+
+try:
+  from OpenSSL import crypto
+except ImportError:
+  crypto = None
+
+try:
+  from urllib.parse import urlsplit
+except ImportError:
+  from urlparse import urlsplit
+
+from exceptions import *
+
+# Least recently used cache of PayPal signing certificates, keyed by cert URL.
+# Certificates are downloaded and parsed once; verifying an event whose
+# certificate is cached needs no network I/O.
+# == Example
+#   cache = CertificateCache(size = 16)
+#   cert  = cache.get("https://api.paypal.com/v1/notifications/certs/CERT-360caa42-fca2a594-a5cafa77")
+class CertificateCache(object):
+
+  def __init__(self, size = 16, trusted_hosts = (".paypal.com",), ssl_options = {}):
+    self.size          = size
+    self.trusted_hosts = trusted_hosts
+    self.ssl_options   = ssl_options
+    self.fetches       = 0
+    self.certs         = OrderedDict()
+    self.lock          = threading.Lock()
+    self.fetch_lock    = threading.Lock()
+
+  def get(self, url):
+    cert = self.lookup(url)
+    if cert is not None:
+      return cert
+    # One download per certificate, however many deliveries wait for it
+    with self.fetch_lock:
+      cert = self.lookup(url)
+      if cert is not None:
+        return cert
+      cert = self.fetch(url)
+      with self.lock:
+        self.certs[url] = cert
+        while len(self.certs) > self.size:
+          self.certs.popitem(last = False)
+    return cert
+
+  def lookup(self, url):
+    with self.lock:
+      cert = self.certs.pop(url, None)
+      if cert is not None:
+        self.certs[url] = cert
+      return cert
+
+  # Download and parse a certificate; only hosts in trusted_hosts are asked,
+  # or anyone could sign events with their own certificate.
+  def fetch(self, url):
+    parts = urlsplit(url)
+    if parts.scheme != "https" and parts.hostname not in ("localhost", "127.0.0.1"):
+      raise WebhookVerificationError("Certificate URL must use https: %s"%(url))
+    if not [ host for host in self.trusted_hosts
+             if parts.hostname == host.lstrip(".") or parts.hostname.endswith(host) ]:
+      raise WebhookVerificationError("Untrusted certificate URL: %s"%(url))
+    response, content = httplib2.Http(**self.ssl_options).request(url, "GET")
+    if response.status != 200:
+      raise WebhookVerificationError("Could not fetch certificate %s: %s"%(url, response.status))
+    self.fetches += 1
+    return crypto.load_certificate(crypto.FILETYPE_PEM, content)
+
+# Bounded set of recently seen event ids
+class DedupeIndex(object):
+
+  def __init__(self, size = 100000):
+    self.size = size
+    self.seen = OrderedDict()
+    self.lock = threading.Lock()
+
+  # Return True the first time an id is added, False afterwards
+  def add(self, key):
+    with self.lock:
+      if key in self.seen:
+        return False
+      self.seen[key] = True
+      while len(self.seen) > self.size:
+        self.seen.popitem(last = False)
+      return True
+
+# Receive PayPal REST webhooks: verify, dedupe and hand events to handlers in batches
+# == Example
+#   receiver = WebhookReceiver("WEBHOOK_ID")
+#   receiver.on("PAYMENT.SALE.COMPLETED", mark_orders_paid)   # called with a list of events
+#   receiver.on("*", log_events)
+#
+#   # In the controller
+#   receiver.receive(request.env, request.body.read())
+class WebhookReceiver(object):
+
+  def __init__(self, webhook_id, cert_cache = None, dedupe = None,
+               batch_size = 100, max_delay = 0.5):
+    self.webhook_id = webhook_id
+    self.cert_cache = cert_cache or CertificateCache()
+    self.dedupe     = dedupe or DedupeIndex()
+    self.batch_size = batch_size
+    self.max_delay  = max_delay
+    self.handlers   = {}
+    self.received   = 0
+    self.duplicates = 0
+    self.pending    = []
+    self.condition  = threading.Condition(threading.Lock())
+    self.dispatcher = None
+
+  # Register handler for event_type, "*" for every event
+  def on(self, event_type, handler):
+    self.handlers.setdefault(event_type, []).append(handler)
+
+  # Verify and queue one webhook delivery. Return False for a redelivered
+  # event, raise WebhookVerificationError for a bad signature.
+  def receive(self, headers, body):
+    event = self.verify(headers, body)
+    if event.get("id") and not self.dedupe.add(event["id"]):
+      self.duplicates += 1
+      return False
+    self.received += 1
+    self.start()
+    with self.condition:
+      self.pending.append(event)
+      if len(self.pending) >= self.batch_size:
+        self.condition.notify()
+    return True
+
+  # Check the transmission signature and return the decoded event
+  def verify(self, headers, body):
+    transmission_id   = header(headers, "PAYPAL-TRANSMISSION-ID")
+    transmission_time = header(headers, "PAYPAL-TRANSMISSION-TIME")
+    signature         = header(headers, "PAYPAL-TRANSMISSION-SIG")
+    cert_url          = header(headers, "PAYPAL-CERT-URL")
+    algorithm         = header(headers, "PAYPAL-AUTH-ALGO") or "SHA256withRSA"
+    if not (transmission_id and transmission_time and signature and cert_url):
+      raise WebhookVerificationError("Missing PayPal transmission headers")
+    if crypto is None:
+      raise WebhookVerificationError("pyOpenSSL is required to verify webhook signatures")
+
+    expected = "%s|%s|%s|%d"%(transmission_id, transmission_time, self.webhook_id,
+      zlib.crc32(body) & 0xffffffff)
+    digest = algorithm.lower().split("with")[0]
+    try:
+      crypto.verify(self.cert_cache.get(cert_url), base64.b64decode(signature), expected, digest)
+    except (crypto.Error, TypeError, ValueError):
+      raise WebhookVerificationError("Invalid webhook signature")
+    try:
+      return json.loads(body)
+    except ValueError:
+      raise WebhookVerificationError("Webhook body is not JSON")
+
+  # Start the dispatcher thread
+  def start(self):
+    if self.dispatcher is None:
+      with self.condition:
+        if self.dispatcher is None:
+          self.dispatcher = threading.Thread(target = self.dispatch_loop, name = "paypal-webhook-dispatcher")
+          self.dispatcher.daemon = True
+          self.dispatcher.start()
+
+  # Hand every queued event to the handlers now
+  def flush(self):
+    with self.condition:
+      events, self.pending = self.pending, []
+    if events:
+      self.dispatch(events)
+
+  def dispatch(self, events):
+    by_type = {}
+    for event in events:
+      by_type.setdefault(event.get("event_type"), []).append(event)
+    for event_type, batch in by_type.items():
+      for handler in self.handlers.get(event_type, []):
+        self.call(handler, batch)
+    for handler in self.handlers.get("*", []):
+      self.call(handler, events)
+
+  def call(self, handler, events):
+    try:
+      handler(events)
+    except Exception:
+      logging.exception("Webhook handler %r failed"%(handler))
+
+  def dispatch_loop(self):
+    while True:
+      with self.condition:
+        if len(self.pending) < self.batch_size:
+          self.condition.wait(self.max_delay)
+        events, self.pending = self.pending, []
+      if events:
+        self.dispatch(events)
+
+# Header lookup for plain dicts as well as WSGI environ (HTTP_PAYPAL_...)
+def header(headers, name):
+  for key in (name, name.lower(), "HTTP_" + name.replace("-", "_"), name.replace("-", "_").lower()):
+    value = headers.get(key)
+    if value is not None:
+      return value
+  for key, value in headers.items():
+    if key.upper().replace("_", "-") in (name, "HTTP-" + name):
+      return value
+  return None